@@ -3,41 +3,138 @@
 glos_qartod/cli.py
 '''
 from argparse import ArgumentParser
-from netCDF4 import Dataset
-from glos_qartod.qc import DatasetQC
 from glos_qartod import get_logger
+from glos_qartod.config import load_compiled_config
 import logging
 import logging.config
-import pkg_resources
 import os
 import six
 import json
-import pandas as pd
-from lxml import etree
-from redis import StrictRedis
-import redis_lock
+import time
 from collections import OrderedDict
 
+# Heavy dependencies (pandas, netCDF4, lxml, redis, ioos_qartod, cf_units) are
+# imported inside the functions that need them so that `--help` and forked rq
+# jobs don't pay for them at module load.
+
 
 def main():
     '''
     Apply QARTOD QC to GliderDAC submitted netCDF files
     '''
     parser = ArgumentParser(description=main.__doc__)
-    parser.add_argument('-c', '--config', help='Path to config YML file to use')
+    parser.add_argument('-c', '--config',
+                        help='Path to config file to use (Excel, CSV, JSON, '
+                             'YAML or Parquet)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Turn on logging')
+    parser.add_argument('-s', '--series', action='store_true',
+                        help='Treat the files of each station as one '
+                             'consecutive time series so that window tests '
+                             'keep their context across file boundaries')
+    parser.add_argument('-b', '--backend', choices=['netcdf4', 'dask'],
+                        default='netcdf4',
+                        help='Compute the flags eagerly with netCDF4 or '
+                             'lazily and in parallel with xarray and dask')
+    parser.add_argument('-o', '--output', choices=['ncq', 'zarr', 'inplace'],
+                        default='ncq',
+                        help='Write the flags to a .ncq netCDF file, to a '
+                             'chunked, compressed Zarr store or into the '
+                             'netCDF file itself')
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help='Records per chunk for the dask backend and the '
+                             'Zarr output')
+    parser.add_argument('--scheduler', choices=['threads', 'synchronous'],
+                        default=None,
+                        help='dask scheduler for the dask backend.  The '
+                             'flags are written from this process, so the '
+                             'processes scheduler is not supported')
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help='Read the next file and write the previous one '
+                             'while the tests of the current file run')
+    parser.add_argument('--neighbor-files', nargs='+', default=[],
+                        help='Files of other stations to compare with in '
+                             'the neighbor test, in addition to the files '
+                             'being QC\'d')
+    parser.add_argument('-j', '--journal',
+                        help='Path to a run journal.  Files already QC\'d '
+                             'with the same config and unchanged since are '
+                             'skipped, and completed work is appended to it')
+    parser.add_argument('--summary',
+                        help='Path to a SQLite database to record the flag '
+                             'counts of each file, variable and test in')
     parser.add_argument('netcdf_files', nargs='+',
                         help='NetCDF file to apply QC to')
 
     args = parser.parse_args()
     if args.verbose:
         setup_logging()
-    get_logger().info("Loading config %s", args.config)
-    config = pd.read_excel(args.config)
-    for nc_file in args.netcdf_files:
-        with Dataset(nc_file, 'r') as nc:
-            run_qc(config, nc)
+    config = load_compiled_config(args.config)
+    if args.backend == 'dask':
+        if args.series:
+            parser.error('--series is not supported by the dask backend')
+        if args.output != 'ncq':
+            parser.error('--output {} is not supported by the dask '
+                         'backend'.format(args.output))
+        if args.neighbor_files:
+            parser.error('--neighbor-files is not supported by the dask '
+                         'backend')
+        if args.pipeline:
+            parser.error('--pipeline is not supported by the dask backend')
+        if args.summary:
+            parser.error('--summary is not supported by the dask backend')
+        from glos_qartod.xarray_qc import run_qc_xarray
+        for nc_file in args.netcdf_files:
+            run_qc_xarray(config, nc_file, chunk_size=args.chunk_size,
+                          scheduler=args.scheduler)
+        return
+    if args.pipeline and (args.series or args.output != 'ncq'):
+        parser.error('--pipeline does not support --series or --output '
+                     'zarr or inplace')
+    if args.journal and args.series:
+        # a file's flags depend on its neighbours in the series
+        parser.error('--journal is not supported with --series')
+    journal = None
+    if args.journal:
+        from glos_qartod.journal import RunJournal, config_key
+        journal = RunJournal(args.journal, config_key(args.config))
+    summary = None
+    if args.summary:
+        from glos_qartod.summary import FlagSummary
+        summary = FlagSummary(args.summary)
+    neighbors = build_neighbor_index(config, args.netcdf_files +
+                                     args.neighbor_files)
+    try:
+        if args.pipeline:
+            from glos_qartod.pipeline import run_pipeline
+            run_pipeline(config, args.netcdf_files, neighbors=neighbors,
+                         journal=journal, summary=summary)
+        elif args.series:
+            run_qc_series(config, args.netcdf_files, output=args.output,
+                          chunk_size=args.chunk_size, neighbors=neighbors,
+                          summary=summary)
+        else:
+            for nc_file in args.netcdf_files:
+                run_qc_path(config, nc_file, args.output,
+                            chunk_size=args.chunk_size, neighbors=neighbors,
+                            journal=journal, summary=summary)
+    finally:
+        if summary is not None:
+            summary.close()
+
+
+def build_neighbor_index(config, nc_paths):
+    '''
+    Returns a glos_qartod.neighbors.NeighborIndex of the stations of
+    `nc_paths` if the neighbor test is configured, otherwise None
+
+    :param glos_qartod.config.CompiledConfig config: Compiled configuration
+    :param list nc_paths: Paths of the netCDF files of the run
+    '''
+    from glos_qartod.neighbors import NeighborIndex, needs_neighbors
+    if not needs_neighbors(config):
+        return None
+    return NeighborIndex(nc_paths)
 
 
 def extract_dimensions(od):
@@ -55,6 +152,7 @@ def create_or_open_qc_file(qc_file_name, parent_dimensions):
     :param qc_file_name str: The path of the file to open or create
     :param dimensions list: A list of tuples with the dimensions
     """
+    from netCDF4 import Dataset
     if os.path.exists(qc_file_name):
         try:
             ncfile = Dataset(qc_file_name, 'a')
@@ -81,45 +179,192 @@ def create_or_open_qc_file(qc_file_name, parent_dimensions):
 
 
 
-def run_qc(config, ncfile, qc_extension='ncq'):
+def run_qc(config, ncfile, qc_extension='ncq', series=None, neighbors=None,
+           journal=None, summary=None):
     '''
     Runs QC on a netCDF file
 
-    Takes a path to an Excel file to be read or pandas DataFrame containing
-    QC configuration and applies the QC to the file at `filepath`.
+    Takes a path to an Excel file to be read, a pandas DataFrame or a
+    glos_qartod.config.CompiledConfig containing QC configuration and applies
+    the QC to the file at `filepath`.
     Creates a file with the same base name as filepath, but with the file
     extension specified by `qc_extension`.
 
     :param config: str or pandas.DataFrame
     :param ncfile: netCDF4.Dataset
     :param qc_extension: str
+    :param series: glos_qartod.series.StationSeries the file belongs to, if
+                   window tests should use records from neighbouring files
+    :param neighbors: glos_qartod.neighbors.NeighborIndex of the stations of
+                      the run, if the neighbor test should be applied
+    :param journal: glos_qartod.journal.RunJournal to record the completed
+                    tests in
+    :param summary: glos_qartod.summary.FlagSummary to record the flag
+                    counts in
     '''
+    from lxml import etree
+    from glos_qartod.qc import DatasetQC
     fname_base = ncfile.filepath().rsplit('.', 1)[0]
     qc_filename = "{}.{}".format(fname_base, qc_extension)
     # Look for existing qc_file or return new one
     qc_file = create_or_open_qc_file(qc_filename, ncfile.dimensions)
     # load NcML aggregation if it exists
     ncml_filename = fname_base + '.ncml'
-    qc = DatasetQC(ncfile, qc_file, ncml_filename, config)
-    # zero length times will throw an IndexError in the netCDF interface,
-    # and won't result in any QC being applied anyways, so skip them if present
-    if qc.ncfile.variables['time'].size > 0:
-        for varname in qc.find_geophysical_variables():
-            get_logger().info("Applying QC to %s", varname)
-            ncvar = ncfile.variables[varname]
-            for qcvarname in qc.create_qc_variables(ncvar):
-                qcvar = qc_file.variables[qcvarname]
-                get_logger().info(qcvarname)
-                qc.apply_qc(qcvar)
-            get_logger().info("Primary QC")
-            qc.apply_primary_qc(ncvar)
+    qc = DatasetQC(ncfile, qc_file, ncml_filename, config, series, neighbors,
+                   summary)
+    apply_dataset_qc(qc, journal)
+    if summary is not None:
+        summary.commit()
     # if there were changes in the ncml file, write them
     if qc.ncml_write_flag:
-        with open(ncml_filename, 'w') as ncml_file:
+        with open(ncml_filename, 'wb') as ncml_file:
             ncml_file.write(etree.tostring(qc.ncml))
     qc_file.close()
 
 
+def apply_dataset_qc(qc, journal=None):
+    """
+    Creates the QC variables for every configured variable of a DatasetQC's
+    dataset and applies the tests and primary QC to them.  Returns the list
+    of variables QC'd.
+
+    :param qc: glos_qartod.qc.DatasetQC
+    :param journal: glos_qartod.journal.RunJournal to record the completed
+                    tests in
+    """
+    ncfile, qc_file = qc.ncfile, qc.qc_file
+    # zero length times will throw an IndexError in the netCDF interface,
+    # and won't result in any QC being applied anyways, so skip them if present
+    if ncfile.variables['time'].size == 0:
+        return []
+    varnames = list(qc.find_geophysical_variables())
+    # every QC variable is defined before any flags are written
+    qcvarnames = qc.define_qc_variables(
+        [ncfile.variables[varname] for varname in varnames])
+    for varname in varnames:
+        get_logger().info("Applying QC to %s", varname)
+        ncvar = ncfile.variables[varname]
+        for qcvarname in qcvarnames[varname]:
+            qcvar = qc_file.variables[qcvarname]
+            get_logger().info(qcvarname)
+            started = time.time()
+            task = qc.apply_qc(qcvar)
+            if journal is not None and task is not None:
+                journal.unit(ncfile.filepath(), varname, task.qartod_test,
+                             time.time() - started)
+        get_logger().info("Primary QC")
+        started = time.time()
+        qc.apply_primary_qc(ncvar)
+        if journal is not None:
+            journal.unit(ncfile.filepath(), varname, 'primary',
+                         time.time() - started)
+    return varnames
+
+
+def run_qc_output(config, ncfile, output='ncq', series=None,
+                  chunk_size=None, neighbors=None, journal=None,
+                  summary=None):
+    """
+    Runs QC on a netCDF file, writing the flags to a .ncq file or, if
+    `output` is 'zarr', to a Zarr store or, if it is 'inplace', into the
+    netCDF file itself
+
+    :param config: str or pandas.DataFrame
+    :param ncfile: netCDF4.Dataset, opened in 'a' mode for inplace output
+    :param output: str, 'ncq', 'zarr' or 'inplace'
+    :param series: glos_qartod.series.StationSeries the file belongs to
+    :param chunk_size: int, records per Zarr chunk
+    :param neighbors: glos_qartod.neighbors.NeighborIndex of the run
+    :param journal: glos_qartod.journal.RunJournal to record the completed
+                    tests of .ncq and inplace output in
+    :param summary: glos_qartod.summary.FlagSummary to record the flag
+                    counts in
+    """
+    if output == 'zarr':
+        from glos_qartod.zarr_qc import DEFAULT_CHUNK_SIZE, run_qc_zarr
+        run_qc_zarr(config, ncfile, series=series,
+                    chunk_size=chunk_size or DEFAULT_CHUNK_SIZE,
+                    neighbors=neighbors, summary=summary)
+    elif output == 'inplace':
+        from glos_qartod.inplace import run_qc_inplace
+        run_qc_inplace(config, ncfile, series=series, neighbors=neighbors,
+                       journal=journal, summary=summary)
+    else:
+        run_qc(config, ncfile, series=series, neighbors=neighbors,
+               journal=journal, summary=summary)
+
+
+def run_qc_path(config, nc_path, output='ncq', chunk_size=None,
+                neighbors=None, journal=None, summary=None):
+    """
+    Runs QC on the netCDF file at `nc_path`.  With a journal, files it
+    records as done are skipped without being opened and the start, tests
+    and end of the file's QC are recorded.  Returns False if the file was
+    skipped.
+
+    :param config: str or pandas.DataFrame
+    :param nc_path: str
+    :param output: str, 'ncq', 'zarr' or 'inplace'
+    :param chunk_size: int, records per Zarr chunk
+    :param neighbors: glos_qartod.neighbors.NeighborIndex of the run
+    :param journal: glos_qartod.journal.RunJournal of the run
+    :param summary: glos_qartod.summary.FlagSummary to record the flag
+                    counts in
+    """
+    from netCDF4 import Dataset
+    if journal is not None:
+        if journal.is_complete(nc_path):
+            get_logger().info("%s is already QC'd, skipping", nc_path)
+            return False
+        if journal.is_interrupted(nc_path):
+            get_logger().info("QC of %s was interrupted, redoing", nc_path)
+        journal.start(nc_path)
+    started = time.time()
+    # inplace output writes the flags into the file itself
+    mode = 'a' if output == 'inplace' else 'r'
+    with Dataset(nc_path, mode) as nc:
+        run_qc_output(config, nc, output, chunk_size=chunk_size,
+                      neighbors=neighbors, journal=journal, summary=summary)
+    if journal is not None:
+        journal.done(nc_path, time.time() - started)
+    return True
+
+
+def run_qc_series(config, nc_paths, qc_extension='ncq', output=None,
+                  chunk_size=None, neighbors=None, summary=None):
+    """
+    Runs QC on a set of files, presenting the consecutive files of each
+    station as one time ordered series.  Spike, rate of change and flat line
+    tests read the records they need from the neighbouring files, and flags
+    are still written to each file's own QC file.
+
+    :param config: str or pandas.DataFrame
+    :param nc_paths: list of str
+    :param qc_extension: str
+    :param output: str, 'zarr' to write the flags to Zarr stores or
+                   'inplace' to write them into the files
+    :param chunk_size: int, records per Zarr chunk
+    :param neighbors: glos_qartod.neighbors.NeighborIndex of the run
+    :param summary: glos_qartod.summary.FlagSummary to record the flag
+                    counts in
+    """
+    from netCDF4 import Dataset
+    from glos_qartod.series import StationSeries, group_by_station
+    for station_name, paths in six.iteritems(group_by_station(nc_paths)):
+        get_logger().info("Station series %s: %s files", station_name,
+                          len(paths))
+        series = StationSeries(paths)
+        for nc_path in paths:
+            mode = 'a' if output == 'inplace' else 'r'
+            with Dataset(nc_path, mode) as nc:
+                if output in ('zarr', 'inplace'):
+                    run_qc_output(config, nc, output, series, chunk_size,
+                                  neighbors, summary=summary)
+                else:
+                    run_qc(config, nc, qc_extension, series, neighbors,
+                           summary=summary)
+
+
 def run_qc_str(config, nc_path, qc_extension='ncq'):
     """
     Helper function to run_qc.  Mainly used to pass jobs off from redis.
@@ -128,11 +373,13 @@ def run_qc_str(config, nc_path, qc_extension='ncq'):
     :param nc_path: str
     :param qc_extension: str
     """
+    from netCDF4 import Dataset
     # take out a lock on the file being processed
     with Dataset(nc_path, 'r') as nc:
         run_qc(config, nc, qc_extension)
 
-def run_qc_str_lock(config, nc_path):
+def run_qc_str_lock(config, nc_path, journal=None, summary=None,
+                    output='ncq'):
     """
     Helper function to run_qc.  Mainly used to pass jobs off from redis.
     Also takes out a lock in redis to avoid possibly starting multiple jobs
@@ -140,19 +387,37 @@ def run_qc_str_lock(config, nc_path):
 
     :param config: str or pandas.DataFrame
     :param nc_path: str
-    :param qc_extension: str
+    :param journal: str, path to a run journal to record the file's QC in
+    :param summary: str, path to a flag summary database to record the
+                    file's flag counts in
+    :param output: str, 'ncq' or 'inplace'
     """
+    from redis import StrictRedis
+    import redis_lock
     conn = StrictRedis()
     # take out a lock on the file being processed
     with redis_lock.Lock(conn, "{}-lock".format(nc_path)):
-        with Dataset(nc_path, 'r') as nc:
-            run_qc(config, nc)
+        if journal is not None:
+            from glos_qartod.journal import RunJournal, config_key
+            # run.py already skipped the files the journal has done, so jobs
+            # only append to it rather than each reading all of it
+            journal = RunJournal(journal, config_key(config), load=False)
+        if summary is not None:
+            from glos_qartod.summary import FlagSummary
+            summary = FlagSummary(summary)
+        try:
+            run_qc_path(config, nc_path, output, journal=journal,
+                        summary=summary)
+        finally:
+            if summary is not None:
+                summary.close()
 
 def setup_logging(default_path=None, default_level=logging.INFO,
                   env_key='LOG_CFG'):
     """
     Setup logging configuration
     """
+    import pkg_resources
     path = default_path or pkg_resources.resource_filename('glos_qartod',
                                                            'logging.json')
     value = os.getenv(env_key, None)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+'''
+glos_qartod/climatology.py
+
+QARTOD climatology test.  The seasonal, and optionally depth dependent,
+bounds of a station's variable are read from the "Climatology" config sheet,
+one row per period:
+
+`station_id,variable,period,start,end,min,max[,depth_min,depth_max]`
+
+`period` is either `month` (`start` and `end` from 1 to 12) or `day` (day of
+the year from 1 to 366).  Periods are inclusive and wrap around the end of the
+year when `start` is after `end`, e.g. a December to February row.  Depth
+bounds are in the units of the variable's depth and cover
+`depth_min <= depth < depth_max`; rows without them apply at every depth.
+Where rows overlap the first one wins, as in the Variable Config.
+
+Each station's variable is compiled into a dense table of bounds indexed by
+calendar (leap or common year), day of the year and depth bin, so flagging a
+series is a single gather and compare rather than a search of the rows per
+record.
+'''
+import numpy as np
+
+PERIODS = ('month', 'day')
+
+DAYS_IN_YEAR = 366
+
+
+def calendar_months():
+    '''
+    Returns a (2, 366) array of the month, 1 to 12, of each day of the year
+    of a common year (row 0) and a leap year (row 1).  The 366th day of a
+    common year is 0.
+    '''
+    months = np.zeros((2, DAYS_IN_YEAR), dtype=np.int8)
+    for leap, year in enumerate((2001, 2000)):
+        days = np.arange('{}-01-01'.format(year), '{}-01-01'.format(year + 1),
+                         dtype='datetime64[D]')
+        months[leap, :days.size] = (days.astype('datetime64[M]') -
+                                    days.astype('datetime64[Y]')).astype(int) + 1
+    return months
+
+
+def in_period(positions, start, end):
+    '''
+    Returns a boolean array which is True for the positions in the inclusive
+    period from `start` to `end`, wrapping around if `start` is after `end`
+    '''
+    if start <= end:
+        return (positions >= start) & (positions <= end)
+    return (positions >= start) | (positions <= end)
+
+
+class ClimatologyTable(object):
+    '''
+    Dense lookup table of the climatological bounds of a station's variable.
+
+    `bounds` has the shape (2, 366, depth bins, 2): the minimum and maximum
+    for each calendar, day of the year and depth bin, NaN where no row
+    applies.  The depth bins are delimited by the depth bounds of the rows,
+    with a last bin for values of unknown depth.
+    '''
+
+    def __init__(self, rows):
+        '''
+        :param list rows: Rows of the Climatology sheet for one station and
+                          variable, as dicts or pandas Series
+        '''
+        edges = set()
+        for row in rows:
+            for key in ('depth_min', 'depth_max'):
+                depth = _number(row, key)
+                if depth is not None:
+                    edges.add(depth)
+        self.depth_edges = np.array(sorted(edges), dtype=np.float64)
+        n_bins = self.depth_edges.size + 2
+        lower = np.concatenate([[-np.inf], self.depth_edges])
+        upper = np.concatenate([self.depth_edges, [np.inf]])
+
+        months = calendar_months()
+        days = np.tile(np.arange(1, DAYS_IN_YEAR + 1), (2, 1))
+        days[0, -1] = 0
+        self.bounds = np.full((2, DAYS_IN_YEAR, n_bins, 2), np.nan)
+        for row in rows:
+            period = row['period']
+            if period not in PERIODS:
+                raise ValueError("Climatology period must be one of {}, not "
+                                 "{}".format(', '.join(PERIODS), period))
+            positions = months if period == 'month' else days
+            in_season = in_period(positions, int(row['start']),
+                                  int(row['end']))
+            depth_min = _number(row, 'depth_min')
+            depth_max = _number(row, 'depth_max')
+            bins = np.zeros(n_bins, dtype=bool)
+            bins[:-1] = ((lower >= (-np.inf if depth_min is None
+                                    else depth_min)) &
+                         (upper <= (np.inf if depth_max is None
+                                    else depth_max)))
+            # values of unknown depth only match rows without depth bounds
+            bins[-1] = depth_min is None and depth_max is None
+            cells = in_season[:, :, None] & bins[None, None, :]
+            # the first row wins where rows overlap
+            cells &= np.isnan(self.bounds[..., 0])
+            self.bounds[cells] = (float(row['min']), float(row['max']))
+
+    def depth_bins(self, depths):
+        '''
+        Returns the depth bin of each depth, the last bin for NaN or None
+
+        :param depths: Depths, or None if unknown
+        '''
+        if depths is None:
+            return np.array(self.bounds.shape[2] - 1)
+        depths = np.asarray(depths, dtype=np.float64)
+        return np.where(np.isnan(depths), self.bounds.shape[2] - 1,
+                        np.searchsorted(self.depth_edges, depths,
+                                        side='right'))
+
+    def lookup(self, dates, depths=None):
+        '''
+        Returns a tuple of the minimum and maximum bounds for each date and
+        depth, broadcast together.  Bounds are NaN where no period applies or
+        the date is NaT.
+
+        :param numpy.ndarray dates: datetime64 times
+        :param depths: Depths of the values, or None if unknown
+        '''
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        missing = np.isnat(dates)
+        years = dates.astype('datetime64[Y]')
+        doy = (dates - years).astype(np.int64)
+        year = years.astype(np.int64) + 1970
+        leap = ((year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0)))
+        doy[missing] = 0
+        cells = self.bounds[leap.astype(np.intp), doy, self.depth_bins(depths)]
+        lower = cells[..., 0]
+        upper = cells[..., 1]
+        if missing.any():
+            missing = np.broadcast_to(missing, lower.shape)
+            lower[missing] = np.nan
+            upper[missing] = np.nan
+        return lower, upper
+
+    def flag(self, dates, values, depths=None):
+        '''
+        Returns int8 flags for `values`: GOOD within the climatological
+        bounds of their date and depth, SUSPECT outside them and
+        NOT_EVALUATED (2) where no period of the climatology applies.
+
+        :param numpy.ndarray dates: datetime64 times, broadcastable to values
+        :param numpy.ndarray values: Values to test
+        :param depths: Depths, broadcastable to values, or None if unknown
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        lower, upper = self.lookup(dates, depths)
+        lower, upper = np.broadcast_arrays(lower, upper, values)[:2]
+        flags = np.ones(values.shape, dtype=np.int8)
+        with np.errstate(invalid='ignore'):
+            flags[(values < lower) | (values > upper)] = 3
+        flags[np.isnan(lower)] = 2
+        return flags
+
+
+def _number(row, key):
+    '''
+    Returns the value of `key` in a row as a float, or None if it is absent
+    or blank
+    '''
+    value = row.get(key)
+    if value is None:
+        return None
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def compile_climatology(frame):
+    '''
+    Returns a tuple of dicts of ClimatologyTable keyed by (station_id,
+    variable) for station specific rows and by variable for station-wide
+    ('*') rows of a Climatology sheet
+
+    :param pandas.DataFrame frame: The Climatology sheet
+    '''
+    grouped = {}
+    for _, row in frame.iterrows():
+        key = (str(row['station_id']), row['variable'])
+        grouped.setdefault(key, []).append(row)
+    station_tables = {}
+    wildcard_tables = {}
+    for (station_id, variable), rows in grouped.items():
+        if station_id == '*':
+            wildcard_tables[variable] = ClimatologyTable(rows)
+        else:
+            station_tables[(station_id, variable)] = ClimatologyTable(rows)
+    return station_tables, wildcard_tables
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+'''
+glos_qartod/config.py
+'''
+from argparse import ArgumentParser
+from collections import OrderedDict
+from glos_qartod import get_logger
+import glob
+import json
+import os
+import six
+
+
+# Loaded configurations keyed by absolute path.  Each value is a tuple of the
+# file stamp the entry was loaded from and a dict of cached objects derived
+# from the file, so that a long running process only re-reads a configuration
+# when the file on disk changes.
+_cache = {}
+
+VARIABLE_CONFIG = 'Variable Config'
+MAPPINGS = 'Mappings'
+CLIMATOLOGY = 'Climatology'
+
+# Required columns of each sheet
+REQUIRED_COLUMNS = {
+    VARIABLE_CONFIG: ['station_id', 'variable', 'units'],
+    MAPPINGS: ['var_name', 'var_dir'],
+    CLIMATOLOGY: ['station_id', 'variable', 'period', 'start', 'end', 'min',
+                  'max']
+}
+
+# Numeric columns of the Climatology sheet
+CLIMATOLOGY_NUMERIC = ['start', 'end', 'min', 'max', 'depth_min', 'depth_max']
+
+# Parameter columns, as <test>.<parameter>, accepted in the Variable Config
+TEST_PARAMETERS = {
+    'gross_range': ['sensor_min', 'sensor_max', 'user_min', 'user_max'],
+    'rate_of_change': ['threshold'],
+    'spike': ['low_threshold', 'high_threshold'],
+    'flat_line': ['low_reps', 'high_reps', 'epsilon'],
+    'neighbor': ['k', 'max_distance', 'time_tolerance', 'suspect_threshold',
+                 'fail_threshold']
+}
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xls')
+# Formats which hold one table per file.  The Variable Config is stored in the
+# file itself and any other sheet in a sibling file named after the sheet,
+# e.g. config.csv and config.mappings.csv
+TABLE_EXTENSIONS = ('.csv', '.parquet')
+DOCUMENT_EXTENSIONS = ('.json', '.yml', '.yaml')
+
+
+def config_format(path):
+    '''
+    Returns the lower case file extension of a config file, raising a
+    ValueError if it is not a supported format
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in EXCEL_EXTENSIONS + TABLE_EXTENSIONS + DOCUMENT_EXTENSIONS:
+        raise ValueError("Unsupported config format '{}' for {}".format(ext,
+                                                                        path))
+    return ext
+
+
+def sheet_path(path, sheet_name):
+    '''
+    Returns the path of the file holding `sheet_name` for a one table per file
+    config format
+    '''
+    if sheet_name == VARIABLE_CONFIG:
+        return path
+    base, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(base, sheet_name.lower().replace(' ', '_'), ext)
+
+
+def config_files(path):
+    '''
+    Returns the paths of all files making up the config at `path`
+    '''
+    if os.path.splitext(path)[1].lower() not in TABLE_EXTENSIONS:
+        return [path]
+    base, ext = os.path.splitext(path)
+    # glob.escape is not available on python 2
+    if hasattr(glob, 'escape'):
+        base = glob.escape(base)
+    return [path] + sorted(glob.glob('{}.*{}'.format(base, ext)))
+
+
+def file_stamp(path):
+    '''
+    Returns a tuple identifying the current version of the config at `path`,
+    including any sibling sheet files
+    '''
+    stamp = []
+    for f in config_files(path):
+        st = os.stat(f)
+        stamp.append((f, st.st_mtime, st.st_size))
+    return tuple(stamp)
+
+
+def _cached(path):
+    '''
+    Returns the cache entry dict for `path`, discarding it if the file has
+    changed since it was populated.
+    '''
+    key = os.path.abspath(path)
+    stamp = file_stamp(key)
+    entry = _cache.get(key)
+    if entry is None or entry[0] != stamp:
+        if entry is not None:
+            get_logger().info("Config %s changed, reloading", path)
+        entry = (stamp, {})
+        _cache[key] = entry
+    return entry[1]
+
+
+def clear_cache():
+    '''
+    Drops all cached configurations
+    '''
+    _cache.clear()
+
+
+def read_sheets(path):
+    '''
+    Reads the config at `path` without caching or validation and returns an
+    ordered dict of sheet name to pandas DataFrame.  The format is chosen by
+    the file extension: Excel (.xlsx, .xls), CSV (.csv), Parquet (.parquet),
+    JSON (.json) or YAML (.yml, .yaml).
+
+    :param str path: Path to the config file
+    '''
+    import pandas as pd
+    ext = config_format(path)
+    if ext in EXCEL_EXTENSIONS:
+        sheets = pd.read_excel(path, None)
+        return OrderedDict((name, _promote_header(frame, REQUIRED_COLUMNS.get(
+            name, REQUIRED_COLUMNS[VARIABLE_CONFIG])))
+            for name, frame in six.iteritems(sheets))
+
+    sheets = OrderedDict()
+    if ext in TABLE_EXTENSIONS:
+        for f in config_files(path):
+            if f == path:
+                name = VARIABLE_CONFIG
+            else:
+                slug = f[len(os.path.splitext(path)[0]) + 1:-len(ext)]
+                name = slug.replace('_', ' ').title()
+            if ext == '.csv':
+                # keep station identifiers such as 45005 as strings
+                sheets[name] = pd.read_csv(f, dtype={'station_id': str})
+            else:
+                sheets[name] = pd.read_parquet(f)
+        return sheets
+
+    with open(path, 'r') as f:
+        if ext == '.json':
+            document = json.load(f, object_pairs_hook=OrderedDict)
+        else:
+            import yaml
+            document = yaml.safe_load(f)
+    if not isinstance(document, dict):
+        raise ValueError("Config {} must map sheet names to lists of "
+                         "records".format(path))
+    for name, records in six.iteritems(document):
+        sheets[name] = pd.DataFrame(records)
+    return sheets
+
+
+def _promote_header(frame, required, max_rows=5):
+    '''
+    Returns `frame` with the header moved to the first of the leading rows
+    that contains the `required` column names.  Workbooks exported from some
+    spreadsheet applications have a table title row above the header.
+    '''
+    import pandas as pd
+    if all(c in frame.columns for c in required):
+        return frame
+    for i in range(min(len(frame), max_rows)):
+        header = frame.iloc[i].tolist()
+        if all(c in header for c in required):
+            body = frame.iloc[i + 1:].reset_index(drop=True)
+            body.columns = header
+            for column in body.columns:
+                if column in required:
+                    continue
+                try:
+                    body[column] = pd.to_numeric(body[column])
+                except (ValueError, TypeError):
+                    pass
+            return body
+    return frame
+
+
+def validate_sheets(sheets, path=''):
+    '''
+    Checks that config sheets follow the "Variable Config"/"Mappings" schema,
+    raising a ValueError describing the first problem found.
+
+    :param dict sheets: Sheet name to pandas DataFrame
+    :param str path: Path of the config, used in error messages
+    '''
+    import pandas as pd
+    if VARIABLE_CONFIG not in sheets:
+        raise ValueError("Config {} has no '{}' sheet".format(path,
+                                                             VARIABLE_CONFIG))
+    for name, required in six.iteritems(REQUIRED_COLUMNS):
+        if name not in sheets:
+            continue
+        missing = [c for c in required if c not in sheets[name].columns]
+        if missing:
+            raise ValueError("Sheet '{}' of config {} is missing columns: "
+                             "{}".format(name, path, ', '.join(missing)))
+
+    frame = sheets[VARIABLE_CONFIG]
+    for column in frame.columns:
+        if '.' not in column:
+            continue
+        test, param = column.split('.', 1)
+        if param not in TEST_PARAMETERS.get(test, []):
+            raise ValueError("Unknown test parameter '{}' in config "
+                             "{}".format(column, path))
+        try:
+            pd.to_numeric(frame[column])
+        except (ValueError, TypeError):
+            raise ValueError("Test parameter '{}' in config {} must be "
+                             "numeric".format(column, path))
+
+    if CLIMATOLOGY in sheets:
+        from glos_qartod.climatology import PERIODS
+        frame = sheets[CLIMATOLOGY]
+        for column in CLIMATOLOGY_NUMERIC:
+            if column not in frame.columns:
+                continue
+            try:
+                pd.to_numeric(frame[column])
+            except (ValueError, TypeError):
+                raise ValueError("Climatology column '{}' in config {} must "
+                                 "be numeric".format(column, path))
+        unknown = set(frame['period']) - set(PERIODS)
+        if unknown:
+            raise ValueError("Unknown climatology period(s) {} in config "
+                             "{}".format(', '.join(sorted(map(str, unknown))),
+                                         path))
+
+
+def load_sheets(path):
+    '''
+    Returns an ordered dict of sheet name to pandas DataFrame for the config
+    file at `path`, validated against the config schema.  Results are cached
+    until the file is modified.
+
+    :param str path: Path to the config file
+    '''
+    entry = _cached(path)
+    if 'sheets' not in entry:
+        get_logger().info("Loading config %s", path)
+        sheets = read_sheets(path)
+        # older workbooks may name the first sheet differently
+        if VARIABLE_CONFIG not in sheets and config_format(path) in \
+                EXCEL_EXTENSIONS:
+            first = next(iter(sheets))
+            sheets = OrderedDict([(VARIABLE_CONFIG if k == first else k, v)
+                                  for k, v in six.iteritems(sheets)])
+        validate_sheets(sheets, path)
+        entry['sheets'] = sheets
+    return entry['sheets']
+
+
+def load_config(path):
+    '''
+    Returns the "Variable Config" sheet of the config file at `path` as a
+    pandas DataFrame.
+
+    :param str path: Path to the config file
+    '''
+    return load_sheets(path)[VARIABLE_CONFIG]
+
+
+def _records(frame):
+    '''
+    Returns the rows of a DataFrame as a list of dicts of plain python
+    values, with missing values as None
+    '''
+    import pandas as pd
+    records = []
+    for row in frame.to_dict(orient='records'):
+        records.append(OrderedDict(
+            (k, None if pd.isnull(v) else getattr(v, 'item', lambda: v)())
+            for k, v in six.iteritems(row)))
+    return records
+
+
+def write_sheets(sheets, path):
+    '''
+    Writes config sheets to `path` in the format given by its extension
+
+    :param dict sheets: Sheet name to pandas DataFrame
+    :param str path: Destination path
+    '''
+    import pandas as pd
+    ext = config_format(path)
+    if ext in EXCEL_EXTENSIONS:
+        with pd.ExcelWriter(path) as writer:
+            for name, frame in six.iteritems(sheets):
+                frame.to_excel(writer, sheet_name=name, index=False)
+    elif ext in TABLE_EXTENSIONS:
+        for name, frame in six.iteritems(sheets):
+            if ext == '.csv':
+                frame.to_csv(sheet_path(path, name), index=False)
+            else:
+                frame.to_parquet(sheet_path(path, name), index=False)
+    else:
+        document = OrderedDict((name, _records(frame))
+                               for name, frame in six.iteritems(sheets))
+        with open(path, 'w') as f:
+            if ext == '.json':
+                json.dump(document, f, indent=2)
+            else:
+                import yaml
+                yaml.safe_dump(json.loads(json.dumps(document)), f,
+                               default_flow_style=False)
+
+
+def convert(src, dest):
+    '''
+    Converts the config at `src` to the format given by the extension of
+    `dest`, validating it on the way.
+    '''
+    write_sheets(load_sheets(src), dest)
+
+
+def load_compiled_config(path):
+    '''
+    Returns a CompiledConfig for the config file at `path`.  Results are
+    cached until the file is modified.
+
+    :param str path: Path to the config file
+    '''
+    entry = _cached(path)
+    if 'compiled' not in entry:
+        sheets = load_sheets(path)
+        entry['compiled'] = CompiledConfig(sheets[VARIABLE_CONFIG],
+                                           sheets.get(CLIMATOLOGY))
+    return entry['compiled']
+
+
+def compile_config(config):
+    '''
+    Returns a CompiledConfig for a path, DataFrame or already compiled config
+
+    :param config: str, pandas.DataFrame or CompiledConfig
+    '''
+    if isinstance(config, CompiledConfig):
+        return config
+    if isinstance(config, six.string_types):
+        return load_compiled_config(config)
+    return CompiledConfig(config)
+
+
+class CompiledConfig(object):
+    '''
+    Lookup tables built once from the "Variable Config" DataFrame so that
+    per-variable configuration resolution is a dict access rather than a
+    DataFrame scan.  The optional "Climatology" sheet is compiled into a
+    lookup table per station and variable.
+    '''
+
+    def __init__(self, frame, climatology=None):
+        self.frame = frame
+        self.climatology_frame = climatology
+        self.climatology_tables = ({}, {})
+        if climatology is not None:
+            from glos_qartod.climatology import compile_climatology
+            self.climatology_tables = compile_climatology(climatology)
+        # station specific rows keyed by (station_id, variable) and
+        # station-wide ('*') rows keyed by variable.  The first row wins if
+        # there are duplicates.
+        self.station_rows = {}
+        self.wildcard_rows = {}
+        self.station_variables = {}
+        for _, row in frame.iterrows():
+            station_id = str(row['station_id'])
+            variable = row['variable']
+            if station_id == '*':
+                self.wildcard_rows.setdefault(variable, row)
+            else:
+                self.station_rows.setdefault((station_id, variable), row)
+                self.station_variables.setdefault(station_id,
+                                                  []).append(variable)
+
+    def variables(self, station_id):
+        '''
+        Returns the list of configured variables for a station, including
+        station-wide ('*') variables
+        '''
+        local = self.station_variables.get(station_id, [])
+        univ = [v for v in self.wildcard_rows if v not in local]
+        return local + univ
+
+    def get(self, station_id, variable):
+        '''
+        Returns the config row for the station and variable, preferring
+        station specific configuration to station-wide ('*') configuration.
+        The returned row has its station_id set to `station_id`.
+
+        :param str station_id: Station identifier
+        :param str variable: Variable name
+        '''
+        row = self.station_rows.get((station_id, variable))
+        if row is None:
+            row = self.wildcard_rows.get(variable)
+        if row is None:
+            raise KeyError("No configuration found for station {} and variable {}.".format(station_id,
+                                                                     variable))
+        row = row.copy()
+        row['station_id'] = station_id
+        return row
+
+    def climatology(self, station_id, variable):
+        '''
+        Returns the glos_qartod.climatology.ClimatologyTable for the station
+        and variable, preferring station specific rows to station-wide ('*')
+        rows, or None if no climatology is configured
+
+        :param str station_id: Station identifier
+        :param str variable: Variable name
+        '''
+        station_tables, wildcard_tables = self.climatology_tables
+        table = station_tables.get((station_id, variable))
+        if table is None:
+            table = wildcard_tables.get(variable)
+        return table
+
+
+def main():
+    '''
+    Convert a QC config, e.g. GLOS-Climatologies.xlsx, between the Excel, CSV,
+    JSON, YAML and Parquet formats
+    '''
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('src', help='Config to convert')
+    parser.add_argument('dest', help='Destination path.  The extension '
+                                     'selects the output format')
+    args = parser.parse_args()
+    convert(args.src, args.dest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+'''
+glos_qartod/export.py
+
+Export of observations with their QC flags to a Parquet or Arrow dataset,
+partitioned by station, variable and month:
+
+    <dest>/station_id=<station>/variable=<variable>/month=<YYYY-MM>/<file>.parquet
+
+Each row is one record of a variable: its time, value and the flags of every
+test and the primary flag, one column each, so queries read only the columns
+they need rather than joining each .nc with its .ncq.  Files are read and
+written in chunks of records.  Each source file is written to its own part
+files, recorded in a manifest in the dataset, so exporting new files appends
+to the dataset and exporting a file that changed replaces its parts.
+'''
+from argparse import ArgumentParser
+from glos_qartod import get_logger
+import json
+import os
+
+
+# Records read and written at a time
+DEFAULT_CHUNK_SIZE = 100000
+
+FORMATS = ('parquet', 'arrow')
+
+# Name of the manifest of the exported files within the dataset
+MANIFEST = '_manifest.json'
+
+
+class PartitionWriter(object):
+    '''
+    Writes tables to the part files of one source file.  Only the part of
+    the partition being written is open: rows of a partition usually arrive
+    together, across several chunks, since records are in time order.  If a
+    partition's rows arrive again after another's, they go to a further part
+    file of it.
+    '''
+
+    def __init__(self, dest, part_name, fmt='parquet'):
+        self.dest = dest
+        self.part_name = part_name
+        self.format = fmt
+        self.partition = None
+        self.writer = None
+        # number of part files of each partition
+        self.parts = {}
+        # paths of the part files relative to dest
+        self.paths = []
+
+    def write(self, partition, table):
+        '''
+        Appends a pyarrow.Table to the part file of a partition
+
+        :param tuple partition: (key, value) pairs of the partition
+        :param pyarrow.Table table: The rows
+        '''
+        if partition != self.partition:
+            self.close()
+            self.writer = self.open(partition, table.schema)
+            self.partition = partition
+        if self.format == 'parquet':
+            self.writer.write_table(table)
+        else:
+            self.writer.write(table)
+
+    def open(self, partition, schema):
+        import pyarrow.ipc
+        import pyarrow.parquet as pq
+        directory = os.path.join(self.dest, *['{}={}'.format(key, value)
+                                              for key, value in partition])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        n = self.parts.get(partition, 0)
+        self.parts[partition] = n + 1
+        name = self.part_name if n == 0 else '{}.{}'.format(self.part_name, n)
+        path = os.path.join(directory, '{}.{}'.format(name, self.format))
+        self.paths.append(os.path.relpath(path, self.dest))
+        if self.format == 'parquet':
+            return pq.ParquetWriter(path, schema)
+        return pyarrow.ipc.new_file(path, schema)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = self.partition = None
+
+
+def load_manifest(dest):
+    '''
+    Returns the manifest of a dataset, a dict of the absolute path of each
+    file exported to the signature of the file and the part files written
+    '''
+    path = os.path.join(dest, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(dest, manifest):
+    '''
+    Replaces the manifest of a dataset
+    '''
+    path = os.path.join(dest, MANIFEST)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def month_partitions(dates):
+    '''
+    Returns a list of (month, start, stop) of the runs of records of each
+    month in `dates`, a datetime64 array.  Months are formatted YYYY-MM.
+    '''
+    import numpy as np
+    if dates.size == 0:
+        return []
+    months = dates.astype('datetime64[M]')
+    edges = np.flatnonzero(months[1:] != months[:-1]) + 1
+    starts = np.concatenate([[0], edges])
+    stops = np.concatenate([edges, [dates.size]])
+    return [(str(months[start]), start, stop)
+            for start, stop in zip(starts, stops)]
+
+
+def export_variable(qc, ncvariable, writer, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Writes the records of a variable with their flags to a PartitionWriter.
+    Returns the number of records written.
+
+    :param glos_qartod.qc.DatasetQC qc: QC of the variable's dataset
+    :param netCDF4.Variable ncvariable: The variable
+    :param PartitionWriter writer: Writer of the source file's parts
+    :param int chunk_size: Records read at a time
+    '''
+    import numpy as np
+    import numpy.ma as ma
+    import pyarrow as pa
+    station_id = qc.station_id()
+    time_var = qc.index.time
+    flag_columns = []
+    for qcvarname in qc.find_ancillary_variables(ncvariable):
+        qcvar = qc.qc_file.variables[qcvarname]
+        test = getattr(qcvar, 'qartod_test', 'primary')
+        flag_columns.append(('{}_flag'.format(test), qcvar))
+    fields = [pa.field('time', pa.timestamp('ms', tz='UTC')),
+              pa.field('value', pa.float64())]
+    fields.extend(pa.field(name, pa.int8()) for name, _ in flag_columns)
+    schema = pa.schema(fields)
+
+    written = 0
+    size = ncvariable.shape[0]
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        times = ma.masked_invalid(time_var[start:stop])
+        valid = ~ma.getmaskarray(times)
+        if not valid.any():
+            continue
+        dates = qc.get_dates(ma.getdata(times)[valid].astype(np.float64))
+        values = ma.masked_invalid(
+            ma.asarray(ncvariable[start:stop], dtype=np.float64))[valid]
+        columns = [dates, values]
+        for _, qcvar in flag_columns:
+            columns.append(ma.filled(qcvar[start:stop], 9)[valid]
+                           .astype(np.int8))
+        for month, m_start, m_stop in month_partitions(dates):
+            arrays = [pa.array(dates[m_start:m_stop], type=fields[0].type),
+                      pa.array(ma.getdata(values[m_start:m_stop]),
+                               mask=ma.getmaskarray(values[m_start:m_stop]),
+                               type=pa.float64())]
+            arrays.extend(pa.array(column[m_start:m_stop], type=pa.int8())
+                          for column in columns[2:])
+            partition = (('station_id', station_id),
+                         ('variable', ncvariable.name), ('month', month))
+            writer.write(partition, pa.Table.from_arrays(arrays,
+                                                         schema=schema))
+        written += int(valid.sum())
+    return written
+
+
+def export_file(config, nc_path, dest, fmt='parquet', qc_extension='ncq',
+                chunk_size=DEFAULT_CHUNK_SIZE, manifest=None):
+    '''
+    Exports the configured variables of a netCDF file and their flags to
+    the dataset at `dest`, replacing the parts of an earlier export of the
+    file.  Files without a QC file are exported if their flags are stored
+    in place, see glos_qartod.inplace.  The file is skipped if it and its QC
+    file are unchanged since it was last exported.  Returns True if the file
+    was exported.
+
+    :param config: str, pandas.DataFrame or CompiledConfig
+    :param str nc_path: Path to the netCDF file
+    :param str dest: Root directory of the dataset
+    :param str fmt: 'parquet' or 'arrow'
+    :param str qc_extension: Extension of the QC file
+    :param int chunk_size: Records read at a time
+    :param dict manifest: Manifest of the dataset, updated in place, see
+                          load_manifest
+    '''
+    from netCDF4 import Dataset
+    from glos_qartod.journal import file_signature
+    from glos_qartod.inplace import InPlaceDatasetQC, has_inplace_flags
+    from glos_qartod.qc import DatasetQC
+    if manifest is None:
+        manifest = load_manifest(dest)
+    fname_base = nc_path.rsplit('.', 1)[0]
+    qc_path = "{}.{}".format(fname_base, qc_extension)
+    inplace = not os.path.exists(qc_path)
+    key = os.path.abspath(nc_path)
+    signature = [file_signature(nc_path),
+                 None if inplace else file_signature(qc_path), fmt]
+    previous = manifest.get(key)
+    if previous is not None and previous['signature'] == signature:
+        get_logger().info("%s is already exported, skipping", nc_path)
+        return False
+
+    part_name = os.path.basename(fname_base)
+    writer = PartitionWriter(dest, part_name, fmt)
+    with Dataset(nc_path) as nc:
+        if inplace and not has_inplace_flags(nc):
+            get_logger().warning("%s has no QC file or flags stored in "
+                                 "place, skipping", nc_path)
+            return False
+        if previous is not None:
+            remove_parts(dest, previous['parts'])
+        qc_file = None
+        try:
+            if inplace:
+                qc = InPlaceDatasetQC(nc, config)
+            else:
+                qc_file = Dataset(qc_path)
+                qc = DatasetQC(nc, qc_file, fname_base + '.ncml', config)
+            for varname in sorted(qc.find_geophysical_variables()):
+                ncvar = nc.variables[varname]
+                if len(ncvar.dimensions) != 1:
+                    get_logger().warning("Multi-dimensional variable %s is "
+                                         "not exported", varname)
+                    continue
+                records = export_variable(qc, ncvar, writer, chunk_size)
+                get_logger().info("Exported %s records of %s from %s",
+                                  records, varname, nc_path)
+        except Exception:
+            writer.close()
+            remove_parts(dest, writer.paths)
+            manifest.pop(key, None)
+            raise
+        finally:
+            if qc_file is not None:
+                qc_file.close()
+    writer.close()
+    manifest[key] = {'signature': signature, 'parts': writer.paths}
+    return True
+
+
+def remove_parts(dest, parts):
+    '''
+    Removes part files of a dataset, relative to its root
+    '''
+    for part in parts:
+        path = os.path.join(dest, part)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def export(config, nc_paths, dest, fmt='parquet', qc_extension='ncq',
+           chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Exports netCDF files and their flags to the dataset at `dest`, adding
+    the files not yet exported and replacing those that changed.  Returns
+    the list of paths exported.
+
+    :param config: str, pandas.DataFrame or CompiledConfig
+    :param list nc_paths: Paths to the netCDF files
+    :param str dest: Root directory of the dataset
+    :param str fmt: 'parquet' or 'arrow'
+    :param str qc_extension: Extension of the QC files
+    :param int chunk_size: Records read at a time
+    '''
+    from glos_qartod.config import compile_config
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format {}".format(fmt))
+    config = compile_config(config)
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    manifest = load_manifest(dest)
+    exported = []
+    try:
+        for nc_path in nc_paths:
+            try:
+                if export_file(config, nc_path, dest, fmt, qc_extension,
+                               chunk_size, manifest):
+                    exported.append(nc_path)
+            except Exception:
+                get_logger().exception("Failed to export %s", nc_path)
+    finally:
+        save_manifest(dest, manifest)
+    return exported
+
+
+def main():
+    '''
+    Export observations and their QC flags to a Parquet or Arrow dataset
+    partitioned by station, variable and month
+    '''
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-c', '--config', required=True,
+                        help='Path to config file to use')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Turn on logging')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Root directory of the dataset')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='parquet',
+                        help='Format of the part files')
+    parser.add_argument('-e', '--extension', default='ncq',
+                        help='Extension of the QC files')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Records read and written at a time')
+    parser.add_argument('netcdf_files', nargs='+',
+                        help='NetCDF files to export')
+    args = parser.parse_args()
+    if args.verbose:
+        from glos_qartod.cli import setup_logging
+        setup_logging()
+    from glos_qartod.config import load_compiled_config
+    export(load_compiled_config(args.config), args.netcdf_files, args.output,
+           args.format, args.extension, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+'''
+glos_qartod/inotify.py
+
+A minimal ctypes binding of the Linux inotify API, enough to watch
+directories for files being written, moved in and created.
+'''
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event without its variable length name
+_EVENT = struct.Struct('iIII')
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    try:
+        libc.inotify_init1
+    except AttributeError:
+        raise OSError(errno.ENOSYS, "inotify is not available")
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify(object):
+    '''
+    An inotify instance.  Raises OSError where inotify isn't available.
+    '''
+
+    def __init__(self):
+        self.libc = _load_libc()
+        self.fd = _check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        '''
+        Watches `path` for the events in `mask` and returns the watch
+        descriptor.  Watching a path again returns the same descriptor.
+        '''
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        return _check(self.libc.inotify_add_watch(self.fd, path, mask))
+
+    def rm_watch(self, wd):
+        _check(self.libc.inotify_rm_watch(self.fd, wd))
+
+    def read_events(self, timeout=None):
+        '''
+        Waits up to `timeout` seconds for events and returns a list of
+        (wd, mask, cookie, name) tuples, with name decoded.  Returns an empty
+        list if there were none.
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, name.decode('utf-8',
+                                                         'replace')))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+'''
+glos_qartod/inplace.py
+
+In-place flag storage.  Rather than writing the flags to a .ncq file and
+linking them to their variables through a .ncml union aggregation, the flag
+variables are written into the source netCDF file and listed in the
+`ancillary_variables` attribute of the variables they flag.  A file is then
+one file on disk and readers open it directly, without an aggregation.
+
+The migration folds the .ncq and .ncml of files QC'd before into them.
+'''
+from argparse import ArgumentParser
+from glos_qartod import get_logger
+from glos_qartod.qc import DatasetQC, ns
+import os
+import six
+
+
+# Prefix of the names of the flag variables
+FLAG_PREFIX = 'qartod_'
+
+# Records copied at a time by the migration
+DEFAULT_CHUNK_SIZE = 100000
+
+
+class InPlaceDatasetQC(DatasetQC):
+    '''
+    DatasetQC writing the flag variables into the dataset itself.  The
+    ancillary variables of each variable are read from and written to its
+    `ancillary_variables` attribute rather than an NcML aggregation, so
+    there's no `ncml` and `ncml_write_flag` is never set.  The dataset must
+    be open for writing.
+    '''
+
+    def __init__(self, ncfile, config, series=None, neighbors=None,
+                 summary=None):
+        '''
+        :param netCDF4.Dataset ncfile: The dataset, opened in 'a' mode
+        :param config: str, pandas.DataFrame or CompiledConfig
+        :param series: glos_qartod.series.StationSeries the file belongs to
+        :param neighbors: glos_qartod.neighbors.NeighborIndex of the run
+        :param summary: glos_qartod.summary.FlagSummary to record the flag
+                        counts in
+        '''
+        super(InPlaceDatasetQC, self).__init__(ncfile, ncfile, None, config,
+                                               series, neighbors, summary)
+
+    def index_ncml(self):
+        '''
+        Records the parents of the flag variables listed in the
+        ancillary_variables attributes of the dataset
+        '''
+        for name, ncvar in six.iteritems(self.ncfile.variables):
+            for child in getattr(ncvar, 'ancillary_variables', '').split():
+                if child.startswith(FLAG_PREFIX):
+                    self.index.add_qc_variable(child, name)
+
+    def find_ancillary_variables(self, ncvariable):
+        '''
+        Returns the flag variables listed in the ancillary_variables
+        attribute of a variable.  Other ancillary variables of the source
+        file, such as GliderDAC _qc variables, are left out.
+
+        :param netCDF4.Variable ncvariable: Variable to get the ancillary
+                                            variables for
+        '''
+        return [varname for varname in
+                getattr(ncvariable, 'ancillary_variables', '').split()
+                if varname.startswith(FLAG_PREFIX) and
+                varname in self.ncfile.variables]
+
+    def append_ancillary_variable(self, parent, child):
+        '''
+        Adds a flag variable to the ancillary_variables attribute of the
+        variable it flags, keeping the names already listed
+
+        :param netCDF.Variable parent: Parent Variable
+        :param netCDF.Variable child: Status Flag Variable
+        '''
+        self.index.add_qc_variable(child.name, parent.name)
+        anc_vars = getattr(parent, 'ancillary_variables', '').split()
+        if child.name not in anc_vars:
+            anc_vars.append(child.name)
+            parent.setncattr('ancillary_variables', ' '.join(anc_vars))
+
+
+def run_qc_inplace(config, ncfile, series=None, neighbors=None,
+                   journal=None, summary=None):
+    '''
+    Runs QC on a netCDF file, writing the flags into the file itself
+
+    :param config: str or pandas.DataFrame
+    :param ncfile: netCDF4.Dataset opened in 'a' mode
+    :param series: glos_qartod.series.StationSeries the file belongs to
+    :param neighbors: glos_qartod.neighbors.NeighborIndex of the run
+    :param journal: glos_qartod.journal.RunJournal to record the completed
+                    tests in
+    :param summary: glos_qartod.summary.FlagSummary to record the flag
+                    counts in
+    '''
+    from glos_qartod.cli import apply_dataset_qc
+    qc = InPlaceDatasetQC(ncfile, config, series, neighbors, summary)
+    apply_dataset_qc(qc, journal)
+    if summary is not None:
+        summary.commit()
+
+
+def has_inplace_flags(ncfile):
+    '''
+    Returns True if any variable of a dataset lists flag variables stored
+    in the dataset among its ancillary variables
+
+    :param netCDF4.Dataset ncfile: The dataset
+    '''
+    for ncvar in ncfile.variables.values():
+        for child in getattr(ncvar, 'ancillary_variables', '').split():
+            if child.startswith(FLAG_PREFIX) and child in ncfile.variables:
+                return True
+    return False
+
+
+def ncml_ancillary_variables(ncml_filename):
+    '''
+    Returns a dict of the name of each variable of an NcML aggregation to
+    the list of names in its ancillary_variables attribute
+
+    :param str ncml_filename: Path to the NcML file
+    '''
+    from lxml import etree
+    with open(ncml_filename, 'rb') as ncml_contents:
+        ncml = etree.fromstring(ncml_contents.read())
+    links = {}
+    for path in ('.//ncml:variable', './/variable'):
+        for var_elem in ncml.findall(path, namespaces=ns):
+            for attr_elem in var_elem:
+                if (not isinstance(attr_elem.tag, six.string_types) or
+                        attr_elem.get('name') != 'ancillary_variables'):
+                    continue
+                links.setdefault(var_elem.get('name'), []).extend(
+                    attr_elem.get('value', '').split())
+    return links
+
+
+def migrate_file(nc_path, qc_extension='ncq', remove=True,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Folds the QC file and NcML aggregation of a netCDF file into it: every
+    variable of the QC file is defined in the netCDF file with the same
+    attributes, the ancillary_variables of the NcML are added to the
+    variables' attributes, and then the flags are copied in chunks of
+    records.  The variables are all defined before any data is copied, so
+    a classic format file is only reorganised once.  Once the netCDF file
+    is closed the QC file and NcML are removed, unless `remove` is False.
+    Returns False if the file has no QC file.
+
+    Flag variables already in the file, from an interrupted migration, are
+    overwritten.
+
+    :param str nc_path: Path to the netCDF file
+    :param str qc_extension: Extension of the QC file
+    :param bool remove: Remove the QC file and NcML once migrated
+    :param int chunk_size: Records copied at a time
+    '''
+    from netCDF4 import Dataset
+    fname_base = nc_path.rsplit('.', 1)[0]
+    qc_filename = "{}.{}".format(fname_base, qc_extension)
+    ncml_filename = fname_base + '.ncml'
+    if not os.path.exists(qc_filename):
+        get_logger().warning("%s has no QC file, skipping", nc_path)
+        return False
+    links = {}
+    if os.path.exists(ncml_filename):
+        links = ncml_ancillary_variables(ncml_filename)
+    else:
+        get_logger().warning("%s has no NcML, its flags won't be listed as "
+                             "ancillary variables", nc_path)
+
+    with Dataset(qc_filename, 'r') as qc_file, \
+            Dataset(nc_path, 'a') as ncfile:
+        for name, qcvar in six.iteritems(qc_file.variables):
+            missing = [dim for dim in qcvar.dimensions
+                       if dim not in ncfile.dimensions]
+            if missing:
+                raise ValueError("{} has no dimensions {} of {}".format(
+                    nc_path, ', '.join(missing), name))
+        for name, qcvar in six.iteritems(qc_file.variables):
+            attrs = dict((attr, qcvar.getncattr(attr))
+                         for attr in qcvar.ncattrs() if attr != '_FillValue')
+            if name in ncfile.variables:
+                ncvar = ncfile.variables[name]
+            else:
+                ncvar = ncfile.createVariable(
+                    name, qcvar.dtype, qcvar.dimensions,
+                    fill_value=getattr(qcvar, '_FillValue', None))
+            if attrs:
+                ncvar.setncatts(attrs)
+        for parent, children in six.iteritems(links):
+            if parent not in ncfile.variables:
+                continue
+            ncvar = ncfile.variables[parent]
+            anc_vars = getattr(ncvar, 'ancillary_variables', '').split()
+            added = [child for child in children
+                     if child in qc_file.variables and child not in anc_vars]
+            if added:
+                ncvar.setncattr('ancillary_variables',
+                                ' '.join(anc_vars + added))
+
+        for name, qcvar in six.iteritems(qc_file.variables):
+            ncvar = ncfile.variables[name]
+            # raw values, so masked flags stay fill values
+            qcvar.set_auto_maskandscale(False)
+            ncvar.set_auto_maskandscale(False)
+            if not qcvar.dimensions:
+                ncvar.assignValue(qcvar.getValue())
+                continue
+            size = qcvar.shape[0]
+            for start in range(0, size, chunk_size):
+                stop = min(start + chunk_size, size)
+                ncvar[start:stop] = qcvar[start:stop]
+    get_logger().info("Migrated %s into %s", qc_filename, nc_path)
+
+    if remove:
+        os.remove(qc_filename)
+        if os.path.exists(ncml_filename):
+            os.remove(ncml_filename)
+    return True
+
+
+def migrate(nc_paths, qc_extension='ncq', remove=True,
+            chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Migrates the QC files and NcML aggregations of netCDF files into them.
+    Returns the list of paths migrated; files that fail are logged and
+    keep their QC file and NcML.
+
+    :param list nc_paths: Paths to the netCDF files
+    :param str qc_extension: Extension of the QC files
+    :param bool remove: Remove the QC files and NcML once migrated
+    :param int chunk_size: Records copied at a time
+    '''
+    migrated = []
+    for nc_path in nc_paths:
+        try:
+            if migrate_file(nc_path, qc_extension, remove, chunk_size):
+                migrated.append(nc_path)
+        except Exception:
+            get_logger().exception("Failed to migrate %s", nc_path)
+    return migrated
+
+
+def main():
+    '''
+    Fold the .ncq QC files and .ncml aggregations of netCDF files into the
+    files, so their flags are stored in place
+    '''
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Turn on logging')
+    parser.add_argument('-e', '--extension', default='ncq',
+                        help='Extension of the QC files')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='Keep the QC files and NcML after migrating')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Records copied at a time')
+    parser.add_argument('netcdf_files', nargs='+',
+                        help='NetCDF files to migrate')
+    args = parser.parse_args()
+    if args.verbose:
+        from glos_qartod.cli import setup_logging
+        setup_logging()
+    migrate(args.netcdf_files, args.extension, not args.keep,
+            args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+'''
+glos_qartod/journal.py
+
+An append-only JSON lines journal of the files a batch run has QC'd.  Each
+file gets a start record when its QC begins, a unit record with the timing
+of each (variable, test) completed, and a done record with the size and
+modification time of the file when its QC finished.  A restarted run reads
+the journal and skips the files which are done and unchanged since, using
+only os.stat.  A file with a start record and no later done record was
+interrupted and is QC'd again.
+'''
+import hashlib
+import json
+import os
+import six
+import time
+from glos_qartod import get_logger
+
+
+def config_key(config):
+    '''
+    Returns a digest of the contents of a config file, so that files QC'd
+    with a different configuration aren't treated as done.  Returns None if
+    `config` isn't a path.
+
+    :param config: Path to the config file, or a DataFrame or CompiledConfig
+    '''
+    if not isinstance(config, six.string_types):
+        return None
+    with open(config, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def file_signature(path):
+    '''
+    Returns the modification time and size of a file as a list, as they are
+    stored in the journal
+    '''
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size]
+
+
+class RunJournal(object):
+    '''
+    Journal of the files QC'd by batch runs.  Records are appended with a
+    single write to a file opened in append mode, so several processes on
+    one host can share a journal.
+    '''
+
+    def __init__(self, path, key=None, load=True):
+        '''
+        :param str path: Path to the journal, created if it doesn't exist
+        :param str key: Config key of the run, see config_key
+        :param bool load: Read the records already in the journal
+        '''
+        self.path = path
+        self.key = key
+        # path to the signature of the file when its QC last finished
+        self.completed = {}
+        # paths of files started and not finished
+        self.started = set()
+        # bytes of the journal read so far
+        self.offset = 0
+        if load:
+            self.load()
+
+    def load(self):
+        '''
+        Reads the records appended to the journal since it was last read,
+        e.g. by other processes sharing it
+        '''
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                # a line still being written is read once it is complete
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # a run killed mid write leaves a partial last line
+                    get_logger().warning("Skipping malformed journal record "
+                                         "in %s", self.path)
+                    continue
+                self.apply(record)
+
+    def apply(self, record):
+        '''
+        Updates the state of the journal with a record
+        '''
+        path = record.get('file')
+        event = record.get('event')
+        if event == 'start':
+            self.started.add(path)
+            self.completed.pop(path, None)
+        elif event == 'done':
+            self.started.discard(path)
+            if record.get('key') == self.key:
+                self.completed[path] = record.get('signature')
+            else:
+                self.completed.pop(path, None)
+
+    def append(self, record):
+        '''
+        Appends a record to the journal
+        '''
+        record['time'] = time.time()
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with open(self.path, 'ab+') as f:
+            # end a partial line left by a run killed mid write, rather than
+            # running this record into it
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    line = b'\n' + line
+            f.write(line)
+        self.apply(record)
+
+    def is_complete(self, path):
+        '''
+        Returns True if the file's QC finished with the run's configuration
+        and the file hasn't changed since
+        '''
+        path = os.path.abspath(path)
+        signature = self.completed.get(path)
+        if signature is None:
+            return False
+        try:
+            return file_signature(path) == signature
+        except OSError:
+            return False
+
+    def is_interrupted(self, path):
+        '''
+        Returns True if the file's QC was started and didn't finish
+        '''
+        return os.path.abspath(path) in self.started
+
+    def start(self, path):
+        '''
+        Records that QC of a file started
+        '''
+        self.append({'event': 'start', 'file': os.path.abspath(path),
+                     'key': self.key})
+
+    def unit(self, path, variable, test, seconds):
+        '''
+        Records that a test of a variable of a file completed
+
+        :param str path: Path to the netCDF file
+        :param str variable: Name of the variable tested
+        :param str test: Name of the test, or primary for the primary flag
+        :param float seconds: Time taken
+        '''
+        self.append({'event': 'unit', 'file': os.path.abspath(path),
+                     'variable': variable, 'test': test,
+                     'seconds': round(seconds, 6)})
+
+    def done(self, path, seconds):
+        '''
+        Records that QC of a file finished
+
+        :param str path: Path to the netCDF file
+        :param float seconds: Time taken
+        '''
+        self.append({'event': 'done', 'file': os.path.abspath(path),
+                     'key': self.key, 'signature': file_signature(path),
+                     'seconds': round(seconds, 6)})
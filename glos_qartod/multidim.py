@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+'''
+glos_qartod/multidim.py
+
+Batched QARTOD tests for variables with dimensions beyond time, such as
+thermistor strings (time, depth) or ADCP bins (time, bin).  Each column is
+tested along the time axis as its own series with missing values removed,
+the same way a 1-D variable is, but all columns are tested at once.  The
+valid values of each column are packed to the top of a (records, columns)
+array so that the window tests become shifted array operations.
+'''
+import numpy as np
+
+
+def pack_columns(values, valid):
+    '''
+    Returns a tuple of the valid values of each column packed to the top of
+    a NaN padded array, the row and column in the packed array of each
+    valid entry in row-major order, and the number of valid values in each
+    column.
+
+    :param numpy.ndarray values: 2-D array of (time, column) values
+    :param numpy.ndarray valid: Boolean array, True for valid entries
+    '''
+    counts = valid.sum(axis=0)
+    rows = (np.cumsum(valid, axis=0) - 1)[valid]
+    cols = np.nonzero(valid)[1]
+    packed = np.full((counts.max() if counts.size else 0, values.shape[1]),
+                     np.nan)
+    packed[rows, cols] = values[valid]
+    return packed, (rows, cols), counts
+
+
+def gross_range(packed, sensor_span, user_span=None):
+    '''
+    Gross range test of packed columns, as ioos_qartod's range_check
+    '''
+    if len(sensor_span) != 2:
+        raise ValueError("Sensor range extent must be size two.")
+    sensor_min, sensor_max = sorted(sensor_span)
+    flags = np.ones(packed.shape, dtype=np.int8)
+    if user_span is not None:
+        if len(user_span) != 2:
+            raise ValueError("User defined range extent must be size two.")
+        user_min, user_max = sorted(user_span)
+        if user_min < sensor_min or user_max > sensor_max:
+            raise ValueError("User span range may not exceed sensor bounds.")
+        flags[(packed < user_min) | (packed > user_max)] = 3
+    flags[(packed < sensor_min) | (packed > sensor_max)] = 4
+    return flags
+
+
+def rate_of_change(packed, seconds, thresh_val):
+    '''
+    Rate of change test of packed columns, as ioos_qartod's
+    rate_of_change_check.  The first value of each column is NOT_EVALUATED.
+
+    :param numpy.ndarray packed: Packed values
+    :param numpy.ndarray seconds: Packed times of the values in seconds
+    :param float thresh_val: Threshold per hour
+    '''
+    flags = np.ones(packed.shape, dtype=np.int8)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.abs(np.diff(packed, axis=0) / np.diff(seconds, axis=0))
+    flags[1:][rate > thresh_val / 3600.] = 3
+    flags[:1] = 2
+    return flags
+
+
+def spike(packed, counts, low_thresh, high_thresh):
+    '''
+    Spike test of packed columns, as ioos_qartod's spike_check.  The first
+    and last values of each column can't be tested and are GOOD.
+    '''
+    if low_thresh >= high_thresh:
+        raise ValueError("Low theshold value must be less than high threshold "
+                         "value.")
+    difference = np.zeros(packed.shape)
+    difference[1:-1] = np.abs(packed[1:-1] -
+                              0.5 * (packed[:-2] + packed[2:]))
+    columns = np.flatnonzero(counts)
+    difference[counts[columns] - 1, columns] = 0
+    flags = np.ones(packed.shape, dtype=np.int8)
+    flags[difference >= low_thresh] = 3
+    flags[difference >= high_thresh] = 4
+    return flags
+
+
+def flat_line(packed, low_reps, high_reps, eps):
+    '''
+    Flat line test of packed columns, as ioos_qartod's flat_line_check.
+    Each lag up to high_reps is compared once for every column.
+    '''
+    if not eps:
+        raise ValueError("Must specify a tolerance value (`eps`).")
+    if low_reps >= high_reps:
+        raise ValueError("Low reps must be less than high reps.")
+
+    def repeated(first, last, within):
+        # marks the values within eps of each of the values `first` to
+        # `last` records before them
+        for lag in range(first, last + 1):
+            within[lag:] &= np.abs(packed[lag:] - packed[:-lag]) < eps
+            within[:lag] = False
+        return within
+
+    suspect = repeated(1, low_reps, np.ones(packed.shape, dtype=bool))
+    bad = repeated(low_reps + 1, high_reps, suspect.copy())
+    flags = np.ones(packed.shape, dtype=np.int8)
+    flags[suspect] = 3
+    flags[bad] = 4
+    return flags
+
+
+def column_flags(qartod_test, test_params, dates, values, valid):
+    '''
+    Runs a QARTOD test along the first axis of `values` for every column at
+    once and returns int8 flags of the same shape, MISSING (9) where values
+    aren't valid.  Each column is flagged as the 1-D test would flag the
+    series of its valid values.
+
+    :param str qartod_test: Name of the test
+    :param dict test_params: Parameters for the test from build_test_params
+    :param numpy.ndarray dates: datetime64 times along the first axis
+    :param numpy.ndarray values: Values of two or more dimensions
+    :param numpy.ndarray valid: Boolean array, True for valid values
+    '''
+    shape = values.shape
+    values = values.reshape(shape[0], -1)
+    valid = valid.reshape(shape[0], -1)
+    flags = np.full(values.shape, 9, dtype=np.int8)
+    if not valid.any():
+        return flags.reshape(shape)
+    if qartod_test == 'climatology':
+        # not a window test, so the columns don't need packing
+        depths = test_params.get('depths')
+        if depths is not None:
+            depths = np.broadcast_to(depths, shape[1:]).reshape(1, -1)
+        column = test_params['table'].flag(dates[:, None], values, depths)
+        flags[valid] = column[valid]
+        return flags.reshape(shape)
+    packed, index, counts = pack_columns(values, valid)
+    if qartod_test == 'gross_range':
+        packed_flags = gross_range(packed, **test_params)
+    elif qartod_test == 'rate_of_change':
+        seconds = (dates.astype('datetime64[ms]').astype(np.int64) /
+                   1000.)
+        seconds = np.broadcast_to(seconds[:, None], values.shape)
+        packed_seconds = pack_columns(seconds, valid)[0]
+        packed_flags = rate_of_change(packed, packed_seconds, **test_params)
+    elif qartod_test == 'spike':
+        packed_flags = spike(packed, counts, **test_params)
+    elif qartod_test == 'flat_line':
+        packed_flags = flat_line(packed, **test_params)
+    else:
+        raise ValueError("{} is not supported for multi-dimensional "
+                         "variables".format(qartod_test))
+    flags[valid] = packed_flags[index]
+    return flags.reshape(shape)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+'''
+glos_qartod/neighbors.py
+
+Neighbor test: compares a station's series with the time-aligned series of
+the same variable at the nearest stations of a run.  The stations are found
+through a KD-tree of the platform locations built once per run, and each
+station's series is read once per run however many stations it is a
+neighbor of.
+'''
+import numpy as np
+import numpy.ma as ma
+import warnings
+from collections import OrderedDict
+from glos_qartod import get_logger
+
+# Mean radius of the Earth in km
+EARTH_RADIUS = 6371.0088
+
+# Defaults for the optional neighbor.* parameters
+DEFAULT_K = 3
+DEFAULT_TIME_TOLERANCE = 3600.
+
+
+def station_location(ncfile):
+    '''
+    Returns the (latitude, longitude) of a station dataset from its scalar
+    latitude and longitude variables, or None if it has none
+
+    :param netCDF4.Dataset ncfile: The dataset
+    '''
+    location = []
+    for standard_name in ('latitude', 'longitude'):
+        for ncvar in ncfile.variables.values():
+            if getattr(ncvar, 'standard_name', None) == standard_name:
+                value = ma.compressed(ma.asarray(ncvar[...], dtype=np.float64))
+                if value.size:
+                    location.append(value[0])
+                    break
+        else:
+            return None
+    return tuple(location)
+
+
+def to_cartesian(latitude, longitude):
+    '''
+    Returns (n, 3) Earth-centred coordinates in km, so that distances in
+    the KD-tree are straight line distances, unaffected by longitude
+    wrapping or convergence
+    '''
+    lat = np.radians(np.asarray(latitude, dtype=np.float64))
+    lon = np.radians(np.asarray(longitude, dtype=np.float64))
+    return EARTH_RADIUS * np.column_stack([np.cos(lat) * np.cos(lon),
+                                           np.cos(lat) * np.sin(lon),
+                                           np.sin(lat)])
+
+
+def chord_length(distance):
+    '''
+    Returns the straight line distance between two points `distance` km
+    apart along the surface of the Earth
+    '''
+    return 2 * EARTH_RADIUS * np.sin(min(distance / (2 * EARTH_RADIUS),
+                                         np.pi / 2))
+
+
+def align(times, ref_times, ref_values, tolerance):
+    '''
+    Returns the values of a reference series at the nearest reference time
+    to each of `times`, NaN where none is within `tolerance`.  Both series
+    must be sorted by time.
+
+    :param numpy.ndarray times: int64 times to align to
+    :param numpy.ndarray ref_times: Sorted int64 times of the reference
+    :param numpy.ndarray ref_values: Values of the reference
+    :param tolerance: Largest time difference to accept, in the units of
+                      the times
+    '''
+    aligned = np.full(times.shape, np.nan)
+    if ref_times.size == 0 or times.size == 0:
+        return aligned
+    after = np.clip(np.searchsorted(ref_times, times), 1, ref_times.size - 1)
+    before = after - 1
+    if ref_times.size == 1:
+        after = before = np.zeros_like(after)
+    nearest = np.where(np.abs(ref_times[after] - times) <
+                       np.abs(times - ref_times[before]), after, before)
+    within = np.abs(ref_times[nearest] - times) <= tolerance
+    aligned[within] = ref_values[nearest[within]]
+    return aligned
+
+
+def neighbor_check(arr, neighbor_values, suspect_threshold,
+                   fail_threshold=None):
+    '''
+    Returns flags for `arr` from its difference to the median of the
+    neighbors' values at the same times: SUSPECT beyond
+    `suspect_threshold`, BAD beyond `fail_threshold` and NOT_EVALUATED where
+    no neighbor has a value.
+
+    :param numpy.ndarray arr: Values to test
+    :param numpy.ndarray neighbor_values: (neighbors, len(arr)) array of
+                                          aligned values, NaN where missing
+    :param float suspect_threshold: Largest difference that is GOOD
+    :param float fail_threshold: Largest difference that is SUSPECT
+    '''
+    flags = np.full(arr.shape, 2, dtype=np.int8)
+    if len(neighbor_values) == 0:
+        return flags
+    with warnings.catch_warnings():
+        # all NaN columns, where no neighbor has a value, are expected
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(neighbor_values, axis=0)
+    evaluated = ~np.isnan(median)
+    difference = np.abs(arr - median)
+    flags[evaluated] = 1
+    flags[evaluated & (difference > suspect_threshold)] = 3
+    if fail_threshold is not None:
+        flags[evaluated & (difference > fail_threshold)] = 4
+    return flags
+
+
+class NeighborIndex(object):
+    '''
+    Locations and series of the stations of a run.  The KD-tree of station
+    locations is built once and each station's series of a variable is
+    cached after it is first read.
+    '''
+
+    def __init__(self, paths):
+        '''
+        :param list paths: Paths of the netCDF files of the run
+        '''
+        from netCDF4 import Dataset
+        from scipy.spatial import cKDTree
+        from glos_qartod.qc import find_station_name
+        self.paths = OrderedDict()
+        locations = OrderedDict()
+        for path in paths:
+            with Dataset(path, 'r') as nc:
+                try:
+                    station_id = find_station_name(nc).split(':')[-1]
+                except (AttributeError, ValueError):
+                    get_logger().warn("No station found for %s, not using "
+                                      "it as a neighbor", path)
+                    continue
+                location = station_location(nc)
+            if location is None:
+                get_logger().warn("No location found for %s, not using it "
+                                  "as a neighbor", path)
+                continue
+            self.paths.setdefault(station_id, []).append(path)
+            locations.setdefault(station_id, location)
+        self.station_ids = list(locations)
+        self.positions = dict((station_id, i) for i, station_id in
+                              enumerate(self.station_ids))
+        self.points = to_cartesian([l[0] for l in locations.values()],
+                                   [l[1] for l in locations.values()])
+        self.tree = cKDTree(self.points) if self.station_ids else None
+        self._series = {}
+
+    def nearest(self, station_id, k, max_distance=None):
+        '''
+        Returns the identifiers of up to `k` stations nearest `station_id`,
+        nearest first, excluding the station itself
+
+        :param str station_id: Station identifier
+        :param int k: Number of neighbors
+        :param float max_distance: Largest distance to a neighbor in km
+        '''
+        if station_id not in self.positions or len(self.station_ids) < 2:
+            return []
+        upper = np.inf if max_distance is None else chord_length(max_distance)
+        count = min(k + 1, len(self.station_ids))
+        distances, indices = self.tree.query(
+            self.points[self.positions[station_id]], k=count,
+            distance_upper_bound=upper)
+        indices = np.atleast_1d(indices)[np.isfinite(np.atleast_1d(distances))]
+        return [self.station_ids[i] for i in indices
+                if self.station_ids[i] != station_id][:k]
+
+    def read_series(self, station_id, variable, units):
+        '''
+        Returns a tuple of the sorted int64 times in milliseconds since
+        1970-01-01 and float64 values in `units` of a station's variable
+        over all of the station's files.  Cached for the run.
+
+        :param str station_id: Station identifier
+        :param str variable: Name of the variable
+        :param str units: Units to convert the values to
+        '''
+        key = (station_id, variable, units)
+        if key not in self._series:
+            self._series[key] = self._read_series(station_id, variable,
+                                                  units)
+        return self._series[key]
+
+    def _read_series(self, station_id, variable, units):
+        from netCDF4 import Dataset, num2date
+        from glos_qartod.qc import (apply_scaling, convert_units,
+                                    invalid_mask, open_raw)
+        times, values = [], []
+        for path in self.paths.get(station_id, []):
+            with Dataset(path, 'r') as nc:
+                ncvar = nc.variables.get(variable)
+                time_var = nc.variables.get('time')
+                if (ncvar is None or time_var is None or
+                        ncvar.dimensions != time_var.dimensions):
+                    continue
+                with open_raw(nc) as read:
+                    raw_times = read(time_var)
+                    raw_values = read(ncvar)
+                    valid = ~(invalid_mask(raw_times, time_var) |
+                              invalid_mask(raw_values, ncvar))
+                    t = np.asarray(raw_times[valid], dtype=np.float64)
+                    v = np.asarray(raw_values[valid], dtype=np.float64)
+                apply_scaling(t, time_var)
+                apply_scaling(v, ncvar)
+                v = convert_units(v, getattr(ncvar, 'units', '1'), units,
+                                  inplace=True)
+                if t.size:
+                    t = np.array(num2date(t, time_var.units),
+                                 dtype='datetime64[ms]').astype(np.int64)
+                times.append(t.astype(np.int64))
+                values.append(v)
+        if not times:
+            return np.array([], dtype=np.int64), np.array([])
+        times = np.concatenate(times)
+        values = np.concatenate(values)
+        order = np.argsort(times, kind='mergesort')
+        return times[order], values[order]
+
+    def aligned(self, station_id, variable, units, dates, k,
+                max_distance=None, time_tolerance=DEFAULT_TIME_TOLERANCE):
+        '''
+        Returns a (neighbors, len(dates)) array of the values of `variable`
+        at the `k` nearest stations aligned to `dates`, NaN where a neighbor
+        has no record within `time_tolerance` seconds
+
+        :param str station_id: Station being QC'd
+        :param str variable: Name of the variable
+        :param str units: Units to compare the values in
+        :param numpy.ndarray dates: datetime64 times to align to
+        :param int k: Number of neighbors
+        :param float max_distance: Largest distance to a neighbor in km
+        :param float time_tolerance: Largest time difference in seconds
+        '''
+        times = np.asarray(dates, dtype='datetime64[ms]').astype(np.int64)
+        rows = []
+        for neighbor in self.nearest(station_id, k, max_distance):
+            ref_times, ref_values = self.read_series(neighbor, variable,
+                                                     units)
+            if ref_times.size == 0:
+                continue
+            rows.append(align(times, ref_times, ref_values,
+                              time_tolerance * 1000.))
+        if not rows:
+            return np.empty((0, times.size))
+        return np.vstack(rows)
+
+
+def get_neighbor_config(config):
+    '''
+    Returns a dictionary of neighbor test parameters for a config row, empty
+    if the test isn't configured
+
+    :param config: A row from the pandas dataframe representing the
+                   configuration
+    '''
+    import pandas as pd
+
+    def param(name):
+        key = 'neighbor.{}'.format(name)
+        if key in config and not pd.isnull(config[key]):
+            return config[key]
+        return None
+
+    suspect_threshold = param('suspect_threshold')
+    if suspect_threshold is None:
+        return {}
+    params = {
+        'suspect_threshold': suspect_threshold,
+        'k': int(param('k') or DEFAULT_K),
+        'time_tolerance': param('time_tolerance') or DEFAULT_TIME_TOLERANCE
+    }
+    if param('fail_threshold') is not None:
+        params['fail_threshold'] = param('fail_threshold')
+    if param('max_distance') is not None:
+        params['max_distance'] = param('max_distance')
+    return params
+
+
+def needs_neighbors(compiled):
+    '''
+    Returns True if the neighbor test is configured for any variable
+
+    :param glos_qartod.config.CompiledConfig compiled: Compiled configuration
+    '''
+    column = 'neighbor.suspect_threshold'
+    return (column in compiled.frame.columns and
+            compiled.frame[column].notnull().any())
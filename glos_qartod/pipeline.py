@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+'''
+glos_qartod/pipeline.py
+
+Pipelined QC of a batch of files.  Three stages run concurrently, connected
+by bounded queues: a reader opens each file, defines its QC variables and
+reads the inputs of every test, a compute stage runs the tests, and a single
+writer writes the flags, primary flags and NcML.  While one file's tests run,
+the next file is read and the previous one written.
+
+The netCDF-C and HDF5 libraries aren't thread safe, so the reader and writer
+take turns with them under NETCDF_LOCK.  The compute stage only works on
+arrays and never calls into them, so it overlaps with both.
+'''
+import threading
+import time
+from six.moves import queue
+from glos_qartod import get_logger
+
+
+# Number of files each stage may run ahead of the next
+DEFAULT_QUEUE_SIZE = 2
+
+# Held around every call into the netCDF libraries from a pipeline stage
+NETCDF_LOCK = threading.Lock()
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class FileJob(object):
+    '''
+    A file passing through the pipeline: its open dataset and QC file, the
+    DatasetQC, the variables QC'd and the tasks of their tests.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.nc = None
+        self.qc_file = None
+        self.qc = None
+        self.ncml_filename = None
+        self.varnames = []
+        self.tasks = []
+        # compute time of each task, and when the file was started
+        self.seconds = []
+        self.started = time.time()
+
+    def close(self):
+        '''
+        Closes the QC file and dataset, logging rather than raising errors
+        '''
+        for ncfile in (self.qc_file, self.nc):
+            if ncfile is None:
+                continue
+            try:
+                ncfile.close()
+            except Exception:
+                get_logger().exception("Failed to close %s", self.path)
+        self.qc_file = self.nc = None
+
+
+def read_file(config, path, qc_extension='ncq', neighbors=None,
+              summary=None):
+    '''
+    Read stage: opens a file and its QC file, defines the QC variables and
+    reads the inputs of every test that needs to run.  Returns a FileJob.
+
+    :param glos_qartod.config.CompiledConfig config: Compiled configuration
+    :param str path: Path to the netCDF file
+    :param str qc_extension: Extension of the QC file
+    :param neighbors: glos_qartod.neighbors.NeighborIndex of the run
+    :param summary: glos_qartod.summary.FlagSummary to record the flag
+                    counts in
+    '''
+    from netCDF4 import Dataset
+    from glos_qartod.cli import create_or_open_qc_file
+    from glos_qartod.qc import DatasetQC
+    job = FileJob(path)
+    try:
+        job.nc = Dataset(path, 'r')
+        fname_base = path.rsplit('.', 1)[0]
+        job.qc_file = create_or_open_qc_file(
+            "{}.{}".format(fname_base, qc_extension), job.nc.dimensions)
+        job.ncml_filename = fname_base + '.ncml'
+        job.qc = DatasetQC(job.nc, job.qc_file, job.ncml_filename, config,
+                           neighbors=neighbors, summary=summary)
+        # as in cli.apply_dataset_qc, files without records aren't QC'd
+        if job.nc.variables['time'].size == 0:
+            return job
+        # tasks of the same variable share one copy of its arrays
+        memo = {}
+        varnames = list(job.qc.find_geophysical_variables())
+        qcvarnames = job.qc.define_qc_variables(
+            [job.nc.variables[varname] for varname in varnames])
+        for varname in varnames:
+            get_logger().info("Reading %s from %s", varname, path)
+            for qcvarname in qcvarnames[varname]:
+                task = job.qc.prepare_qc(job.qc_file.variables[qcvarname])
+                if task is not None:
+                    task.copy(memo)
+                    job.tasks.append(task)
+            job.varnames.append(varname)
+    except Exception:
+        job.close()
+        raise
+    return job
+
+
+def compute_file(job):
+    '''
+    Compute stage: runs the tests of a FileJob
+    '''
+    for task in job.tasks:
+        started = time.time()
+        job.qc.compute_qc(task)
+        job.seconds.append(time.time() - started)
+
+
+def write_file(job, journal=None):
+    '''
+    Write stage: writes the flags of a FileJob, applies the primary QC and
+    writes the NcML if it changed
+
+    :param journal: glos_qartod.journal.RunJournal to record the completed
+                    tests and file in
+    '''
+    from lxml import etree
+    for task in job.tasks:
+        job.qc.write_qc(task)
+    for varname in job.varnames:
+        job.qc.apply_primary_qc(job.nc.variables[varname])
+    if job.qc.ncml_write_flag:
+        with open(job.ncml_filename, 'wb') as ncml_file:
+            ncml_file.write(etree.tostring(job.qc.ncml))
+    if job.qc.summary is not None:
+        job.qc.summary.commit()
+    if journal is not None:
+        for task, seconds in zip(job.tasks, job.seconds):
+            journal.unit(job.path,
+                         job.qc.index.qc_parents[task.ncvariable.name],
+                         task.qartod_test, seconds)
+        journal.done(job.path, time.time() - job.started)
+
+
+def run_pipeline(config, nc_paths, qc_extension='ncq', neighbors=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, journal=None, summary=None):
+    '''
+    Runs QC on a list of files, overlapping reading the next file and
+    writing the previous one with running the tests of the current one.  The
+    flags are the same as running glos_qartod.cli.run_qc on each file.
+    Returns the list of paths QC'd; files that fail are logged and skipped.
+
+    :param config: str, pandas.DataFrame or CompiledConfig
+    :param list nc_paths: Paths to the netCDF files
+    :param str qc_extension: Extension of the QC files
+    :param neighbors: glos_qartod.neighbors.NeighborIndex of the run
+    :param int queue_size: Number of files each stage may run ahead of the
+                           next
+    :param journal: glos_qartod.journal.RunJournal of the run.  Files it
+                    records as done are skipped without being opened.
+    :param summary: glos_qartod.summary.FlagSummary to record the flag
+                    counts in
+    '''
+    from glos_qartod.config import compile_config
+    config = compile_config(config)
+    read_queue = queue.Queue(queue_size)
+    write_queue = queue.Queue(queue_size)
+
+    def discard(job):
+        with NETCDF_LOCK:
+            job.close()
+
+    def reader():
+        try:
+            for path in nc_paths:
+                if journal is not None:
+                    if journal.is_complete(path):
+                        get_logger().info("%s is already QC'd, skipping",
+                                          path)
+                        continue
+                    journal.start(path)
+                try:
+                    with NETCDF_LOCK:
+                        job = read_file(config, path, qc_extension,
+                                        neighbors, summary)
+                except Exception:
+                    get_logger().exception("Failed to read %s", path)
+                    continue
+                read_queue.put(job)
+        finally:
+            read_queue.put(_DONE)
+
+    def computer():
+        try:
+            while True:
+                job = read_queue.get()
+                if job is _DONE:
+                    break
+                try:
+                    compute_file(job)
+                except Exception:
+                    get_logger().exception("Failed to QC %s", job.path)
+                    discard(job)
+                    continue
+                write_queue.put(job)
+        finally:
+            write_queue.put(_DONE)
+
+    threads = [threading.Thread(target=reader, name='qc-reader'),
+               threading.Thread(target=computer, name='qc-compute')]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # the calling thread is the single writer
+    written = []
+    while True:
+        job = write_queue.get()
+        if job is _DONE:
+            break
+        try:
+            with NETCDF_LOCK:
+                write_file(job, journal)
+            written.append(job.path)
+        except Exception:
+            get_logger().exception("Failed to write QC for %s", job.path)
+        finally:
+            discard(job)
+    for thread in threads:
+        thread.join()
+    return written
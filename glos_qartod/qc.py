@@ -2,20 +2,151 @@
 '''
 glider_qc/glider_qc.py
 '''
+import hashlib
 import numpy as np
 import numpy.ma as ma
-import quantities as pq
-import pandas as pd
-from lxml import etree
-from cf_units import Unit
-from netCDF4 import num2date
-from ioos_qartod.qc_tests import qc
-from ioos_qartod.qc_tests import gliders as gliders_qc
+import six
 from glos_qartod import get_logger
+from glos_qartod.config import CompiledConfig, compile_config
+from glos_qartod.series import WINDOW_TESTS, context_size
+from collections import OrderedDict
+from contextlib import contextmanager
 from os.path import basename
 
+# pandas, lxml, cf_units, netCDF4, quantities and ioos_qartod are imported on
+# the code paths that use them; see glos_qartod.cli for the rationale.
+
 ns = {'ncml': "http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2"}
 
+
+def find_station_name(ncfile):
+    '''
+    Returns the station identifier of a netCDF dataset using the ioos_code
+    attribute of its platform variable
+
+    :param netCDF4.Dataset ncfile: The dataset
+    '''
+    platform_name = ncfile.platform
+    if platform_name not in ncfile.variables:
+        raise ValueError("Platform defined as {} but no variable matches this name".format(platform_name))
+    station_id = ncfile.variables[platform_name].ioos_code
+    return station_id
+
+
+class DatasetIndex(object):
+    '''
+    Metadata of a netCDF dataset looked up once so that later lookups are
+    dict accesses: the station identifier, the time variable and its units,
+    the variables with each standard_name and the parent variable of each QC
+    variable.
+    '''
+
+    def __init__(self, ncfile):
+        self.ncfile = ncfile
+        self.variables_by_standard_name = {}
+        for name, ncvar in six.iteritems(ncfile.variables):
+            standard_name = getattr(ncvar, 'standard_name', None)
+            if standard_name is not None:
+                self.variables_by_standard_name.setdefault(
+                    standard_name, []).append(name)
+        self.time = ncfile.variables.get('time')
+        self.time_units = getattr(self.time, 'units', None)
+        # the error is kept and raised when the station is asked for, so
+        # datasets without a platform can still be indexed
+        try:
+            self.station_name = find_station_name(ncfile)
+            self.station_error = None
+        except (AttributeError, ValueError) as e:
+            self.station_name = None
+            self.station_error = e
+        self.station_id = (self.station_name.split(':')[-1]
+                           if self.station_name else None)
+        # QC variable name to the name of the variable it flags
+        self.qc_parents = {}
+
+    def get_station_name(self):
+        '''
+        Returns the ioos_code of the dataset's platform
+        '''
+        if self.station_error is not None:
+            raise self.station_error
+        return self.station_name
+
+    def add_qc_variable(self, qcvarname, parent_name):
+        '''
+        Records the variable a QC variable flags
+        '''
+        self.qc_parents[qcvarname] = parent_name
+
+    def find_parent(self, qcvariable):
+        '''
+        Returns the variable a QC variable flags.  QC variables created or
+        listed in the NcML aggregation are looked up directly.  Otherwise
+        the parent is found by the standard_name of the QC variable,
+        preferring the variable the QC variable is named after if several
+        share the standard_name.
+
+        :param qcvariable: netCDF4.Variable of QC flags
+        '''
+        parent_name = self.qc_parents.get(qcvariable.name)
+        if parent_name is None:
+            standard_name = qcvariable.standard_name.split(' ')[0]
+            candidates = self.variables_by_standard_name.get(standard_name)
+            if not candidates:
+                raise KeyError("No variable with standard_name {} for {}"
+                               .format(standard_name, qcvariable.name))
+            # the longest name wins, e.g. temp_2 over temp for
+            # qartod_temp_2_spike_flag
+            named = [name for name in candidates if
+                     qcvariable.name.startswith('qartod_{}_'.format(name))]
+            parent_name = max(named, key=len) if named else candidates[0]
+            self.qc_parents[qcvariable.name] = parent_name
+        return self.ncfile.variables[parent_name]
+
+
+class QCTask(object):
+    '''
+    The inputs, and once computed the flags, of one test of one variable.
+    Tasks separate reading a test's inputs, computing its flags and writing
+    them, so the three can run in different stages of a pipeline.
+    '''
+
+    def __init__(self, ncvariable, qartod_test, test_params):
+        self.ncvariable = ncvariable
+        self.qartod_test = qartod_test
+        self.test_params = test_params
+        # True for a multi-dimensional variable tested column by column
+        self.columns = False
+        # valid numeric times and values, or for columns the values with the
+        # variable's shape, and the mask of missing records
+        self.times = None
+        self.dates = None
+        self.values = None
+        self.mask = None
+        # number of context records before the file's own, and the number of
+        # the file's own valid records
+        self.n_before = 0
+        self.n_values = 0
+        self.digest = None
+        self.flags = None
+
+    def copy(self, memo=None):
+        '''
+        Replaces the arrays of the task with copies, detaching them from
+        reused read buffers.  Arrays already copied for another task are
+        shared through `memo`, a dict kept across the tasks of a file.
+        '''
+        memo = {} if memo is None else memo
+        for name in ('times', 'dates', 'values', 'mask'):
+            value = getattr(self, name)
+            if value is None:
+                continue
+            # the original is kept so its id isn't reused while memo lives
+            if id(value) not in memo:
+                memo[id(value)] = (value, np.array(value))
+            setattr(self, name, memo[id(value)][1])
+
+
 class DatasetQC(object):
 
     ncml_template = """<?xml version="1.0" encoding="UTF-8"?>
@@ -32,43 +163,62 @@ class DatasetQC(object):
 </variable>"""
 
 
-    def __init__(self, ncfile, qc_file, ncml_filename, config):
+    def __init__(self, ncfile, qc_file, ncml_filename, config, series=None,
+                 neighbors=None, summary=None):
+        from lxml import etree
         self.ncfile = ncfile
         self.qc_file = qc_file
         self.ncml_filename = ncml_filename
         # Look for existing qc_file or return None, signifying we'll create
         # one later
-        try:
-            with open(self.ncml_filename, 'r') as ncml_contents:
-                self.ncml = etree.fromstring(ncml_contents.read())
-        except:
-            self.ncml = etree.fromstring(
-                        self.ncml_template.format(basename(self.ncfile.filepath()),
-                                                  basename(self.qc_file.filepath())))
+        # lxml only accepts documents with an encoding declaration as bytes
+        if self.ncml_filename is None:
+            # no aggregation, as when the flags are stored in place
+            self.ncml = None
+        else:
+            try:
+                with open(self.ncml_filename, 'rb') as ncml_contents:
+                    self.ncml = etree.fromstring(ncml_contents.read())
+            except:
+                self.ncml = etree.fromstring(
+                            self.ncml_template.format(basename(self.ncfile.filepath()),
+                                                      basename(self.qc_file.filepath())).encode('utf-8'))
         self.ncml_write_flag = False
-        if isinstance(config, str):
+        if isinstance(config, CompiledConfig):
+            self.compiled_config = config
+            self.config = config.frame
+        elif isinstance(config, six.string_types):
             self.load_config(config)
         else:
             self.config = config
+            self.compiled_config = compile_config(config)
         self.ancillary_variables = {}
+        # optional glos_qartod.series.StationSeries the file belongs to
+        self.series = series
+        # optional glos_qartod.neighbors.NeighborIndex of the stations in the
+        # run, for the neighbor test
+        self.neighbors = neighbors
+        # optional glos_qartod.summary.FlagSummary to record flag counts in
+        self.summary = summary
+        # float64 buffers reused for the compressed series of each variable,
+        # the full times and their mask, and the series last read
+        self._buffers = {}
+        self._times = None
+        self._series = None
+        # digests of the raw data of the variables read, and of the times
+        self._digests = {}
+        self.index = DatasetIndex(ncfile)
+        self.index_ncml()
 
     def find_geophysical_variables(self):
         '''
         Returns a list of variables that match any variables listed in the
         config file for this station
         '''
-        variables = []
-        station_name = self.find_station_name()
-        station_id = station_name.split(':')[-1]
+        station_id = self.station_id()
         get_logger().info("Station ID: %s", station_id)
-        local_config = self.config[self.config['station_id'].astype(str) == station_id]
-        # get remaining "all" config
-        univ_config = self.config[(self.config['station_id'] == '*') & (~self.config['variable'].isin(local_config['variable']))]
-        # switch over to normal station ID
-        univ_config.loc[:, 'station_id'] = station_id
-        config_all = pd.concat([local_config, univ_config])
-
-        configured_variables = config_all.variable.tolist()
+        # station specific variables plus any remaining "all" config
+        configured_variables = self.compiled_config.variables(station_id)
         get_logger().info("Configured variables: %s", ', '.join(configured_variables))
         return set(configured_variables).intersection(self.ncfile.variables)
 
@@ -76,17 +226,38 @@ class DatasetQC(object):
         '''
         Returns the station identifier using the ioos_code attribute
         '''
-        platform_name = self.ncfile.platform
-        if platform_name not in self.ncfile.variables:
-            raise ValueError("Platform defined as {} but no variable matches this name".format(platform_name))
-        station_id = self.ncfile.variables[platform_name].ioos_code
-        return station_id
+        return self.index.get_station_name()
+
+    def station_id(self):
+        '''
+        Returns the short station identifier used in the config
+        '''
+        self.index.get_station_name()
+        return self.index.station_id
+
+    def index_ncml(self):
+        '''
+        Records the parents of the QC variables listed as ancillary variables
+        in the NcML aggregation, if there is one
+        '''
+        if self.ncml is None:
+            return
+        for path in ('.//ncml:variable', './/variable'):
+            for var_elem in self.ncml.findall(path, namespaces=ns):
+                for attr_elem in var_elem:
+                    if (not isinstance(attr_elem.tag, six.string_types) or
+                            attr_elem.get('name') != 'ancillary_variables'):
+                        continue
+                    for child in attr_elem.get('value', '').split():
+                        self.index.add_qc_variable(child,
+                                                   var_elem.get('name'))
 
     def create_or_find_variable_element(self, varname):
         """
         Finds an NcML variable element with nested attribute element containing
         ancillary variables.  Returns a lxml element
         """
+        from lxml import etree
 
         xpath_str = './/ncml:variable[@name="{}"]/ncml:attribute[@name="ancillary_variables"]'.format(varname)
         anc_var_elem = self.ncml.find(xpath_str, namespaces=ns)
@@ -132,6 +303,7 @@ class DatasetQC(object):
         :param netCDF.Variable child: Status Flag Variable
         '''
 
+        self.index.add_qc_variable(child.name, parent.name)
         anc_var_elem = self.create_or_find_variable_element(parent.name)
         anc_vars = anc_var_elem.attrib['value'].split(' ')
         # only add the ancillary variable name if it is not already present
@@ -157,6 +329,49 @@ class DatasetQC(object):
         '''
         Returns a list of variable names for the newly created variables for QC flags
         '''
+        return self.define_qc_variables([ncvariable])[ncvariable.name]
+
+    def define_qc_variables(self, ncvariables):
+        '''
+        Creates or updates the QC flag variables of all of `ncvariables` in
+        one pass, before any flags are written, so that a classic format QC
+        file doesn't go back into define mode and move data written for
+        one variable to define the next.  Each variable's changed attributes
+        are set together and attributes which already have the right value
+        aren't rewritten.  Flag variables without a digest get
+        PENDING_DIGEST, so their digest is already as long as any recorded
+        after their flags are written.  Returns an ordered dict of each variable's name to
+        the names of its QC variables.
+
+        :param list ncvariables: Variables to define QC variables for
+        '''
+        schemas = OrderedDict((ncvariable.name, self.qc_schema(ncvariable))
+                              for ncvariable in ncvariables)
+        for ncvariable in ncvariables:
+            for variable_name, (dims, attrs) in \
+                    six.iteritems(schemas[ncvariable.name]):
+                if variable_name not in self.qc_file.variables:
+                    ncvar = self.qc_file.createVariable(
+                        variable_name, np.int8, dims, fill_value=np.int8(9))
+                else:
+                    ncvar = self.qc_file.variables[variable_name]
+                changed = changed_attributes(ncvar, attrs)
+                if DIGEST_ATTR not in ncvar.ncattrs():
+                    # reserved now so recording the digest after the flags
+                    # are written doesn't grow the header
+                    changed[DIGEST_ATTR] = PENDING_DIGEST
+                if changed:
+                    ncvar.setncatts(changed)
+                self.append_ancillary_variable(ncvariable, ncvar)
+        return OrderedDict((name, list(schema))
+                           for name, schema in six.iteritems(schemas))
+
+    def qc_schema(self, ncvariable):
+        '''
+        Returns an ordered dict of the name of each QC flag variable of
+        `ncvariable` to a tuple of its dimensions and ordered dict of
+        attributes
+        '''
         name = ncvariable.name
         standard_name = ncvariable.standard_name
         dims = ncvariable.dimensions
@@ -199,6 +414,24 @@ class DatasetQC(object):
                 'references': 'http://gliders.ioos.us/static/pdf/Manual-for-QC-of-Glider-Data_05_09_16.pdf',
                 'qartod_test': 'spike'
             },
+            'climatology': {
+                'name': 'qartod_%(name)s_climatology_flag',
+                'long_name': 'QARTOD Climatology Test for %(standard_name)s',
+                'standard_name': '%(standard_name)s status_flag',
+                'flag_values': np.array([1, 2, 3, 4, 9], dtype=np.int8),
+                'flag_meanings': 'GOOD NOT_EVALUATED SUSPECT BAD MISSING',
+                'references': 'http://gliders.ioos.us/static/pdf/Manual-for-QC-of-Glider-Data_05_09_16.pdf',
+                'qartod_test': 'climatology'
+            },
+            'neighbor': {
+                'name': 'qartod_%(name)s_neighbor_flag',
+                'long_name': 'QARTOD Neighbor Test for %(standard_name)s',
+                'standard_name': '%(standard_name)s status_flag',
+                'flag_values': np.array([1, 2, 3, 4, 9], dtype=np.int8),
+                'flag_meanings': 'GOOD NOT_EVALUATED SUSPECT BAD MISSING',
+                'references': 'http://gliders.ioos.us/static/pdf/Manual-for-QC-of-Glider-Data_05_09_16.pdf',
+                'qartod_test': 'neighbor'
+            },
             'pressure': {
                 'name': 'qartod_monotonic_pressure_flag',
                 'long_name': 'QARTOD Pressure Test for %(standard_name)s',
@@ -218,146 +451,423 @@ class DatasetQC(object):
             }
         }
 
-        qcvariables = []
+        schema = OrderedDict()
 
         for tname, template in templates.items():
             if tname == 'pressure' and standard_name != 'sea_water_pressure':
                 continue
             variable_name = template['name'] % {'name': name}
 
-            if variable_name not in self.qc_file.variables:
-                ncvar = self.qc_file.createVariable(variable_name, np.int8, dims, fill_value=np.int8(9))
-            else:
-                ncvar = self.qc_file.variables[variable_name]
-
-            ncvar.units = '1'
-            ncvar.standard_name = template['standard_name'] % {'standard_name': standard_name}
-            ncvar.long_name = template['long_name'] % {'standard_name': standard_name}
-            ncvar.flag_values = template['flag_values']
-            ncvar.flag_meanings = template['flag_meanings']
-            ncvar.references = template['references']
+            attrs = OrderedDict()
+            attrs['units'] = '1'
+            attrs['standard_name'] = template['standard_name'] % {'standard_name': standard_name}
+            attrs['long_name'] = template['long_name'] % {'standard_name': standard_name}
+            attrs['flag_values'] = template['flag_values']
+            attrs['flag_meanings'] = template['flag_meanings']
+            attrs['references'] = template['references']
             if 'qartod_test' in template:
-                ncvar.qartod_test = template['qartod_test']
-            qcvariables.append(variable_name)
-            self.append_ancillary_variable(ncvariable, ncvar)
+                attrs['qartod_test'] = template['qartod_test']
+            schema[variable_name] = (dims, attrs)
 
-        return qcvariables
+        return schema
 
     def load_config(self, path):
         '''
-        Returns a dataframe loaded from the excel config file.
+        Returns a dataframe loaded from the excel config file.  Loaded and
+        compiled configurations are cached until the file changes.
         '''
-        get_logger().info("Loading config %s", path)
-        df = pd.read_excel(path)
-        self.config = df
-        return df
+        self.compiled_config = compile_config(path)
+        self.config = self.compiled_config.frame
+        return self.config
 
     def apply_qc(self, ncvariable):
         '''
-        Applies QC to a qartod variable
+        Applies QC to a qartod variable.  Returns the QCTask run, or None if
+        the test wasn't run, see prepare_qc.
 
         :param netCDF4.Variable ncvariable: A QARTOD Variable
         '''
-        qc_tests = {
-            'flat_line': qc.flat_line_check,
-            'gross_range': qc.range_check,
-            'rate_of_change': qc.rate_of_change_check,
-            'spike': qc.spike_check,
-            'pressure': gliders_qc.pressure_check
-        }
+        task = self.prepare_qc(ncvariable)
+        if task is None:
+            return None
+        self.compute_qc(task)
+        self.write_qc(task)
+        return task
+
+    def prepare_qc(self, ncvariable):
+        '''
+        Reads the inputs of the test of a qartod variable and returns them as
+        a QCTask, or None if the test isn't configured, can't be applied or
+        its flags are up to date.  The arrays of the task are views of
+        buffers which the next variable read reuses, see QCTask.copy.
 
+        :param netCDF4.Variable ncvariable: A QARTOD Variable
+        '''
         # If the qartod_test attribute isn't defined then this isn't a variable
         # this script created and is not eligble for automatic QC
         qartod_test = getattr(ncvariable, 'qartod_test', None)
         if not qartod_test:
-            return
+            return None
 
-        # Get a reference to the parent variable using the standard_name
-        # attribute
-        standard_name = getattr(ncvariable, 'standard_name').split(' ')[0]
-        parent = self.ncfile.get_variables_by_attributes(standard_name=\
-                                                         standard_name)[0]
+        parent = self.index.find_parent(ncvariable)
 
         test_params = self.get_test_params(parent.name)
         # If there are no parameters defined for this test, don't apply QC
         if qartod_test not in test_params:
-            return
+            return None
 
         test_params = test_params[qartod_test]
-
-        if 'thresh_val' in test_params:
-            test_params['thresh_val'] = test_params['thresh_val'] / pq.hour
-
-        times, values, mask = self.get_unmasked(parent)
-
-        if qartod_test in ('rate_of_change', 'spike'):
-            times = ma.getdata(times[~mask])
-            if times.size > 0:
-               dates = np.array(num2date(times,
-                                         self.ncfile.variables['time'].units),
-                                dtype='datetime64[ms]')
-            else:
-               dates = np.array([], dtype='datetime64[ms]')
-            test_params['times'] = dates
-
-        if qartod_test == 'pressure':
-            test_params['pressure'] = values
+        if qartod_test == 'climatology':
+            test_params = dict(test_params, depths=self.get_depths(parent))
+
+        task = QCTask(ncvariable, qartod_test, test_params)
+        context = None
+        if len(parent.dimensions) > 1:
+            if qartod_test == 'neighbor':
+                get_logger().warn("The neighbor test is not supported for "
+                                  "multi-dimensional variable %s",
+                                  parent.name)
+                return None
+            if self.series is not None and qartod_test in WINDOW_TESTS:
+                get_logger().warn("Station series context is not used for "
+                                  "multi-dimensional variable %s",
+                                  parent.name)
+            task.columns = True
+            try:
+                task.dates, task.values, task.mask = self.get_columns(parent)
+            except:
+                get_logger().exception("QARTOD test application failed.")
+                return None
         else:
-            test_params['arr'] = values
+            task.times, task.values, task.mask = self.get_unmasked(parent)
+            task.n_values = task.values.size
+            # give window tests the records on the other side of the file
+            # boundaries when running over a station series
+            if (self.series is not None and qartod_test in WINDOW_TESTS and
+                    task.n_values > 0):
+                before, after = context_size(qartod_test, test_params)
+                task.times, task.values, task.n_before = \
+                    self.extend_with_context(parent, task.times, task.values,
+                                             before, after)
+                # the context records from the neighbouring files are inputs
+                # too
+                if task.times.size != task.n_values:
+                    context = (task.times, task.values)
+
+        task.digest = self.test_digest(parent, qartod_test, test_params,
+                                       context)
+        if task.digest is not None and self.is_current(ncvariable,
+                                                       task.digest):
+            self.summarize(ncvariable)
+            return None
+
+        if qartod_test == 'neighbor':
+            task.dates = self.get_dates(task.times)
+            neighbor_values = self.neighbors.aligned(
+                self.station_id(), parent.name,
+                self.get_config(parent.name).units, task.dates,
+                test_params['k'], test_params.get('max_distance'),
+                test_params['time_tolerance'])
+            task.test_params = dict(test_params,
+                                    neighbor_values=neighbor_values)
+        return task
+
+    def compute_qc(self, task):
+        '''
+        Runs the test of a QCTask and sets its flags to an int8 array with
+        the shape of the variable, MISSING (9) where the variable is missing.
+        The flags are left as None if the test fails.  No files are read or
+        written.
 
-        if values.size > 0:
-            # Try to run the test.  If it fails, return an exception
+        :param QCTask task: Task returned by prepare_qc
+        '''
+        mask = task.mask
+        if task.columns:
+            from glos_qartod.multidim import column_flags
             try:
-                qc_flags = qc_tests[qartod_test](**test_params)
+                flags = column_flags(task.qartod_test, task.test_params,
+                                     task.dates, task.values, ~mask)
             except:
                 get_logger().exception("QARTOD test application failed.")
                 return
         else:
-           qc_flags = np.array([], dtype=np.uint8)
+            dates = task.dates
+            if dates is None and task.qartod_test in TIMED_TESTS:
+                dates = self.get_dates(task.times)
+            if task.values.size > 0:
+                # Try to run the test.  If it fails, return an exception
+                try:
+                    qc_flags = run_test(task.qartod_test, task.test_params,
+                                        dates, task.values)
+                    qc_flags = qc_flags[task.n_before:
+                                        task.n_before + task.n_values]
+                except:
+                    get_logger().exception("QARTOD test application failed.")
+                    return
+            else:
+                qc_flags = np.array([], dtype=np.uint8)
+            flags = np.full(mask.shape, 9, dtype=np.int8)
+            flags[~mask] = qc_flags
+        if task.digest is None:
+            # tests of data outside the file can't be memoized, but the
+            # primary flag still needs to know when their flags change
+            task.digest = 'flags:' + array_digest(flags)
+        get_logger().info("Flagged: %s", np.count_nonzero(flags == 4))
+        get_logger().info("Total Values: %s", np.count_nonzero(~mask))
+        task.flags = flags
+
+    def write_qc(self, task):
+        '''
+        Writes the flags of a computed QCTask and their digest, if the test
+        succeeded
 
-        get_logger().info("Flagged: %s", len(np.where(qc_flags == 4)[0]))
-        get_logger().info("Total Values: %s", len(values))
-        # write any flags to non-missing data
-        ncvariable[~mask] = qc_flags[~mask]
+        :param QCTask task: Task passed to compute_qc
+        '''
+        if task.flags is None:
+            return
+        write_flag_array(task.ncvariable, task.flags)
+        setattr(task.ncvariable, DIGEST_ATTR, task.digest)
+        self.summarize(task.ncvariable, task.flags)
 
-    def get_unmasked(self, ncvariable):
-        times = self.ncfile.variables['time'][:]
-        values = ncvariable[:]
+    def summarize(self, qcvar, flags=None):
+        '''
+        Records the flag counts of a flag variable in the summary, if there
+        is one.  Without `flags` the flags are up to date and are only read
+        back if the summary has no row for them.
 
-        mask = np.zeros(times.shape[0], dtype=bool)
+        :param netCDF4.Variable qcvar: Flag variable
+        :param numpy.ndarray flags: The flags just computed
+        '''
+        if self.summary is None:
+            return
+        path = self.ncfile.filepath()
+        parent_name = self.index.qc_parents.get(qcvar.name)
+        test = getattr(qcvar, 'qartod_test', 'primary')
+        if flags is None:
+            if self.summary.has(path, parent_name, test):
+                return
+            flags = ma.filled(qcvar[:], 9)
+        time_start, time_end = self.flag_time_range(flags)
+        self.summary.record(path, self.station_id(), parent_name, test,
+                            flags, time_start, time_end)
 
-        if hasattr(values, 'mask'):
-            mask |= values.mask
+    def flag_time_range(self, flags):
+        '''
+        Returns the first and last times, in seconds since 1970, with flags
+        other than MISSING, or a tuple of Nones if there are none.  Uses the
+        times read for the tests.
 
-        if hasattr(times, 'mask'):
-            mask |= times.mask
+        :param numpy.ndarray flags: Flags with time as the first dimension
+        '''
+        if self._times is None:
+            return None, None
+        times, time_mask = self._times
+        evaluated = flags != 9
+        if evaluated.ndim > 1:
+            evaluated = evaluated.reshape(evaluated.shape[0], -1).any(axis=1)
+        evaluated &= ~time_mask
+        if not evaluated.any():
+            return None, None
+        evaluated_times = times[evaluated]
+        dates = self.get_dates(np.array([evaluated_times.min(),
+                                         evaluated_times.max()]))
+        seconds = dates.astype('datetime64[ms]').astype(np.int64) / 1000.
+        return float(seconds[0]), float(seconds[1])
+
+    def get_dates(self, times):
+        '''
+        Returns numeric times of the dataset as datetime64
 
-        values_initial = ma.getdata(values[~mask])
-        config = self.get_config(ncvariable.name)
+        :param numpy.ndarray times: Times in the dataset's time units
+        '''
+        from netCDF4 import num2date
+        if times.size == 0:
+            return np.array([], dtype='datetime64[ms]')
+        return np.array(num2date(times, self.index.time_units),
+                        dtype='datetime64[ms]')
+
+    def test_digest(self, parent, qartod_test, test_params, context=None):
+        '''
+        Returns a digest of everything the flags of a test depend on: the raw
+        data and read attributes of the variable and the times, the
+        configured units, the resolved test parameters and the engine
+        version.  Returns None for tests of data outside the file, which
+        can't be memoized.  The variable must have been read first.
+
+        :param netCDF4.Variable parent: The variable being QC'd
+        :param str qartod_test: Name of the test
+        :param dict test_params: Resolved parameters of the test
+        :param tuple context: Times and values extended with records from
+                              neighbouring files, if any
+        '''
+        if qartod_test in EXTERNAL_TESTS:
+            return None
+        return inputs_digest([
+            engine_version(), qartod_test, parent.name,
+            self._digests[parent.name], self._digests[self.index.time.name],
+            self.index.time_units, self.get_config(parent.name).units,
+            test_params, context
+        ])
+
+    def is_current(self, ncvariable, digest):
+        '''
+        Returns True if the flags of `ncvariable` were computed from inputs
+        with the same digest, so computing and writing them can be skipped
+        '''
+        if getattr(ncvariable, DIGEST_ATTR, None) != digest:
+            return False
+        get_logger().info("%s is up to date, skipping", ncvariable.name)
+        return True
+
+    def get_columns(self, ncvariable):
+        '''
+        Returns a tuple of the dataset's times as datetime64, the values of a
+        multi-dimensional variable converted to the configured units and a
+        boolean array of the same shape which is True for missing values or
+        times.  Time must be the first dimension of the variable.  Like
+        get_unmasked, the arrays are reused buffers.
+
+        :param netCDF4.Variable ncvariable: Variable to read
+        '''
+        from netCDF4 import num2date
+        if ncvariable.dimensions[0] != self.index.time.dimensions[0]:
+            raise ValueError("The first dimension of {} is not time".format(
+                ncvariable.name))
+        if self._series is not None and self._series[0] == ncvariable.name:
+            return self._series[1:]
+        with open_raw(self.ncfile) as read:
+            all_times, time_mask = self.get_times(read)
+            raw = read(ncvariable)
+            self._digests[ncvariable.name] = data_digest(raw, ncvariable)
+            mask = invalid_mask(raw, ncvariable)
+            mask |= time_mask.reshape((-1,) + (1,) * (raw.ndim - 1))
+            values = self.get_buffer('columns', raw.size).reshape(raw.shape)
+            values[...] = raw
+            del raw
+        apply_scaling(values, ncvariable)
         units = getattr(ncvariable, 'units', '1')
-        # If units are not defined or empty, set them to unitless
-        # If the config units are empty, do not attempt to convert units
-        # The latter is necessary as some of the NetCDF files do not have
-        # units attribute under the udunits variable definitions
-        if not units or pd.isnull(config.units):
-            units = '1'
-            values = values_initial
-        # must be a CF unit or this will throw an exception
-        elif ncvariable.units != config.units:
-            try:
-                values = Unit(units).convert(values_initial, config.units)
-            except ValueError as e:
-                exc_text = "Caught exception while converting units: {}".format(e)
-                get_logger().warn(exc_text)
-                values = values_initial
+        values = self.convert_units(ncvariable.name, values, units,
+                                    inplace=True)
+        dates = np.full(time_mask.shape, np.datetime64('NaT'),
+                        dtype='datetime64[ms]')
+        if not time_mask.all():
+            dates[~time_mask] = np.array(
+                num2date(all_times[~time_mask], self.index.time_units),
+                dtype='datetime64[ms]')
+        self._series = (ncvariable.name, dates, values, mask)
+        return dates, values, mask
+
+    def get_unmasked(self, ncvariable):
+        '''
+        Returns a tuple of the valid times, the valid values converted to the
+        configured units and a boolean array which is True for the records
+        that are missing a time or value.
+
+        The data are read raw, without netCDF4 building masked arrays, and
+        the valid records are gathered straight into float64 buffers that
+        are reused from variable to variable.  The series of the last
+        variable read is kept, so each test of a variable reuses it.  The
+        returned arrays are views of the buffers and are only valid until
+        the next variable is read.
+
+        :param netCDF4.Variable ncvariable: Variable to read
+        '''
+        if self._series is not None and self._series[0] == ncvariable.name:
+            return self._series[1:]
+        with open_raw(self.ncfile) as read:
+            all_times, time_mask = self.get_times(read)
+            raw = read(ncvariable)
+            self._digests[ncvariable.name] = data_digest(raw, ncvariable)
+            mask = invalid_mask(raw, ncvariable)
+            mask |= time_mask
+            index = np.flatnonzero(~mask)
+            values = gather(raw, index, self.get_buffer('values', index.size))
+            del raw
+        times = gather(all_times, index, self.get_buffer('times', index.size))
+        apply_scaling(values, ncvariable)
+        units = getattr(ncvariable, 'units', '1')
+        values = self.convert_units(ncvariable.name, values, units,
+                                    inplace=True)
+        self._series = (ncvariable.name, times, values, mask)
         return times, values, mask
 
-    def get_gross_range_config(self, config):
+    def get_times(self, read):
+        '''
+        Returns a tuple of the dataset's times as float64 and a boolean array
+        which is True for missing times.  Read once per dataset.
+
+        :param callable read: Raw variable reader from open_raw
+        '''
+        if self._times is None:
+            time_var = self.index.time
+            raw = read(time_var)
+            self._digests[time_var.name] = data_digest(raw, time_var)
+            mask = invalid_mask(raw, time_var)
+            times = self.get_buffer('all_times', raw.size)
+            times[...] = raw
+            del raw
+            apply_scaling(times, time_var)
+            self._times = (times, mask)
+        return self._times
+
+    def get_buffer(self, name, size):
+        '''
+        Returns a float64 buffer of `size` elements, reusing the allocation
+        of previous calls with the same name
+        '''
+        buf = self._buffers.get(name)
+        if buf is None or buf.size < size:
+            buf = self._buffers[name] = np.empty(size, dtype=np.float64)
+        return buf[:size]
+
+    def convert_units(self, variable, values, units, inplace=False):
+        '''
+        Returns `values` converted from `units` to the units configured for
+        `variable`.  The values are returned unchanged if no conversion is
+        needed or the conversion fails.
+
+        :param str variable: Name of the variable the values belong to
+        :param numpy.ndarray values: Values to convert
+        :param str units: Units the values are expressed in
+        :param bool inplace: Convert float64 values in place
+        '''
+        config = self.get_config(variable)
+        return convert_units(values, units, config.units, inplace)
+
+    def extend_with_context(self, parent, times, values, before, after):
+        '''
+        Returns the times and values of `parent` extended with up to `before`
+        preceding and `after` following valid records from the neighbouring
+        files in the station series, along with the number of records
+        prepended.
+
+        :param netCDF4.Variable parent: The variable being QC'd
+        :param numpy.ndarray times: Valid times of the variable
+        :param numpy.ndarray values: Valid values of the variable
+        :param int before: Number of preceding records to read
+        :param int after: Number of following records to read
+        '''
+        time_units = self.index.time_units
+        head, tail = self.series.read_context(self.ncfile.filepath(),
+                                              parent.name, time_units,
+                                              times[0], times[-1], before,
+                                              after)
+        times = np.concatenate([head[0], times, tail[0]])
+        values = np.concatenate([
+            self.convert_units(parent.name, head[1], head[2]),
+            values,
+            self.convert_units(parent.name, tail[1], tail[2])
+        ])
+        return times, values, head[0].size
+
+    @staticmethod
+    def get_gross_range_config(config):
         '''
         Returns a dictionary of test configuration parameters for the given config row
 
         :param config: A row from the pandas dataframe representing the configuration
         '''
+        import pandas as pd
         gross_range = {}
         if ('gross_range.sensor_min' in config and not pd.isnull(config['gross_range.sensor_min'])) and \
            ('gross_range.sensor_max' in config and not pd.isnull(config['gross_range.sensor_max'])):
@@ -373,23 +883,27 @@ class DatasetQC(object):
             ]
         return gross_range
 
-    def get_rate_of_change_config(self, config):
+    @staticmethod
+    def get_rate_of_change_config(config):
         '''
         Returns a dictionary of test configuration parameters for the given config row
 
         :param config: A row from the pandas dataframe representing the configuration
         '''
+        import pandas as pd
         rate_of_change = {}
         if ('rate_of_change.threshold' in config and not pd.isnull(config['rate_of_change.threshold'])):
             rate_of_change['thresh_val'] = config['rate_of_change.threshold']
         return rate_of_change
 
-    def get_spike_config(self, config):
+    @staticmethod
+    def get_spike_config(config):
         '''
         Returns a dictionary of test configuration parameters for the given config row
 
         :param config: A row from the pandas dataframe representing the configuration
         '''
+        import pandas as pd
         spike = {}
 
         if ('spike.low_threshold' in config and not pd.isnull(config['spike.low_threshold'])):
@@ -399,12 +913,14 @@ class DatasetQC(object):
 
         return spike
 
-    def get_flat_line_config(self, config):
+    @staticmethod
+    def get_flat_line_config(config):
         '''
         Returns a dictionary of test configuration parameters for the given config row
 
         :param config: A row from the pandas dataframe representing the configuration
         '''
+        import pandas as pd
         flat_line = {}
 
         if ('flat_line.low_reps' in config and not pd.isnull(config['flat_line.low_reps'])):
@@ -426,26 +942,40 @@ class DatasetQC(object):
 
         :param netCDF4.Variable ncvariable: NCVariable
         '''
-        config = self.get_config(variable)
-        test_params = {}
-
-        gross_range = self.get_gross_range_config(config)
-        if gross_range:
-            test_params['gross_range'] = gross_range
-
-        rate_of_change = self.get_rate_of_change_config(config)
-        if rate_of_change:
-            test_params['rate_of_change'] = rate_of_change
-
-        spike = self.get_spike_config(config)
-        if spike:
-            test_params['spike'] = spike
+        test_params = config_test_params(self.compiled_config,
+                                         self.station_id(), variable)
+        if self.neighbors is not None:
+            from glos_qartod.neighbors import get_neighbor_config
+            neighbor = get_neighbor_config(self.get_config(variable))
+            if neighbor:
+                test_params['neighbor'] = neighbor
+        return test_params
 
-        flat_line = self.get_flat_line_config(config)
-        if flat_line:
-            test_params['flat_line'] = flat_line
+    def get_depths(self, ncvariable):
+        '''
+        Returns the depths of a variable for the climatology test: the
+        values of the coordinate variable of the second dimension of a
+        (time, depth) variable, otherwise the variable's depth attribute or
+        scalar depth coordinate.  Returns None if the depth is unknown.
 
-        return test_params
+        :param netCDF4.Variable ncvariable: Variable being QC'd
+        '''
+        if len(ncvariable.dimensions) == 2:
+            coordinate = self.ncfile.variables.get(ncvariable.dimensions[1])
+            if coordinate is None or coordinate.ndim != 1:
+                return None
+            return ma.filled(ma.asarray(coordinate[:], dtype=np.float64),
+                             np.nan)
+        if len(ncvariable.dimensions) > 2:
+            return None
+        if hasattr(ncvariable, 'depth'):
+            return float(ncvariable.depth)
+        for name in getattr(ncvariable, 'coordinates', '').split():
+            coordinate = self.ncfile.variables.get(name)
+            if (coordinate is not None and coordinate.ndim == 0 and
+                    getattr(coordinate, 'standard_name', None) == 'depth'):
+                return float(coordinate[...])
+        return None
 
     def get_config(self, variable):
         '''
@@ -453,24 +983,9 @@ class DatasetQC(object):
 
         :param netCDF4.Variable ncvariable: NCVariable
         '''
-        station_name = self.find_station_name()
-        station_id = station_name.split(':')[-1]
-        # find any station specific as well as station-wide ('*') config rows
-        rows = self.config[(self.config['station_id'].astype(str) == station_id) &
-                           (self.config['variable'] == variable) |
-                           (self.config['station_id'].astype(str) == '*') &
-                           (self.config['variable'] == variable)]
-        # prefer station specific variable configuration to generalized variable
-        # configuration, if it is available.  '*' sorts before alphanumericals,
-        # so use reverse sorting order for the station id so that individual
-        # stations get chosen first
-        dedup = rows.sort_values(['variable', 'station_id'], ascending=[True,
-                                         False]).drop_duplicates('variable')
-        dedup['station_id'] = station_id
-        if len(dedup) > 0:
-            return dedup.iloc[-1]
-        raise KeyError("No configuration found for station {} and variable {}.".format(station_id,
-                                                                 variable))
+        # prefer station specific variable configuration to generalized
+        # variable configuration ('*'), if it is available
+        return self.compiled_config.get(self.station_id(), variable)
 
     def apply_primary_qc(self, ncvariable):
         '''
@@ -479,6 +994,7 @@ class DatasetQC(object):
 
         :param netCDF4.Variable ncvariable: NCVariable
         '''
+        from ioos_qartod.qc_tests import qc
         primary_qc_name = 'qartod_%s_primary_flag' % ncvariable.name
         if primary_qc_name not in self.qc_file.variables:
             return
@@ -486,13 +1002,459 @@ class DatasetQC(object):
         qcvar = self.qc_file.variables[primary_qc_name]
 
         ancillary_variables = self.find_ancillary_variables(ncvariable)
-        vectors = []
-
-        for qc_variable in ancillary_variables:
-            if qc_variable == primary_qc_name:
-                continue
-            ncvar = self.qc_file.variables[qc_variable]
-            vectors.append(ma.getdata(ncvar[:]))
-
-        flags = qc.qc_compare(vectors)
-        qcvar[:] = flags
+        components = [self.qc_file.variables[qc_variable]
+                      for qc_variable in ancillary_variables
+                      if qc_variable != primary_qc_name]
+        # the primary flag only depends on the flags it aggregates
+        digest = inputs_digest([engine_version(), 'primary'] + [
+            (ncvar.name, getattr(ncvar, DIGEST_ATTR, None))
+            for ncvar in components])
+        if self.is_current(qcvar, digest):
+            self.summarize(qcvar)
+            return
+        vectors = [ma.getdata(ncvar[:]) for ncvar in components]
+
+        # qc_compare takes 1-D vectors, so multi-dimensional flags are
+        # compared flattened
+        flags = np.reshape(qc.qc_compare([v.ravel() for v in vectors]),
+                           vectors[0].shape)
+        write_flag_array(qcvar, flags)
+        setattr(qcvar, DIGEST_ATTR, digest)
+        self.summarize(qcvar, flags)
+
+
+def changed_attributes(ncvariable, attrs):
+    '''
+    Returns an ordered dict of the attributes in `attrs` which `ncvariable`
+    doesn't already have with the same value, and type for arrays
+    '''
+    changed = OrderedDict()
+    for key, value in six.iteritems(attrs):
+        current = getattr(ncvariable, key, None)
+        if isinstance(value, np.ndarray):
+            same = (isinstance(current, np.ndarray) and
+                    current.dtype == value.dtype and
+                    np.array_equal(current, value))
+        else:
+            same = (current is not None and
+                    not isinstance(current, np.ndarray) and current == value)
+        if not same:
+            changed[key] = value
+    return changed
+
+
+# Tests which are passed the observation times.  ioos_qartod's spike test
+# takes none and fails if it is given them.
+TIMED_TESTS = ('rate_of_change', 'climatology', 'neighbor')
+
+# Tests which depend on data outside the file being QC'd
+EXTERNAL_TESTS = ('neighbor',)
+
+# Version of the QC engine, part of the digest of every test run.  Bump it
+# when a change would give different flags for the same data and parameters.
+QC_ENGINE_VERSION = 2
+
+# Attribute of a flag variable holding the digest of the inputs its flags
+# were computed from
+DIGEST_ATTR = 'qartod_digest'
+
+# Length of the longest digest, that of flags computed from data outside the
+# file: 'flags:' and a hex SHA-1
+DIGEST_LENGTH = 46
+
+# Digest of flag variables defined but not yet written.  It has the length of
+# the longest digest and, not being hex, matches no inputs.
+PENDING_DIGEST = 'pending'.ljust(DIGEST_LENGTH, '-')
+
+# Attributes of a data variable which change how its raw data is read
+READ_ATTRS = ('units', 'scale_factor', 'add_offset', '_FillValue',
+              'missing_value', 'valid_range', 'valid_min', 'valid_max')
+
+
+def engine_version():
+    '''
+    Returns a string identifying the versions of the code the flags are
+    computed with
+    '''
+    import ioos_qartod
+    from glos_qartod import __version__
+    return '{}/{}/{}'.format(__version__, QC_ENGINE_VERSION,
+                             getattr(ioos_qartod, '__version__', ''))
+
+
+def update_digest(digest, value):
+    '''
+    Feeds a value to a hashlib digest: arrays by their type, shape and
+    bytes, containers element by element and other objects by their
+    attributes
+    '''
+    if value is None or isinstance(value, (bool, six.string_types)):
+        digest.update(repr(value).encode('utf-8'))
+    elif isinstance(value, np.ndarray):
+        digest.update('{}{}'.format(value.dtype.str,
+                                    value.shape).encode('utf-8'))
+        digest.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8))
+    elif isinstance(value, (np.generic, int, float)):
+        digest.update(repr(np.asarray(value).item()).encode('utf-8'))
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            update_digest(digest, key)
+            update_digest(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update('[{}'.format(len(value)).encode('utf-8'))
+        for item in value:
+            update_digest(digest, item)
+    else:
+        update_digest(digest, (type(value).__name__, vars(value)))
+
+
+def inputs_digest(values):
+    '''
+    Returns the hex digest of a list of values
+    '''
+    digest = hashlib.sha1()
+    update_digest(digest, values)
+    return digest.hexdigest()
+
+
+def data_digest(raw, ncvariable):
+    '''
+    Returns the hex digest of the raw data of a variable and the attributes
+    which affect how it is read
+    '''
+    attrs = ncvariable.ncattrs()
+    return inputs_digest([raw] + [(name, ncvariable.getncattr(name))
+                                  for name in READ_ATTRS if name in attrs])
+
+
+def array_digest(*arrays):
+    '''
+    Returns the hex digest of arrays
+    '''
+    return inputs_digest(list(arrays))
+
+
+def build_test_params(config):
+    '''
+    Returns a dictionary of test name to test parameters for a config row.
+    Tests without parameters defined are omitted.
+
+    :param config: A row from the pandas dataframe representing the configuration
+    '''
+    test_params = {}
+
+    gross_range = DatasetQC.get_gross_range_config(config)
+    if gross_range:
+        test_params['gross_range'] = gross_range
+
+    rate_of_change = DatasetQC.get_rate_of_change_config(config)
+    if rate_of_change:
+        test_params['rate_of_change'] = rate_of_change
+
+    spike = DatasetQC.get_spike_config(config)
+    if spike:
+        test_params['spike'] = spike
+
+    flat_line = DatasetQC.get_flat_line_config(config)
+    if flat_line:
+        test_params['flat_line'] = flat_line
+
+    return test_params
+
+
+def config_test_params(compiled_config, station_id, variable):
+    '''
+    Returns a dictionary of test name to test parameters for a station's
+    variable: the tests of its "Variable Config" row, and the climatology
+    test if the "Climatology" sheet has rows for it.  The climatology
+    parameters hold the table only; callers add the depths.
+
+    :param glos_qartod.config.CompiledConfig compiled_config: Configuration
+    :param str station_id: Short station identifier
+    :param str variable: Name of the variable in the config
+    '''
+    test_params = build_test_params(compiled_config.get(station_id, variable))
+    table = compiled_config.climatology(station_id, variable)
+    if table is not None:
+        test_params['climatology'] = {'table': table}
+    return test_params
+
+
+def run_test(qartod_test, test_params, dates, values):
+    '''
+    Runs a QARTOD test over a series of valid values and returns the flags
+
+    :param str qartod_test: Name of the test
+    :param dict test_params: Parameters for the test from build_test_params
+    :param numpy.ndarray dates: datetime64 times of the values.  Only used by
+                                the rate of change and climatology tests
+    :param numpy.ndarray values: Valid values to test
+    '''
+    if qartod_test == 'climatology':
+        return test_params['table'].flag(dates, values,
+                                         test_params.get('depths'))
+    if qartod_test == 'neighbor':
+        from glos_qartod.neighbors import neighbor_check
+        return neighbor_check(values, test_params['neighbor_values'],
+                              test_params['suspect_threshold'],
+                              test_params.get('fail_threshold'))
+    import quantities as pq
+    from ioos_qartod.qc_tests import qc
+    from ioos_qartod.qc_tests import gliders as gliders_qc
+    qc_tests = {
+        'flat_line': qc.flat_line_check,
+        'gross_range': qc.range_check,
+        'rate_of_change': qc.rate_of_change_check,
+        'spike': qc.spike_check,
+        'pressure': gliders_qc.pressure_check
+    }
+
+    params = dict(test_params)
+    if 'thresh_val' in params:
+        params['thresh_val'] = params['thresh_val'] / pq.hour
+
+    if qartod_test in TIMED_TESTS:
+        params['times'] = dates
+
+    if qartod_test == 'pressure':
+        params['pressure'] = values
+    else:
+        params['arr'] = values
+
+    return qc_tests[qartod_test](**params)
+
+
+def convert_units(values, units, target_units, inplace=False):
+    '''
+    Returns `values` converted from `units` to `target_units`.  The values are
+    returned unchanged if no conversion is needed or the conversion fails.
+
+    :param numpy.ndarray values: Values to convert
+    :param str units: Units the values are expressed in
+    :param str target_units: Units to convert to, usually from the config
+    :param bool inplace: Convert float64 values in place
+    '''
+    import pandas as pd
+    from cf_units import Unit
+    # If units are not defined or empty, treat them as unitless
+    # If the config units are empty, do not attempt to convert units
+    # The latter is necessary as some of the NetCDF files do not have
+    # units attribute under the udunits variable definitions
+    if not units or pd.isnull(target_units) or units == target_units:
+        return values
+    # must be a CF unit or this will throw an exception
+    try:
+        return Unit(units).convert(values, target_units, inplace=inplace)
+    except ValueError as e:
+        exc_text = "Caught exception while converting units: {}".format(e)
+        get_logger().warn(exc_text)
+        return values
+
+
+def qc_arrays(config, station_id, variable, times, values, units=None,
+              time_units=None, depth=None):
+    '''
+    Runs the QARTOD tests configured for a station's variable over in-memory
+    arrays, without reading or writing any files.  The configuration is
+    resolved the same way as DatasetQC.get_config and the values are
+    converted to the configured units first.
+
+    Returns an OrderedDict of test name to int8 flags for each configured
+    test, plus the aggregate flag under 'primary'.  Masked, NaN and NaT
+    entries are flagged MISSING (9) and left out of the tests.
+
+    :param config: str, pandas.DataFrame or CompiledConfig
+    :param str station_id: Station identifier, e.g. 'leorgn' or the full
+                           ioos_code
+    :param str variable: Name of the variable in the config
+    :param times: Observation times as datetimes or datetime64, or numbers in
+                  `time_units`
+    :param values: Observed values, a numpy array, masked array or pandas
+                   Series
+    :param str units: Units of `values`.  Values are not converted if None
+    :param str time_units: CF time units of numeric `times`
+    :param float depth: Depth of the values for the climatology test
+    '''
+    from ioos_qartod.qc_tests import qc
+    compiled = compile_config(config)
+    station_id = station_id.split(':')[-1]
+    config = compiled.get(station_id, variable)
+    test_params = config_test_params(compiled, station_id, variable)
+    if 'climatology' in test_params:
+        test_params['climatology']['depths'] = depth
+
+    values = ma.masked_invalid(ma.asarray(values, dtype=np.float64))
+    if time_units is not None:
+        from netCDF4 import num2date
+        times = num2date(ma.masked_invalid(ma.asarray(times, dtype=np.float64)),
+                         time_units)
+    dates = np.asarray(ma.filled(ma.asarray(times), None),
+                       dtype='datetime64[ms]')
+    if dates.shape != values.shape:
+        raise ValueError("times and values must have the same shape")
+    valid = ~(ma.getmaskarray(values) | np.isnat(dates))
+    dates = dates[valid]
+    valid_values = convert_units(ma.getdata(values)[valid], units,
+                                 config.units)
+
+    flags = OrderedDict()
+    for qartod_test in sorted(test_params):
+        test_flags = np.full(values.shape, 9, dtype=np.int8)
+        if valid_values.size > 0:
+            try:
+                test_flags[valid] = run_test(qartod_test,
+                                             test_params[qartod_test], dates,
+                                             valid_values)
+            except Exception:
+                get_logger().exception("QARTOD test application failed.")
+        flags[qartod_test] = test_flags
+    if flags:
+        flags['primary'] = np.asarray(qc.qc_compare(list(flags.values())),
+                                      dtype=np.int8)
+    else:
+        flags['primary'] = np.full(values.shape, 9, dtype=np.int8)
+    return flags
+
+
+# Approximate maximum number of flags written to a QC variable at a time
+WRITE_BLOCK = 1 << 20
+
+
+def write_flag_array(ncvariable, flags):
+    '''
+    Writes a full array of flags to a QC variable as contiguous hyperslabs
+    along the first dimension, in blocks of about WRITE_BLOCK flags aligned
+    to the variable's chunks
+
+    :param netCDF4.Variable ncvariable: QC variable to write to
+    :param numpy.ndarray flags: Flags with the shape of the variable
+    '''
+    size = flags.shape[0]
+    row_size = max(int(np.prod(flags.shape[1:])), 1)
+    block = max(WRITE_BLOCK // row_size, 1)
+    chunking = getattr(ncvariable, 'chunking', None)
+    chunks = chunking() if chunking is not None else None
+    if chunks and chunks != 'contiguous':
+        block = max(block // chunks[0], 1) * chunks[0]
+    if size <= block:
+        ncvariable[:] = flags
+        return
+    for start in range(0, size, block):
+        # a slice past the end of an unlimited dimension would grow it, so
+        # the last block is sized to what is left
+        stop = min(start + block, size)
+        ncvariable[start:stop] = flags[start:stop]
+
+
+# Data models scipy.io.netcdf_file can memory map
+CLASSIC_MODELS = ('NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_64BIT')
+
+# Number of records gathered at a time, bounding the temporary copy made
+# when the raw data type differs from the buffer's
+GATHER_BLOCK = 65536
+
+
+@contextmanager
+def open_raw(ncfile):
+    '''
+    Yields a function returning the raw data of a variable of `ncfile`,
+    without masking or scaling.  Classic and 64-bit offset files are memory
+    mapped with scipy when it is available, so the data is paged in as it is
+    gathered rather than copied up front.  Other files are read through
+    netCDF4 with auto masking and scaling turned off.  Arrays returned by the
+    function must not be kept after the block exits.
+
+    :param netCDF4.Dataset ncfile: The dataset to read from
+    '''
+    mmap_file = None
+    if ncfile.data_model in CLASSIC_MODELS:
+        try:
+            from scipy.io import netcdf_file
+            mmap_file = netcdf_file(ncfile.filepath(), 'r', mmap=True)
+        except Exception:
+            get_logger().debug("Could not memory map %s", ncfile.filepath(),
+                               exc_info=True)
+
+    def read(ncvariable):
+        if mmap_file is not None:
+            return mmap_file.variables[ncvariable.name].data
+        ncvariable.set_auto_maskandscale(False)
+        try:
+            return ncvariable[:]
+        finally:
+            ncvariable.set_auto_maskandscale(True)
+
+    try:
+        yield read
+    finally:
+        if mmap_file is not None:
+            mmap_file.close()
+
+
+def invalid_mask(raw, ncvariable):
+    '''
+    Returns a boolean array which is True where netCDF4 would have masked the
+    raw data of `ncvariable`: fill values, missing values, values outside the
+    valid range and NaNs.
+
+    :param numpy.ndarray raw: Unmasked, unscaled data of the variable
+    :param netCDF4.Variable ncvariable: The variable
+    '''
+    from netCDF4 import default_fillvals
+    attrs = ncvariable.ncattrs()
+    mask = np.zeros(raw.shape, dtype=bool)
+    if '_FillValue' in attrs:
+        fill_value = ncvariable.getncattr('_FillValue')
+    elif raw.dtype.itemsize > 1:
+        # like netCDF4, fall back to the default fill value except for bytes
+        fill_value = default_fillvals.get(raw.dtype.str[1:])
+    else:
+        fill_value = None
+    if fill_value is not None:
+        mask |= raw == fill_value
+    if 'missing_value' in attrs:
+        for missing_value in np.atleast_1d(ncvariable.missing_value):
+            mask |= raw == missing_value
+    valid_min = valid_max = None
+    if 'valid_range' in attrs:
+        valid_min, valid_max = ncvariable.valid_range
+    if 'valid_min' in attrs:
+        valid_min = ncvariable.valid_min
+    if 'valid_max' in attrs:
+        valid_max = ncvariable.valid_max
+    if valid_min is not None:
+        mask |= raw < valid_min
+    if valid_max is not None:
+        mask |= raw > valid_max
+    if raw.dtype.kind == 'f':
+        mask |= np.isnan(raw)
+    return mask
+
+
+def gather(raw, index, out):
+    '''
+    Copies the entries of `raw` at `index` into `out`, a block at a time, and
+    returns `out`
+
+    :param numpy.ndarray raw: Data to gather from
+    :param numpy.ndarray index: Indices of the entries to gather
+    :param numpy.ndarray out: Buffer of the same length as `index`
+    '''
+    for start in range(0, index.size, GATHER_BLOCK):
+        stop = start + GATHER_BLOCK
+        out[start:stop] = raw[index[start:stop]]
+    return out
+
+
+def apply_scaling(values, ncvariable):
+    '''
+    Applies the scale_factor and add_offset of `ncvariable`, if any, to
+    float64 `values` in place
+    '''
+    scale_factor = getattr(ncvariable, 'scale_factor', None)
+    if scale_factor is not None:
+        values *= scale_factor
+    add_offset = getattr(ncvariable, 'add_offset', None)
+    if add_offset is not None:
+        values += add_offset
+    return values
@@ -1,34 +1,332 @@
 import os
-import sys
 import glob
-import pandas as pd
-from redis import Redis
-from rq import Queue
-from netCDF4 import Dataset
+import hashlib
+import heapq
+import json
+import signal
+import sys
+import time
+from argparse import ArgumentParser
 from glos_qartod import cli
+from glos_qartod.config import CLIMATOLOGY, load_sheets
 from glos_qartod import get_logger
 
 
+# Seconds a file must go without writes before the watcher enqueues it
+DEFAULT_SETTLE = 30.
+
+# Seconds between the watcher's reconciliation sweeps
+DEFAULT_RECONCILE = 3600.
+
+# rq statuses of jobs which are yet to finish
+PENDING_STATUSES = ('queued', 'deferred', 'scheduled', 'started')
+
+# Prefix of the Redis key holding the ID of the latest job of each file
+LATEST_JOB_PREFIX = 'glos_qartod:latest_job:'
+
+# Seconds the ID of the latest job of a file, and the result of a finished
+# job, are kept
+LATEST_JOB_TTL = 7 * 86400
+
+
 def main():
-    q = Queue(connection=Redis())
-    conf_file, proc_dir = sys.argv[1:3]
-    sheets = pd.read_excel(conf_file, None)
+    '''
+    Find netCDF files which are missing QC and enqueue QC jobs for them,
+    largest first
+    '''
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('conf_file', help='Path to the config file')
+    parser.add_argument('proc_dir', help='Root directory of the netCDF files')
+    parser.add_argument('-p', '--plan', action='store_true',
+                        help='Print the estimated work and makespan and exit '
+                             'without enqueueing any jobs')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of workers to plan for')
+    parser.add_argument('-j', '--journal',
+                        help='Path to a run journal.  Files it records as '
+                             'done are skipped without being opened, files '
+                             'it records as interrupted are redone, and the '
+                             'jobs append their progress to it')
+    parser.add_argument('-s', '--summary',
+                        help='Path to a SQLite database the jobs record the '
+                             'flag counts of each file, variable and test in')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running, watching the station directories '
+                             'with inotify and enqueueing QC of new and '
+                             'modified files as they are written')
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE,
+                        help='Seconds a file must go without writes before '
+                             'it is enqueued in watch mode')
+    parser.add_argument('--reconcile', type=float, default=DEFAULT_RECONCILE,
+                        help='Seconds between full sweeps of the directories '
+                             'in watch mode, to catch missed events')
+    parser.add_argument('-i', '--inplace', action='store_true',
+                        help='The jobs write the flags into the netCDF files '
+                             'rather than .ncq files and .ncml aggregations')
+    args = parser.parse_args()
+    if args.watch and args.plan:
+        parser.error('--watch and --plan are exclusive')
+    if args.watch and args.inplace:
+        # writing the flags into a file would trigger its QC again
+        parser.error('--inplace is not supported in watch mode')
+    output = 'inplace' if args.inplace else 'ncq'
+
+    sheets = load_sheets(args.conf_file)
     conf = sheets['Variable Config']
     mappings = sheets['Mappings'].set_index('var_name').to_dict()['var_dir']
-    files = qc_subset(proc_dir, conf, mappings)
+    climatology = sheets.get(CLIMATOLOGY)
+    from glos_qartod.journal import config_key
+    conf_key = config_key(args.conf_file)
+    journal = None
+    if args.journal:
+        from glos_qartod.journal import RunJournal
+        journal = RunJournal(args.journal, conf_key)
+
+    if args.watch:
+        from redis import Redis
+        from rq import Queue
+        q = Queue(connection=Redis())
+
+        def enqueue(f):
+            enqueue_qc(q, args.conf_file, f, conf_key=conf_key,
+                       journal=args.journal, summary=args.summary,
+                       output=output)
+        try:
+            watcher = Watcher(args.proc_dir, conf, mappings, enqueue,
+                              settle=args.settle, reconcile=args.reconcile,
+                              journal=journal, climatology=climatology)
+        except OSError as e:
+            parser.error('--watch needs Linux inotify: {}'.format(e))
+
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            watcher.run()
+        finally:
+            watcher.close()
+        return
+
+    files = qc_subset(args.proc_dir, conf, mappings, journal, climatology)
+    jobs, makespan = plan(files, conf, args.workers, climatology)
+
+    if args.plan:
+        print_plan(jobs, makespan, args.workers)
+        return
+
+    from redis import Redis
+    from rq import Queue
+    q = Queue(connection=Redis())
+    # workers take jobs in queue order, so enqueueing the largest jobs first
+    # schedules them longest processing time first across the workers
+    enqueued = 0
+    for cost, f in jobs:
+        if enqueue_qc(q, args.conf_file, f, conf_key=conf_key,
+                      journal=args.journal, summary=args.summary,
+                      output=output) is not None:
+            enqueued += 1
+    get_logger().info("Enqueued %s of %s files", enqueued, len(jobs))
+
+
+def job_id(conf_file, nc_path, conf_key=None):
+    '''
+    Returns the rq job ID of QC of a file, a digest of its absolute path,
+    modification time and size and the contents of the config file.  The ID
+    only changes when the file or the configuration does.
+
+    :param str conf_file: Path to the config file
+    :param str nc_path: Path to the netCDF file
+    :param str conf_key: glos_qartod.journal.config_key of the config file,
+                         read from the file if not given
+    '''
+    from glos_qartod.journal import config_key, file_signature
+    if conf_key is None:
+        conf_key = config_key(conf_file)
+    key = json.dumps([os.path.abspath(nc_path), file_signature(nc_path),
+                      conf_key])
+    return 'qartod-' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def enqueue_qc(q, conf_file, nc_path, conf_key=None, **kwargs):
+    '''
+    Enqueues QC of a file under its deterministic job ID and returns the
+    job, or None if the same job is already queued, running or finished.
+    Finished jobs are kept for LATEST_JOB_TTL seconds rather than rq's
+    default of 500, so a file QC'd within that time isn't QC'd again.  A
+    queued job of an earlier version of the file is replaced, since the new
+    job QCs the file as it is now.  Failed jobs are enqueued again.
+
+    :param rq.Queue q: Queue of the QC jobs
+    :param str conf_file: Path to the config file
+    :param str nc_path: Path to the netCDF file
+    :param str conf_key: glos_qartod.journal.config_key of the config file,
+                         so a run reads it once rather than once per file
+    :param kwargs: Keyword arguments of glos_qartod.cli.run_qc_str_lock
+    '''
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+    connection = q.connection
+    jid = job_id(conf_file, nc_path, conf_key)
+    try:
+        job = Job.fetch(jid, connection=connection)
+    except NoSuchJobError:
+        job = None
+    if job is not None:
+        status = job.get_status()
+        if status in PENDING_STATUSES or status == 'finished':
+            get_logger().info("QC of %s is already %s", nc_path, status)
+            return None
+        # failed, stopped or canceled, so try again
+        job.delete()
+
+    latest_key = LATEST_JOB_PREFIX + hashlib.sha1(
+        os.path.abspath(nc_path).encode('utf-8')).hexdigest()
+    previous = connection.get(latest_key)
+    if previous is not None:
+        previous = previous.decode('utf-8')
+    if previous is not None and previous != jid:
+        try:
+            previous_job = Job.fetch(previous, connection=connection)
+        except NoSuchJobError:
+            previous_job = None
+        # a job already started may have read the old file, so only jobs
+        # still waiting are coalesced
+        if (previous_job is not None and
+                previous_job.get_status() == 'queued'):
+            get_logger().info("Replacing queued QC of an earlier version of "
+                              "%s", nc_path)
+            previous_job.delete()
+
+    job = q.enqueue(cli.run_qc_str_lock, conf_file, nc_path, job_id=jid,
+                    result_ttl=LATEST_JOB_TTL, **kwargs)
+    connection.set(latest_key, jid, ex=LATEST_JOB_TTL)
+    return job
+
+
+def configured_tests(row, climatology=None):
+    '''
+    Returns the set of test names which have parameters defined in a row of
+    the "Variable Config" sheet, plus the climatology test if the
+    "Climatology" sheet has rows for the row's station and variable
+
+    :param pandas.Series row: Row of the "Variable Config" sheet
+    :param pandas.DataFrame climatology: "Climatology" sheet, if any
+    '''
+    # get all QC keys, i.e. not station, variable, units
+    qc_keys = row.drop(['station_id', 'variable', 'units'], errors='ignore')
+    tests = {k.split('.')[0] for k in qc_keys[qc_keys.notnull()].keys()}
+    if climatology is not None:
+        stations = set(climatology.loc[
+            climatology['variable'] == row['variable'],
+            'station_id'].astype(str))
+        station = str(row['station_id'])
+        # a '*' row covers every station, and so any station's climatology
+        if stations and (station == '*' or '*' in stations or
+                         station in stations):
+            tests.add('climatology')
+    return tests
+
+
+def estimate_cost(file_path, compiled):
+    '''
+    Estimates the QC work for a file from its header as the number of records
+    multiplied by the number of configured tests summed over the configured
+    variables present in the file.
+
+    :param str file_path: Path to the netCDF file
+    :param glos_qartod.config.CompiledConfig compiled: Compiled configuration
+    '''
+    from netCDF4 import Dataset
+    from glos_qartod.qc import find_station_name
+    with Dataset(file_path) as nc:
+        station_id = find_station_name(nc).split(':')[-1]
+        records = len(nc.dimensions['time']) if 'time' in nc.dimensions else 0
+        variables = set(compiled.variables(station_id)).intersection(
+            nc.variables)
+    n_tests = sum(len(configured_tests(compiled.get(station_id, v),
+                                       compiled.climatology_frame))
+                  for v in variables)
+    return records * n_tests
+
+
+def schedule(costs, workers):
+    '''
+    Assigns jobs to workers longest processing time first and returns the
+    resulting makespan, i.e. the largest total cost assigned to one worker.
+
+    :param list costs: Costs of the jobs
+    :param int workers: Number of workers
+    '''
+    loads = [0] * max(workers, 1)
+    for cost in sorted(costs, reverse=True):
+        # give the job to the least loaded worker
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def plan(files, conf, workers=1, climatology=None):
+    '''
+    Returns a tuple of a list of (cost, file) pairs ordered largest first and
+    the expected makespan when the jobs are run in that order on `workers`
+    workers.  Files that can't be read are given a cost of zero.
+
+    :param iterable files: Paths to the netCDF files
+    :param pandas.DataFrame conf: "Variable Config" sheet
+    :param int workers: Number of workers
+    :param pandas.DataFrame climatology: "Climatology" sheet, if any
+    '''
+    from glos_qartod.config import CompiledConfig
+    compiled = CompiledConfig(conf, climatology)
+    jobs = []
     for f in files:
-        q.enqueue(cli.run_qc_str_lock, conf_file, f)
+        try:
+            cost = estimate_cost(f, compiled)
+        except Exception:
+            get_logger().exception("Failed to estimate cost of %s", f)
+            cost = 0
+        jobs.append((cost, f))
+    jobs.sort(key=lambda j: j[0], reverse=True)
+    return jobs, schedule([cost for cost, _ in jobs], workers)
+
+
+def print_plan(jobs, makespan, workers):
+    '''
+    Prints a summary of a plan returned by `plan`
+    '''
+    total = sum(cost for cost, _ in jobs)
+    for cost, f in jobs:
+        print("{:>14} {}".format(cost, f))
+    print("Files: {}".format(len(jobs)))
+    print("Estimated total work: {} record-tests".format(total))
+    print("Expected makespan on {} worker(s): {} record-tests".format(
+        workers, makespan))
+
 
-def qc_subset(dir_root, conf, mappings):
+def qc_subset(dir_root, conf, mappings, journal=None, climatology=None):
     """Returns a subset of the files to QC based on whether there are
-       defined keys, etc"""
+       defined keys, etc.  Files `journal` records as done are left out and
+       files it records as interrupted are always included.  Tests of the
+       `climatology` sheet are expected as well."""
     files = []
+    for dest_dir, qc_varnames, qc_varnames_bkp in station_dirs(
+            dir_root, conf, mappings, climatology):
+        files.extend(find_files(dest_dir, qc_varnames, qc_varnames_bkp,
+                                journal))
+
+    return set(files)
+
+
+def station_dirs(dir_root, conf, mappings, climatology=None):
+    """
+    Yields a tuple of each station directory with configured tests, and the
+    QC variable names expected for it and their fall back names.  The
+    climatology test is expected where the `climatology` sheet has rows for
+    the station and variable.
+    """
     for row in conf.iterrows():
         vals = row[1]
-        # get all QC keys, i.e. not station, variable, units
-        qc_keys = vals.iloc[3:]
         # get unique tests that are defined for this station/variable
-        qc_nn = {k.split('.')[0] for k in qc_keys[qc_keys.notnull()].keys()}
+        qc_nn = configured_tests(vals, climatology)
         # if empty set, i.e. all keys are null, skip processing the batch of
         # files
         if not qc_nn:
@@ -49,27 +347,48 @@ def qc_subset(dir_root, conf, mappings):
         # get the varaiable name as the target directory
         # get the directory matching this station name or get all if * glob
         # is used
-        station_dirs = glob.glob(os.path.join(dir_root, var_dir, station))
-        for dest_dir in station_dirs:
-            files.extend(find_files(dest_dir, qc_varnames, qc_varnames_bkp))
+        for dest_dir in glob.glob(os.path.join(dir_root, var_dir, station)):
+            yield dest_dir, qc_varnames, qc_varnames_bkp
 
-    return set(files)
+
+def variable_dirs(dir_root, conf, mappings, climatology=None):
+    """
+    Returns the set of the variable directories which hold station
+    directories with configured tests, whether or not they exist yet
+    """
+    dirs = set()
+    for row in conf.iterrows():
+        vals = row[1]
+        if configured_tests(vals, climatology):
+            var = vals['variable']
+            dirs.add(os.path.join(dir_root, mappings.get(var, var)))
+    return dirs
 
 
-def find_files(dest_dir, qc_varnames, qc_varnames_bkp):
+def find_files(dest_dir, qc_varnames, qc_varnames_bkp, journal=None):
     nc_files = []
     if os.path.exists(dest_dir):
-        for root, subdir, fname in os.walk(dest_dir):
+        for root, subdirs, fnames in os.walk(dest_dir):
             # find all .nc files in this directory, check if there has been
             # qc applied to them, and create absolute paths to them
             # path to them
-            if not fname.endswith('.nc'):
-                continue
+            for fname in fnames:
+                if not fname.endswith('.nc'):
+                    continue
 
-            full_path = os.path.join(root, fname)
-            if not check_if_qc_vars_exist(full_path, qc_varnames,
-                                          qc_varnames_bkp):
-                nc_files.append(full_path)
+                full_path = os.path.join(root, fname)
+                if journal is not None:
+                    # the journal answers without opening the QC file
+                    if journal.is_complete(full_path):
+                        continue
+                    # the QC file of an interrupted file may have all its
+                    # variables defined and only some of the flags written
+                    if journal.is_interrupted(full_path):
+                        nc_files.append(full_path)
+                        continue
+                if not check_if_qc_vars_exist(full_path, qc_varnames,
+                                              qc_varnames_bkp):
+                    nc_files.append(full_path)
     else:
         get_logger().warn("Directory '{}' does not exist but was referenced in config".format(dest_dir))
 
@@ -78,29 +397,223 @@ def find_files(dest_dir, qc_varnames, qc_varnames_bkp):
 def check_if_qc_vars_exist(file_path, qc_varnames, qc_varnames_bkp):
     """
     Checks that QC variables exist in the corresponding QC file based on
-    data file's filename.
+    data file's filename, or in the data file itself if it has no QC file
+    and its flags are stored in place.
     Returns False if not all the QC variables are present, and True
     if they are.
     """
 
     qc_filepath = file_path.rsplit('.', 1)[0] + '.ncq'
     # try to fetch the QC file's variable names.  If it does not
-    # exist, no QC has been applied and it must be created later
+    # exist, either the flags are in the data file or no QC has been
+    # applied and it must be created later
     if not os.path.exists(qc_filepath):
+        qc_filepath = file_path
+    from netCDF4 import Dataset
+    try:
+        with Dataset(qc_filepath) as f:
+            qc_vars = f.variables.keys()
+        # check if all the QC variables exist in the file.
+        # if they don't, add them to the list of files to be processed
+        return any(names and names.issubset(qc_vars)
+                   for names in (qc_varnames, qc_varnames_bkp))
+    # if for some reason we can't open the file,
+    # note the exception and treat the qc variables as empty
+    except:
+        get_logger().exception('Failed to open file {}'.format(qc_filepath))
         return False
-    else:
+
+
+class Watcher(object):
+    """
+    Watches the station directories of the configuration with inotify and
+    passes the .nc files created, modified or moved into them to `enqueue`
+    once they have gone `settle` seconds without writes, so files still
+    being written aren't QC'd half done.  The variable directories are
+    watched for new station directories.  Every `reconcile` seconds, and
+    whenever the kernel's event queue overflows, the directories are swept
+    with qc_subset as a fall back for files whose events were missed.
+    """
+
+    def __init__(self, dir_root, conf, mappings, enqueue,
+                 settle=DEFAULT_SETTLE, reconcile=DEFAULT_RECONCILE,
+                 journal=None, climatology=None):
+        """
+        :param str dir_root: Root directory of the netCDF files
+        :param pandas.DataFrame conf: "Variable Config" sheet
+        :param dict mappings: Variable names to their directory names
+        :param callable enqueue: Called with the path of each file to QC
+        :param float settle: Seconds a file must go without writes
+        :param float reconcile: Seconds between sweeps
+        :param glos_qartod.journal.RunJournal journal: Journal of the jobs,
+                                                       files it records as
+                                                       done are not enqueued
+        :param pandas.DataFrame climatology: "Climatology" sheet, if any
+        """
+        from glos_qartod import inotify
+        self.dir_root = dir_root
+        self.conf = conf
+        self.mappings = mappings
+        self.enqueue = enqueue
+        self.settle = settle
+        self.reconcile = reconcile
+        self.journal = journal
+        self.climatology = climatology
+        self.inotify = inotify.Inotify()
+        # events of the variable directories, for new station directories,
+        # and of the station directories and their subdirectories
+        self.variable_mask = (inotify.IN_CREATE | inotify.IN_MOVED_TO |
+                              inotify.IN_ONLYDIR)
+        self.station_mask = (inotify.IN_CREATE | inotify.IN_MODIFY |
+                             inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+                             inotify.IN_ONLYDIR)
+        # watch descriptor to directory, of the variable directories and of
+        # the station directory trees
+        self.variable_watches = {}
+        self.station_watches = {}
+        # path of each file waiting to settle to the time of its last event
+        self.pending = {}
+        self.next_sweep = 0
+        self.refresh_watches(new=False)
+
+    def close(self):
+        self.inotify.close()
+
+    def add_watch(self, watches, path, mask):
         try:
-            with Dataset(qc_filepath) as f:
-                qc_vars = f.variables.keys()
-            # check if all the QC variables exist in the file.
-            # if they don't, add them to the list of files to be processed
-            return (qc_varnames.issubset(qc_vars) or
-                    qc_varnames_bkp.issubset(qc_vars))
-        # if for some reason we can't open the file,
-        # note the exception and treat the qc variables as empty
-        except:
-            get_logger().exception('Failed to open file {}'.format(qc_filepath))
+            wd = self.inotify.add_watch(path, mask)
+        except OSError:
+            get_logger().exception("Could not watch %s", path)
             return False
+        watches[wd] = path
+        return True
+
+    def refresh_watches(self, new=True):
+        """
+        Watches the variable directories and any station directories not
+        already watched.  With `new`, the files of the station directories
+        found are treated as new.
+        """
+        watched = set(self.variable_watches.values())
+        for path in variable_dirs(self.dir_root, self.conf, self.mappings,
+                                  self.climatology):
+            if path not in watched and os.path.isdir(path):
+                self.add_watch(self.variable_watches, path,
+                               self.variable_mask)
+        for dest_dir, _, _ in station_dirs(self.dir_root, self.conf,
+                                           self.mappings, self.climatology):
+            self.watch_tree(dest_dir, new)
+
+    def watch_tree(self, path, new=True):
+        """
+        Watches a directory and its subdirectories.  With `new`, the .nc
+        files in the directories newly watched are added to the pending
+        files.
+        """
+        watched = set(self.station_watches.values())
+        now = time.time()
+        for root, subdirs, fnames in os.walk(path):
+            if root in watched:
+                continue
+            # files written before the watch was added have no events
+            if not self.add_watch(self.station_watches, root,
+                                  self.station_mask) or not new:
+                continue
+            for fname in fnames:
+                if fname.endswith('.nc'):
+                    self.pending.setdefault(os.path.join(root, fname), now)
+
+    def handle(self, wd, mask, cookie, name):
+        """
+        Handles an inotify event
+        """
+        from glos_qartod import inotify
+        if mask & inotify.IN_Q_OVERFLOW:
+            get_logger().warning("inotify events were lost, sweeping")
+            self.next_sweep = 0
+            return
+        if mask & inotify.IN_IGNORED:
+            # the directory was removed
+            self.variable_watches.pop(wd, None)
+            self.station_watches.pop(wd, None)
+            return
+        if wd in self.variable_watches:
+            if mask & inotify.IN_ISDIR:
+                self.refresh_watches()
+            return
+        directory = self.station_watches.get(wd)
+        if directory is None:
+            return
+        path = os.path.join(directory, name)
+        if mask & inotify.IN_ISDIR:
+            self.watch_tree(path)
+        elif name.endswith('.nc'):
+            self.pending[path] = time.time()
+
+    def sweep(self, now):
+        """
+        Adds the files qc_subset finds to the pending files, as of `now`, and
+        watches any directories that appeared without an event
+        """
+        get_logger().info("Sweeping %s", self.dir_root)
+        self.refresh_watches()
+        if self.journal is not None:
+            self.journal.load()
+        for f in qc_subset(self.dir_root, self.conf, self.mappings,
+                           self.journal, self.climatology):
+            self.pending.setdefault(f, now)
+
+    def enqueue_settled(self, now):
+        """
+        Enqueues the pending files without events in the last `settle`
+        seconds
+        """
+        settled = [path for path, last in self.pending.items()
+                   if now - last >= self.settle]
+        if settled and self.journal is not None:
+            self.journal.load()
+        for path in settled:
+            del self.pending[path]
+            if not os.path.exists(path):
+                continue
+            if self.journal is not None and self.journal.is_complete(path):
+                continue
+            get_logger().info("Enqueueing %s", path)
+            try:
+                self.enqueue(path)
+            except Exception:
+                get_logger().exception("Failed to enqueue %s", path)
+                self.pending[path] = now
+
+    def timeout(self, now):
+        """
+        Returns the seconds until the next sweep or pending file settles
+        """
+        deadline = self.next_sweep
+        if self.pending:
+            deadline = min(deadline, min(self.pending.values()) + self.settle)
+        return max(deadline - now, 0)
+
+    def poll(self, timeout=0):
+        """
+        Waits up to `timeout` seconds for events, handles them, sweeps if
+        one is due and enqueues the files that have settled
+        """
+        for event in self.inotify.read_events(timeout):
+            self.handle(*event)
+        now = time.time()
+        if now >= self.next_sweep:
+            self.sweep(now)
+            self.next_sweep = now + self.reconcile
+        self.enqueue_settled(now)
+
+    def run(self):
+        """
+        Polls until interrupted
+        """
+        while True:
+            self.poll(self.timeout(time.time()))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+'''
+glos_qartod/series.py
+'''
+import numpy as np
+import numpy.ma as ma
+import os
+from collections import OrderedDict
+from glos_qartod import get_logger
+
+
+# Tests whose flag for a record depends on the records around it.  These lose
+# their context at file boundaries when each file is QC'd on its own.
+WINDOW_TESTS = ('flat_line', 'rate_of_change', 'spike')
+
+
+def context_size(qartod_test, test_params):
+    '''
+    Returns a tuple of the number of valid records needed before and after a
+    file's own records for a window test to flag the file's first and last
+    records the same way it would on the combined series.
+
+    :param str qartod_test: Name of the QARTOD test
+    :param dict test_params: Parameters the test will be run with
+    '''
+    if qartod_test == 'flat_line':
+        return int(test_params.get('high_reps', 0)), 0
+    if qartod_test == 'rate_of_change':
+        return 1, 0
+    if qartod_test == 'spike':
+        return 1, 1
+    return 0, 0
+
+
+def convert_times(times, from_units, to_units):
+    '''
+    Converts numeric times between two CF time unit strings
+    '''
+    if from_units == to_units or times.size == 0:
+        return times
+    from netCDF4 import num2date, date2num
+    return np.asarray(date2num(num2date(times, from_units), to_units),
+                      dtype=np.float64)
+
+
+def time_bounds(path):
+    '''
+    Returns the first and last time of a netCDF file as a tuple of datetimes,
+    or None if the file has no valid times.
+    '''
+    from netCDF4 import Dataset, num2date
+    with Dataset(path, 'r') as nc:
+        time_var = nc.variables['time']
+        size = time_var.shape[0]
+        if size == 0:
+            return None
+        first, last = time_var[0], time_var[size - 1]
+        # fall back to reading the whole time variable if the edge records
+        # are missing
+        if ma.is_masked(first) or ma.is_masked(last):
+            times = ma.compressed(time_var[:])
+            if times.size == 0:
+                return None
+            first, last = times[0], times[-1]
+        return tuple(num2date([first, last], time_var.units))
+
+
+def group_by_station(paths):
+    '''
+    Returns an ordered dict of station identifier to the list of paths of the
+    files for that station
+
+    :param list paths: Paths of netCDF files
+    '''
+    from netCDF4 import Dataset
+    from glos_qartod.qc import find_station_name
+    stations = OrderedDict()
+    for path in paths:
+        with Dataset(path, 'r') as nc:
+            station_name = find_station_name(nc)
+        stations.setdefault(station_name, []).append(path)
+    return stations
+
+
+class StationSeries(object):
+    '''
+    A station's consecutive netCDF files presented as one virtual time
+    ordered series.  Only the records window tests need from the
+    neighbouring files are read.
+    '''
+
+    def __init__(self, paths):
+        bounded = []
+        for path in paths:
+            bounds = time_bounds(path)
+            if bounds is None:
+                get_logger().info("%s has no times, excluding from series",
+                                  path)
+                continue
+            bounded.append((bounds[0], os.path.abspath(path)))
+        bounded.sort(key=lambda b: b[0])
+        self.paths = [path for _, path in bounded]
+
+    def neighbours(self, path):
+        '''
+        Returns a tuple of the files before `path`, nearest first, and the
+        files after `path`, nearest first.
+        '''
+        path = os.path.abspath(path)
+        if path not in self.paths:
+            return [], []
+        idx = self.paths.index(path)
+        return self.paths[idx - 1::-1] if idx > 0 else [], self.paths[idx + 1:]
+
+    def read_context(self, path, varname, time_units, start, end, before,
+                     after):
+        '''
+        Returns a tuple of (times, values, units) for the `before` valid
+        records preceding `start` and the `after` valid records following
+        `end` in the neighbouring files of `path`.  Times are returned in
+        `time_units` and values in their stored units.
+
+        :param str path: Path of the file being QC'd
+        :param str varname: Name of the variable being QC'd
+        :param str time_units: CF time units of the file being QC'd
+        :param float start: First valid time of the file, in `time_units`
+        :param float end: Last valid time of the file, in `time_units`
+        :param int before: Number of preceding records needed
+        :param int after: Number of following records needed
+        '''
+        prev_paths, next_paths = self.neighbours(path)
+        head = self._collect(prev_paths, varname, time_units, before,
+                             lambda t: t < start, from_end=True)
+        tail = self._collect(next_paths, varname, time_units, after,
+                             lambda t: t > end, from_end=False)
+        return head, tail
+
+    def _collect(self, paths, varname, time_units, count, keep, from_end):
+        '''
+        Reads up to `count` valid records from `paths` in order, taking the
+        records nearest the boundary of the file being QC'd.
+        '''
+        from netCDF4 import Dataset
+        times, values, units = [], [], None
+        remaining = count
+        for path in paths:
+            if remaining <= 0:
+                break
+            with Dataset(path, 'r') as nc:
+                if varname not in nc.variables:
+                    # a gap in the series, don't reach past it
+                    break
+                ncvar = nc.variables[varname]
+                var_units = getattr(ncvar, 'units', None)
+                if units is not None and var_units != units:
+                    get_logger().warn("Units of %s in %s differ from the "
+                                      "neighbouring file", varname, path)
+                    break
+                units = var_units
+                t, v = self._read_edge(nc, ncvar, time_units, remaining,
+                                       keep, from_end)
+            times.append(t)
+            values.append(v)
+            remaining -= t.size
+        if from_end:
+            times.reverse()
+            values.reverse()
+        if times:
+            return np.concatenate(times), np.concatenate(values), units
+        return (np.array([], dtype=np.float64),
+                np.array([], dtype=np.float64), units)
+
+    def _read_edge(self, nc, ncvar, time_units, count, keep, from_end):
+        '''
+        Reads the `count` valid records nearest the start or end of a file,
+        widening the slice read from disk until enough are found.
+        '''
+        time_var = nc.variables['time']
+        size = time_var.shape[0]
+        width = min(size, max(2 * count, 16))
+        while True:
+            sl = slice(size - width, size) if from_end else slice(0, width)
+            t = time_var[sl]
+            v = ncvar[sl]
+            valid = ~(ma.getmaskarray(t) | ma.getmaskarray(v))
+            t = convert_times(np.asarray(ma.getdata(t)[valid], dtype=np.float64),
+                              time_var.units, time_units)
+            v = np.asarray(ma.getdata(v)[valid], dtype=np.float64)
+            within = keep(t)
+            t, v = t[within], v[within]
+            if t.size >= count or width == size:
+                break
+            width = min(size, width * 4)
+        if from_end:
+            return t[-count:], v[-count:]
+        return t[:count], v[:count]
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+'''
+glos_qartod/stream.py
+
+Real-time QC of observations as they arrive.  A small rolling buffer is kept
+for each station and variable, just large enough for the spike, rate of
+change and flat line tests, and each new observation is flagged in constant
+amortized time.
+'''
+from argparse import ArgumentParser
+from collections import deque
+from glos_qartod import get_logger
+from glos_qartod.config import compile_config, load_compiled_config
+import json
+import math
+import os
+import signal
+import six
+import sys
+
+
+# Flags in increasing order of precedence when aggregated into the primary
+# flag, as in ioos_qartod.qc_tests.qc.qc_compare
+PRIORITIES = (9, 2, 1, 3, 4)
+
+# Version of the checkpoint format
+CHECKPOINT_VERSION = 1
+
+
+def primary_flag(flags):
+    '''
+    Returns the aggregate of the flags of one observation
+
+    :param iterable flags: Flags of the individual tests
+    '''
+    flags = list(flags)
+    if not flags:
+        return 2
+    return max(flags, key=PRIORITIES.index)
+
+
+def parse_time(value):
+    '''
+    Returns an observation time as seconds since 1970-01-01 UTC.  Numbers
+    are taken to already be seconds since the epoch, anything else is parsed
+    as an ISO 8601 string.
+    '''
+    if isinstance(value, (int, float)):
+        return float(value)
+    import pandas as pd
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return (timestamp - pd.Timestamp(0)).total_seconds()
+
+
+def check_params(qartod_test, params):
+    '''
+    Returns True if the test can be run with `params`.  Mirrors the checks
+    made by the ioos_qartod tests, which fail the whole test and leave the
+    flags MISSING when the configuration is invalid, as when gross range
+    has a user span but no sensor span.
+    '''
+    if qartod_test == 'gross_range':
+        if 'sensor_span' not in params:
+            return False
+        sensor = sorted(params['sensor_span'])
+        user = params.get('user_span')
+        return user is None or (sorted(user)[0] >= sensor[0] and
+                                sorted(user)[1] <= sensor[1])
+    if qartod_test == 'spike':
+        return params['low_thresh'] < params['high_thresh']
+    if qartod_test == 'flat_line':
+        return bool(params['eps']) and params['low_reps'] < params['high_reps']
+    return True
+
+
+class SlidingExtrema(object):
+    '''
+    The minimum and maximum of the last `size` values pushed, maintained with
+    monotonic deques in constant amortized time per value
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.minima = deque()
+        self.maxima = deque()
+
+    def push(self, value):
+        index = self.count
+        self.count += 1
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((index, value))
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((index, value))
+        oldest = self.count - self.size
+        while self.minima and self.minima[0][0] < oldest:
+            self.minima.popleft()
+        while self.maxima and self.maxima[0][0] < oldest:
+            self.maxima.popleft()
+
+    def full(self):
+        return self.count >= self.size
+
+    def within(self, value, eps):
+        '''
+        Returns True if all of the values in the window are within `eps` of
+        `value`
+        '''
+        if not self.maxima:
+            return True
+        return (self.maxima[0][1] - value < eps and
+                value - self.minima[0][1] < eps)
+
+
+class SeriesState(object):
+    '''
+    Rolling QC state of one station's variable.  Only valid observations
+    enter the buffer, as the batch QC runs the tests over the series with
+    missing values removed.
+    '''
+
+    def __init__(self, test_params, target_units=None):
+        # units the thresholds are configured in
+        self.target_units = target_units
+        self.test_params = dict((test, params) for test, params in
+                                six.iteritems(test_params)
+                                if check_params(test, params))
+        self.invalid_tests = sorted(set(test_params) - set(self.test_params))
+        flat_line = self.test_params.get('flat_line')
+        size = 2
+        if flat_line:
+            size = max(size, flat_line['high_reps'])
+            self.low_window = SlidingExtrema(flat_line['low_reps'])
+            self.high_window = SlidingExtrema(flat_line['high_reps'])
+        self.values = deque(maxlen=size)
+        self.last_time = None
+        # the output record of the last valid observation, which is updated
+        # once the spike test can look at the observation after it
+        self.last = None
+
+    def flag(self, time, value, depth=None):
+        '''
+        Returns a tuple of the flags of a new valid observation and the
+        revised spike flag of the previous valid observation, or None if the
+        spike test isn't configured or can't yet be applied to it.
+
+        :param float time: Seconds since 1970-01-01 UTC
+        :param float value: The value, in the configured units
+        :param float depth: Depth of the observation for the climatology
+                            test, if known
+        '''
+        flags = dict((test, 9) for test in self.invalid_tests)
+        previous_spike = None
+        params = self.test_params.get('gross_range')
+        if params:
+            flags['gross_range'] = self.gross_range(value, params)
+        params = self.test_params.get('rate_of_change')
+        if params:
+            flags['rate_of_change'] = self.rate_of_change(time, value, params)
+        params = self.test_params.get('spike')
+        if params:
+            # the newest observation has no successor yet, so like the last
+            # record of a batch it is tested against a difference of zero
+            flags['spike'] = self.spike_flag(0, params)
+            if len(self.values) >= 2:
+                previous_spike = self.spike_flag(
+                    abs(self.values[-1] -
+                        0.5 * (self.values[-2] + value)), params)
+        params = self.test_params.get('climatology')
+        if params:
+            flags['climatology'] = self.climatology(time, value, depth,
+                                                    params)
+        params = self.test_params.get('flat_line')
+        if params:
+            flags['flat_line'] = self.flat_line(value, params)
+            self.low_window.push(value)
+            self.high_window.push(value)
+        self.values.append(value)
+        self.last_time = time
+        return flags, previous_spike
+
+    @staticmethod
+    def gross_range(value, params):
+        sensor_min, sensor_max = sorted(params['sensor_span'])
+        if value < sensor_min or value > sensor_max:
+            return 4
+        user_span = params.get('user_span')
+        if user_span is not None:
+            user_min, user_max = sorted(user_span)
+            if value < user_min or value > user_max:
+                return 3
+        return 1
+
+    def rate_of_change(self, time, value, params):
+        if not self.values:
+            return 2
+        delta = abs(value - self.values[-1])
+        seconds = abs(time - self.last_time)
+        if seconds == 0:
+            rate = float('inf') if delta else float('nan')
+        else:
+            rate = delta / seconds
+        # the threshold is configured per hour
+        return 3 if rate > params['thresh_val'] / 3600. else 1
+
+    @staticmethod
+    def spike_flag(difference, params):
+        if difference < params['low_thresh']:
+            return 1
+        if difference < params['high_thresh']:
+            return 3
+        return 4
+
+    @staticmethod
+    def climatology(time, value, depth, params):
+        import numpy as np
+        date = np.array([int(round(time * 1000))], dtype='datetime64[ms]')
+        return int(params['table'].flag(date, [value], depth)[0])
+
+    def flat_line(self, value, params):
+        eps = params['eps']
+        if not self.low_window.full() or not self.low_window.within(value, eps):
+            return 1
+        if self.high_window.full() and self.high_window.within(value, eps):
+            return 4
+        return 3
+
+    def to_dict(self):
+        return {'values': list(self.values), 'last_time': self.last_time,
+                'last': self.last}
+
+    def restore(self, state):
+        '''
+        Restores the buffer from SeriesState.to_dict, rebuilding the flat line
+        windows from the buffered values.  The buffer holds at least as many
+        values as the windows, so they are full again exactly when they were
+        full before.
+        '''
+        self.values.extend(state['values'])
+        self.last_time = state['last_time']
+        self.last = state['last']
+        if 'flat_line' in self.test_params:
+            for value in self.values:
+                self.low_window.push(value)
+                self.high_window.push(value)
+
+
+class StreamQC(object):
+    '''
+    Flags observations one at a time using the thresholds of the QC config
+    and the bounds of its "Climatology" sheet.  Observations are dicts with
+    station_id, variable, time and value keys and optional units and depth
+    keys.
+    '''
+
+    def __init__(self, config):
+        self.compiled_config = compile_config(config)
+        self.series = {}
+        self.units = {}
+
+    def get_series(self, station_id, variable):
+        '''
+        Returns the SeriesState of a station's variable, creating it on first
+        use, or None if the variable isn't configured.
+        '''
+        from glos_qartod.qc import config_test_params
+        key = (station_id, variable)
+        if key not in self.series:
+            try:
+                config = self.compiled_config.get(station_id, variable)
+            except KeyError:
+                return None
+            self.series[key] = SeriesState(
+                config_test_params(self.compiled_config, station_id,
+                                   variable), config.units)
+        return self.series[key]
+
+    def convert(self, value, units, target_units):
+        '''
+        Converts a value to the configured units, caching the parsed units
+        '''
+        import pandas as pd
+        if not units or pd.isnull(target_units) or units == target_units:
+            return value
+        from cf_units import Unit
+        try:
+            if units not in self.units:
+                self.units[units] = Unit(units)
+            return float(self.units[units].convert(value, target_units))
+        except ValueError as e:
+            get_logger().warn("Caught exception while converting units: "
+                              "{}".format(e))
+            return value
+
+    def process(self, observation):
+        '''
+        Flags an observation.  Returns a list of output records: the
+        observation with its flags under 'flags' and the aggregate flag under
+        'primary', preceded by a revised record of the previous observation,
+        marked with 'update', if its spike flag changed.
+
+        :param dict observation: The observation
+        '''
+        station_id = str(observation['station_id']).split(':')[-1]
+        variable = observation['variable']
+        record = dict(observation)
+        state = self.get_series(station_id, variable)
+        if state is None:
+            get_logger().warn("No configuration for station %s and variable "
+                              "%s", station_id, variable)
+            record['flags'] = {}
+            record['primary'] = 2
+            return [record]
+
+        value = observation.get('value')
+        time = observation.get('time')
+        if value is None or time is None or math.isnan(value):
+            flags = dict((test, 9) for test in
+                         list(state.test_params) + state.invalid_tests)
+            record['flags'] = flags
+            record['primary'] = primary_flag(flags.values())
+            return [record]
+
+        value = self.convert(float(value), observation.get('units'),
+                             state.target_units)
+        flags, previous_spike = state.flag(parse_time(time), value,
+                                           observation.get('depth'))
+        record['flags'] = flags
+        record['primary'] = primary_flag(flags.values())
+        records = []
+        last = state.last
+        if (previous_spike is not None and last is not None and
+                last['flags'].get('spike') != previous_spike):
+            last = dict(last, flags=dict(last['flags'], spike=previous_spike),
+                        update=True)
+            last['primary'] = primary_flag(last['flags'].values())
+            records.append(last)
+        records.append(record)
+        state.last = dict((k, v) for k, v in record.items() if k != 'update')
+        return records
+
+    def checkpoint(self):
+        '''
+        Returns the buffer state of every series as a JSON serializable dict
+        '''
+        return {
+            'version': CHECKPOINT_VERSION,
+            'series': [dict(state.to_dict(), station_id=station_id,
+                            variable=variable)
+                       for (station_id, variable), state in
+                       sorted(self.series.items())]
+        }
+
+    def restore(self, checkpoint):
+        '''
+        Restores the buffers from StreamQC.checkpoint.  Thresholds are taken
+        from the current config, so a series that is no longer configured is
+        dropped.
+        '''
+        if checkpoint.get('version') != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version {}".format(
+                checkpoint.get('version')))
+        self.series = {}
+        for series in checkpoint['series']:
+            state = self.get_series(series['station_id'], series['variable'])
+            if state is None:
+                get_logger().warn("Dropping checkpointed series %s %s",
+                                  series['station_id'], series['variable'])
+                continue
+            state.restore(series)
+
+    def save_checkpoint(self, path):
+        '''
+        Writes the checkpoint to `path`, replacing any previous checkpoint
+        atomically
+        '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoint(), f)
+        os.rename(tmp_path, path)
+
+    def load_checkpoint(self, path):
+        with open(path) as f:
+            self.restore(json.load(f))
+
+
+def process_lines(engine, lines, write, checkpoint_path=None,
+                  checkpoint_every=1000):
+    '''
+    Flags the JSON encoded observations in `lines`, one per line, and passes
+    each output record to `write` as a line of JSON.  Lines that can't be
+    processed are logged and skipped.
+
+    :param StreamQC engine: The QC engine
+    :param iterable lines: Lines of JSON, as str or bytes
+    :param callable write: Called with each output line
+    :param str checkpoint_path: Path to checkpoint the buffers to
+    :param int checkpoint_every: Number of observations between checkpoints
+    '''
+    count = 0
+    try:
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records = engine.process(json.loads(line))
+            except Exception:
+                get_logger().exception("Could not process observation %s",
+                                       line)
+                continue
+            for record in records:
+                write(json.dumps(record) + '\n')
+            count += 1
+            if checkpoint_path and count % checkpoint_every == 0:
+                engine.save_checkpoint(checkpoint_path)
+    finally:
+        if checkpoint_path:
+            engine.save_checkpoint(checkpoint_path)
+
+
+def serve_socket(engine, path, **kwargs):
+    '''
+    Accepts connections on a Unix domain socket at `path` and flags the
+    observations sent on each, writing the flags back on the same
+    connection.  Connections are served one at a time, so every connection
+    sees the same buffers.
+    '''
+    from six.moves import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def write(text):
+                self.wfile.write(text.encode('utf-8'))
+                self.wfile.flush()
+            process_lines(engine, self.rfile, write, **kwargs)
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.UnixStreamServer(path, Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def main():
+    '''
+    Flag observations in real time.  Reads JSON-lines observations with
+    station_id, variable, time, value and optionally units keys from stdin or
+    a Unix socket and writes them back with their flags.
+    '''
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-c', '--config', required=True,
+                        help='Path to config file to use')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Turn on logging')
+    parser.add_argument('-s', '--socket',
+                        help='Listen on this Unix socket instead of reading '
+                             'stdin')
+    parser.add_argument('--checkpoint',
+                        help='Restore the buffers from this file if it '
+                             'exists and checkpoint them to it')
+    parser.add_argument('--checkpoint-every', type=int, default=1000,
+                        help='Observations between checkpoints')
+
+    args = parser.parse_args()
+    if args.verbose:
+        from glos_qartod.cli import setup_logging
+        setup_logging()
+    engine = StreamQC(load_compiled_config(args.config))
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        engine.load_checkpoint(args.checkpoint)
+    kwargs = {'checkpoint_path': args.checkpoint,
+              'checkpoint_every': args.checkpoint_every}
+
+    def terminate(signum, frame):
+        sys.exit(0)
+    # exit through the finally blocks so the last checkpoint is written
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        if args.socket:
+            serve_socket(engine, args.socket, **kwargs)
+        else:
+            def write(text):
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            # iterate with readline so observations are flagged as they
+            # arrive rather than after a read ahead buffer fills
+            process_lines(engine, iter(sys.stdin.readline, ''), write,
+                          **kwargs)
+    finally:
+        if args.checkpoint:
+            engine.save_checkpoint(args.checkpoint)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''
+glos_qartod/summary.py
+
+A SQLite index of the flags of each file, variable and test: the number of
+records with each flag and the time range of the records evaluated.  Rows
+are recorded by the QC run from the flags it has in memory, so reports can
+count GOOD, SUSPECT and BAD flags per station and variable with a query
+rather than by opening every .ncq file.
+'''
+from argparse import ArgumentParser
+from collections import OrderedDict
+import os
+import threading
+import time
+
+import numpy as np
+
+
+# Flag values and the columns counting them
+FLAG_COLUMNS = (
+    (1, 'good'),
+    (2, 'not_evaluated'),
+    (3, 'suspect'),
+    (4, 'bad'),
+    (9, 'missing'),
+)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS flag_summary (
+    file TEXT NOT NULL,
+    station_id TEXT,
+    variable TEXT NOT NULL,
+    test TEXT NOT NULL,
+    time_start REAL,
+    time_end REAL,
+    good INTEGER NOT NULL,
+    not_evaluated INTEGER NOT NULL,
+    suspect INTEGER NOT NULL,
+    bad INTEGER NOT NULL,
+    missing INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (file, variable, test)
+);
+CREATE INDEX IF NOT EXISTS flag_summary_station
+    ON flag_summary (station_id, variable, test);
+CREATE INDEX IF NOT EXISTS flag_summary_time
+    ON flag_summary (time_start, time_end);
+'''
+
+
+def flag_counts(flags):
+    '''
+    Returns a list of the number of each flag in FLAG_COLUMNS in `flags`
+
+    :param numpy.ndarray flags: int8 flags
+    '''
+    counts = np.bincount(np.ravel(flags).astype(np.uint8), minlength=10)
+    return [int(counts[value]) for value, _ in FLAG_COLUMNS]
+
+
+class FlagSummary(object):
+    '''
+    SQLite summary of the flags written by QC runs.  Rows are upserted by
+    (file, variable, test) and committed with `commit`, once per file.  Rows
+    recorded are buffered until then and written in one short transaction,
+    so the database isn't locked while the rest of a file is QC'd.  Several
+    processes can share the database; writers wait for each other for up to
+    `timeout` seconds.
+    '''
+
+    def __init__(self, path, timeout=60.):
+        '''
+        :param str path: Path to the database, created if it doesn't exist
+        :param float timeout: Seconds to wait for another writer
+        '''
+        import sqlite3
+        self.path = path
+        # the pipeline records from its reader and writer threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=timeout,
+                                          check_same_thread=False)
+        # rows recorded since the last commit, by file, variable and test
+        self.pending = OrderedDict()
+        with self.lock:
+            self.connection.executescript(SCHEMA)
+
+    def has(self, nc_path, variable, test):
+        '''
+        Returns True if there is a row for the test of a variable of a file
+        '''
+        with self.lock:
+            if (os.path.abspath(nc_path), variable, test) in self.pending:
+                return True
+            cursor = self.connection.execute(
+                'SELECT 1 FROM flag_summary WHERE file = ? AND variable = ? '
+                'AND test = ?', (os.path.abspath(nc_path), variable, test))
+            return cursor.fetchone() is not None
+
+    def record(self, nc_path, station_id, variable, test, flags,
+               time_start=None, time_end=None):
+        '''
+        Records the flag counts of the test of a variable of a file,
+        replacing any previous row once committed
+
+        :param str nc_path: Path to the netCDF file
+        :param str station_id: Station of the file
+        :param str variable: Name of the variable tested
+        :param str test: Name of the test, or primary for the primary flag
+        :param numpy.ndarray flags: The flags
+        :param float time_start: First time evaluated, in seconds since 1970
+        :param float time_end: Last time evaluated, in seconds since 1970
+        '''
+        nc_path = os.path.abspath(nc_path)
+        values = ([nc_path, station_id, variable, test, time_start,
+                   time_end] + flag_counts(flags) + [time.time()])
+        with self.lock:
+            self.pending[(nc_path, variable, test)] = values
+
+    def write_pending(self):
+        '''
+        Writes and commits the rows recorded since the last commit in one
+        transaction.  The lock must be held.
+        '''
+        if not self.pending:
+            return
+        columns = [name for _, name in FLAG_COLUMNS]
+        sql = ('INSERT OR REPLACE INTO flag_summary (file, station_id, '
+               'variable, test, time_start, time_end, {}, updated) VALUES '
+               '({})'.format(', '.join(columns),
+                             ', '.join(['?'] * (len(columns) + 7))))
+        with self.connection:
+            self.connection.executemany(sql, list(self.pending.values()))
+        self.pending.clear()
+
+    def commit(self):
+        with self.lock:
+            self.write_pending()
+
+    def close(self):
+        with self.lock:
+            self.write_pending()
+            self.connection.close()
+
+    def query(self, station_id=None, variable=None, test=None, start=None,
+              end=None, by_file=False):
+        '''
+        Returns a list of ordered dicts of the flag counts and time range of
+        each station, variable and test, summed over their files, or of each
+        file if `by_file` is True.  Files are included if their time range
+        overlaps `start` to `end`.
+
+        :param str station_id: Only this station
+        :param str variable: Only this variable
+        :param str test: Only this test
+        :param float start: Seconds since 1970
+        :param float end: Seconds since 1970
+        :param bool by_file: Return a row for each file
+        '''
+        keys = ['station_id', 'variable', 'test']
+        if by_file:
+            keys.insert(0, 'file')
+        counts = [name for _, name in FLAG_COLUMNS]
+        where, params = [], []
+        for column, value in (('station_id', station_id),
+                              ('variable', variable), ('test', test)):
+            if value is not None:
+                where.append('{} = ?'.format(column))
+                params.append(value)
+        if start is not None:
+            where.append('time_end >= ?')
+            params.append(start)
+        if end is not None:
+            where.append('time_start <= ?')
+            params.append(end)
+        sql = ('SELECT {keys}, MIN(time_start), MAX(time_end), COUNT(*), '
+               '{sums} FROM flag_summary {where} GROUP BY {keys} '
+               'ORDER BY {keys}').format(
+                   keys=', '.join(keys),
+                   sums=', '.join('SUM({})'.format(c) for c in counts),
+                   where='WHERE ' + ' AND '.join(where) if where else '')
+        names = keys + ['time_start', 'time_end', 'files'] + counts
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+        return [OrderedDict(zip(names, row)) for row in rows]
+
+
+def main():
+    '''
+    Print the flag counts of a QC summary database as CSV
+    '''
+    import csv
+    import sys
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('summary', help='Path to the summary database')
+    parser.add_argument('-s', '--station', help='Only this station')
+    parser.add_argument('-v', '--variable', help='Only this variable')
+    parser.add_argument('-t', '--test', help='Only this test')
+    parser.add_argument('-f', '--by-file', action='store_true',
+                        help='A row for each file rather than each station, '
+                             'variable and test')
+    args = parser.parse_args()
+    summary = FlagSummary(args.summary)
+    try:
+        rows = summary.query(args.station, args.variable, args.test,
+                             by_file=args.by_file)
+    finally:
+        summary.close()
+    if not rows:
+        return
+    writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
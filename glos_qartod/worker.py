@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+'''
+glos_qartod/worker.py
+'''
+from argparse import ArgumentParser
+from glos_qartod import get_logger
+from glos_qartod import config
+from rq import Worker
+import importlib
+import six
+
+
+# Modules used by the QC jobs.  Importing them in the worker parent means each
+# forked job starts with them already loaded.
+PRELOAD_MODULES = [
+    'numpy',
+    'pandas',
+    'netCDF4',
+    'lxml.etree',
+    'quantities',
+    'cf_units',
+    'ioos_qartod.qc_tests.qc',
+    'ioos_qartod.qc_tests.gliders',
+    'redis_lock',
+    'glos_qartod.qc',
+]
+
+
+def preload(config_paths=()):
+    '''
+    Imports the heavy QC dependencies, initializes the udunits unit system and
+    loads and compiles each config file in `config_paths`.
+
+    :param list config_paths: Paths of config files to compile ahead of time
+    '''
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+    # the first unit parse and conversion initializes udunits state
+    from cf_units import Unit
+    Unit('m').convert(1.0, 'cm')
+    for path in config_paths:
+        config.load_compiled_config(path)
+
+
+class PreloadWorker(Worker):
+    '''
+    An rq Worker which imports the QC dependencies and compiles the QC
+    configuration in the parent process before it starts forking jobs, so
+    that each job starts with a warm copy-on-write copy of that state.
+    Configuration is only reloaded in the parent when the config file changes.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.config_paths = list(kwargs.pop('config_paths', []))
+        super(PreloadWorker, self).__init__(*args, **kwargs)
+
+    def work(self, *args, **kwargs):
+        get_logger().info("Preloading QC dependencies")
+        preload(self.config_paths)
+        return super(PreloadWorker, self).work(*args, **kwargs)
+
+    def execute_job(self, job, queue):
+        self.refresh_config(job)
+        return super(PreloadWorker, self).execute_job(job, queue)
+
+    def refresh_config(self, job):
+        '''
+        Loads the config file referenced by a QC job in the parent process
+        before the job is forked.  This is a cache hit unless the file has
+        changed since it was last compiled.
+
+        :param rq.job.Job job: The job about to be executed
+        '''
+        try:
+            args = job.args
+        except Exception:
+            get_logger().exception("Could not read arguments of job %s",
+                                   job.id)
+            return
+        if not args or not isinstance(args[0], six.string_types):
+            return
+        try:
+            config.load_compiled_config(args[0])
+        except Exception:
+            # let the job itself report the failure
+            get_logger().exception("Could not preload config %s", args[0])
+
+
+def main():
+    '''
+    Run an rq worker for glos_qartod QC jobs with dependencies and
+    configuration preloaded
+    '''
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-c', '--config', action='append', default=[],
+                        help='Path to config file to compile before forking '
+                             'jobs.  May be given multiple times')
+    parser.add_argument('-u', '--url', default='redis://localhost:6379/0',
+                        help='Redis connection URL')
+    parser.add_argument('-b', '--burst', action='store_true',
+                        help='Exit once all queues are empty')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Turn on logging')
+    parser.add_argument('queues', nargs='*', default=['default'],
+                        help='Names of the queues to listen on')
+
+    args = parser.parse_args()
+    if args.verbose:
+        from glos_qartod.cli import setup_logging
+        setup_logging()
+    from redis import StrictRedis
+    from rq import Queue
+    conn = StrictRedis.from_url(args.url)
+    queues = [Queue(name, connection=conn) for name in args.queues]
+    worker = PreloadWorker(queues, connection=conn,
+                           config_paths=args.config)
+    worker.work(burst=args.burst)
+
+
+if __name__ == '__main__':
+    main()
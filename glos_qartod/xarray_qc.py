@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+'''
+glos_qartod/xarray_qc.py
+
+Runs the config driven QARTOD tests on an xarray.Dataset backed by dask
+arrays, so that large archives are QC'd lazily, chunk by chunk and in
+parallel.  Requires the optional xarray and dask dependencies.
+'''
+import numpy as np
+from glos_qartod import get_logger
+from glos_qartod.config import compile_config
+from glos_qartod.qc import config_test_params, convert_units, run_test
+from glos_qartod.series import context_size
+
+
+# Default number of records per dask chunk along the time dimension
+DEFAULT_CHUNK_SIZE = 100000
+
+# dask schedulers which run in this process.  The flags are stored straight
+# into the QC file's netCDF4 variables, which can't be sent to other
+# processes.
+THREAD_SCHEDULERS = ('threads', 'threading', 'sync', 'synchronous',
+                     'single-threaded')
+
+
+def netcdf_lock():
+    '''
+    Returns the lock xarray holds around its netCDF4 reads.  netCDF-C and
+    HDF5 are not thread safe, so the writes to the QC file take the same
+    lock rather than running alongside the reads of the source file.
+    '''
+    try:
+        from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+    except ImportError:
+        from xarray.backends.locks import NETCDF4_PYTHON_LOCK
+    return NETCDF4_PYTHON_LOCK
+
+
+def flag_block(values, dates, qartod_test, test_params):
+    '''
+    Runs a QARTOD test over one block of a series of valid values and returns
+    the flags as int8.  If the test fails the block is flagged MISSING (9),
+    matching the netCDF4 backend which leaves the flags unwritten.
+
+    :param numpy.ndarray values: Valid values
+    :param numpy.ndarray dates: datetime64 times of the values
+    :param str qartod_test: Name of the test
+    :param dict test_params: Parameters for the test
+    '''
+    if values.size == 0:
+        return np.empty(0, dtype=np.int8)
+    try:
+        return np.asarray(run_test(qartod_test, test_params, dates, values),
+                          dtype=np.int8)
+    except Exception:
+        get_logger().exception("QARTOD test application failed.")
+        return np.full(values.shape, 9, dtype=np.int8)
+
+
+def compress_block(values, valid):
+    '''
+    Returns the valid entries of a block
+    '''
+    return values[valid]
+
+
+def scatter_block(flags, valid):
+    '''
+    Returns a full length block of flags with the flags of the valid entries
+    in place and MISSING (9) elsewhere
+    '''
+    out = np.full(valid.shape, 9, dtype=np.int8)
+    out[valid] = flags
+    return out
+
+
+def count_block(valid):
+    '''
+    Returns the number of valid entries in a block as a one element array
+    '''
+    return np.array([valid.sum()])
+
+
+def uniform_chunks(size, chunk_size, depth):
+    '''
+    Returns chunks of `chunk_size` covering `size` entries, with a short last
+    chunk folded into the one before it so that every chunk is at least
+    `depth` long as required by map_overlap.
+    '''
+    chunk_size = max(chunk_size, depth, 1)
+    chunks = [chunk_size] * (size // chunk_size)
+    remainder = size % chunk_size
+    if remainder:
+        if chunks and remainder < depth:
+            chunks[-1] += remainder
+        else:
+            chunks.append(remainder)
+    return tuple(chunks) or (0,)
+
+
+def primary_block(*blocks):
+    '''
+    Aggregates blocks of test flags into the primary flag
+    '''
+    from ioos_qartod.qc_tests import qc
+    return np.asarray(qc.qc_compare(list(blocks)), dtype=np.int8)
+
+
+class XarrayDatasetQC(object):
+    '''
+    Applies the configured QARTOD tests to the variables of an xarray.Dataset
+    whose data variables are dask arrays.  Window tests are run with
+    dask.array.map_overlap so that each chunk sees the records on either side
+    of it.
+    '''
+
+    def __init__(self, dataset, config, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.dataset = dataset
+        self.compiled_config = compile_config(config)
+        # records per chunk of the series the tests are run over
+        self.chunk_size = chunk_size
+
+    def find_station_name(self):
+        '''
+        Returns the station identifier using the ioos_code attribute
+        '''
+        platform_name = self.dataset.attrs['platform']
+        if platform_name not in self.dataset.variables:
+            raise ValueError("Platform defined as {} but no variable matches this name".format(platform_name))
+        return self.dataset[platform_name].attrs['ioos_code']
+
+    def station_id(self):
+        '''
+        Returns the short station identifier used in the config
+        '''
+        return self.find_station_name().split(':')[-1]
+
+    def find_geophysical_variables(self):
+        '''
+        Returns the set of configured variables present in the dataset
+        '''
+        configured = self.compiled_config.variables(self.station_id())
+        return set(configured).intersection(self.dataset.variables)
+
+    def get_config(self, variable):
+        return self.compiled_config.get(self.station_id(), variable)
+
+    def get_test_params(self, variable):
+        '''
+        Returns a dictionary of test parameters for `variable`, including the
+        climatology test of the "Climatology" sheet, as
+        DatasetQC.get_test_params does
+        '''
+        test_params = config_test_params(self.compiled_config,
+                                         self.station_id(), variable)
+        if 'climatology' in test_params:
+            test_params['climatology']['depths'] = self.get_depths(variable)
+        return test_params
+
+    def get_depths(self, variable):
+        '''
+        Returns the depth of a variable for the climatology test, from its
+        depth attribute or scalar depth coordinate, or None if it is unknown
+        '''
+        dataarray = self.dataset[variable]
+        if 'depth' in dataarray.attrs:
+            return float(dataarray.attrs['depth'])
+        for coordinate in dataarray.coords.values():
+            if (coordinate.ndim == 0 and
+                    coordinate.attrs.get('standard_name') == 'depth'):
+                return float(coordinate.values)
+        return None
+
+    def get_values(self, variable):
+        '''
+        Returns the values of `variable` as a float64 dask array converted to
+        the configured units, with missing values as NaN
+        '''
+        import dask.array as da
+        dataarray = self.dataset[variable]
+        values = dataarray.data
+        if not isinstance(values, da.Array):
+            values = da.from_array(values, chunks=self.chunk_size)
+        values = values.astype(np.float64)
+        units = dataarray.attrs.get('units', '1')
+        target_units = self.get_config(variable).units
+        return values.map_blocks(convert_units, units, target_units,
+                                 dtype=np.float64)
+
+    def get_dates(self, values):
+        '''
+        Returns the dataset's times as a datetime64 dask array chunked like
+        `values`
+        '''
+        import dask.array as da
+        times = self.dataset['time'].data
+        if isinstance(times, da.Array):
+            return times.astype('datetime64[ms]').rechunk(values.chunks)
+        return da.from_array(np.asarray(times, dtype='datetime64[ms]'),
+                             chunks=values.chunks)
+
+    def compute_flags(self, variable):
+        '''
+        Returns a dict of test name to a lazy int8 dask array of flags for
+        every test configured for `variable`, plus the primary flag under
+        'primary'.
+
+        Like the netCDF4 backend, the tests are run over the series with
+        missing values removed.  To keep the chunks of that compressed series
+        known, the valid records in each chunk are counted up front, which
+        reads the variable once before the flags are computed.
+        Multi-dimensional variables aren't supported and raise a ValueError.
+
+        :param str variable: Name of the variable
+        '''
+        import dask
+        import dask.array as da
+        if self.dataset[variable].ndim != 1:
+            raise ValueError("Multi-dimensional variable {} is not supported "
+                             "by the dask backend".format(variable))
+        test_params = self.get_test_params(variable)
+        if not test_params:
+            return {}
+        values = self.get_values(variable)
+        dates = self.get_dates(values)
+        valid = ~(values.map_blocks(np.isnan, dtype=bool) |
+                  dates.map_blocks(np.isnat, dtype=bool))
+
+        counts, = dask.compute(valid.map_blocks(
+            count_block, chunks=((1,) * valid.numblocks[0],), dtype=np.int64))
+        valid_chunks = (tuple(int(c) for c in counts),)
+        n_valid = sum(valid_chunks[0])
+        compressed_values = da.map_blocks(compress_block, values, valid,
+                                          chunks=valid_chunks,
+                                          dtype=np.float64)
+        compressed_dates = da.map_blocks(compress_block, dates, valid,
+                                         chunks=valid_chunks,
+                                         dtype=dates.dtype)
+
+        flags = {}
+        for qartod_test, params in test_params.items():
+            if n_valid == 0:
+                flags[qartod_test] = da.full(values.shape, 9, dtype=np.int8,
+                                             chunks=values.chunks)
+                continue
+            before, after = context_size(qartod_test, params)
+            depth = max(before, after)
+            if depth and n_valid > depth:
+                chunks = uniform_chunks(n_valid, self.chunk_size, depth)
+                test_flags = da.map_overlap(
+                    flag_block, compressed_values.rechunk(chunks),
+                    compressed_dates.rechunk(chunks), depth=depth,
+                    boundary='none', dtype=np.int8, qartod_test=qartod_test,
+                    test_params=params)
+            else:
+                # tests without windows don't need neighbouring records, and
+                # very short series are tested in one block
+                if depth:
+                    chunks = (n_valid,)
+                else:
+                    chunks = uniform_chunks(n_valid, self.chunk_size, 0)
+                test_flags = da.map_blocks(
+                    flag_block, compressed_values.rechunk(chunks),
+                    compressed_dates.rechunk(chunks), dtype=np.int8,
+                    qartod_test=qartod_test, test_params=params)
+            # put the flags back in place of the valid records, block by block
+            flags[qartod_test] = da.blockwise(
+                scatter_block, 'i', test_flags.rechunk(valid_chunks), 'i',
+                valid, 'i', dtype=np.int8, align_arrays=False,
+                adjust_chunks={'i': values.chunks[0]})
+        flags['primary'] = da.map_blocks(primary_block,
+                                         *list(flags.values()),
+                                         dtype=np.int8)
+        return flags
+
+
+def run_qc_xarray(config, nc_path, qc_extension='ncq',
+                  chunk_size=DEFAULT_CHUNK_SIZE, scheduler=None):
+    '''
+    Runs QC on a netCDF file through xarray and dask, writing the flags to the
+    same .ncq file and NcML aggregation as glos_qartod.cli.run_qc.
+
+    :param config: str, pandas.DataFrame or CompiledConfig
+    :param str nc_path: Path to the netCDF file
+    :param str qc_extension: Extension of the QC file
+    :param int chunk_size: Number of records per chunk along time
+    :param str scheduler: dask scheduler to compute with, one of
+                          THREAD_SCHEDULERS.  Defaults to the dask default
+                          for arrays, the threaded scheduler.
+    '''
+    import dask.array as da
+    import xarray as xr
+    from lxml import etree
+    from netCDF4 import Dataset
+    from glos_qartod.cli import create_or_open_qc_file
+    from glos_qartod.qc import DIGEST_ATTR, PENDING_DIGEST, DatasetQC
+
+    if scheduler is not None and scheduler not in THREAD_SCHEDULERS:
+        raise ValueError("The dask backend only supports the threaded and "
+                         "synchronous schedulers, not {}".format(scheduler))
+    compiled = compile_config(config)
+    fname_base = nc_path.rsplit('.', 1)[0]
+    qc_filename = "{}.{}".format(fname_base, qc_extension)
+    ncml_filename = fname_base + '.ncml'
+
+    with Dataset(nc_path, 'r') as nc:
+        if nc.variables['time'].size == 0:
+            get_logger().info("No records in %s, skipping", nc_path)
+            return
+        qc_file = create_or_open_qc_file(qc_filename, nc.dimensions)
+        try:
+            qc = DatasetQC(nc, qc_file, ncml_filename, compiled)
+            with xr.open_dataset(nc_path,
+                                 chunks={'time': chunk_size}) as dataset:
+                xqc = XarrayDatasetQC(dataset, compiled, chunk_size)
+                sources, targets = [], []
+                varnames = []
+                for varname in sorted(xqc.find_geophysical_variables()):
+                    # left out before any QC variables are defined, so that
+                    # no flag variables are left unwritten
+                    if nc.variables[varname].ndim != 1:
+                        get_logger().warning(
+                            "Multi-dimensional variable %s is not supported "
+                            "by the dask backend, skipping", varname)
+                        continue
+                    varnames.append(varname)
+                qcvarnames = qc.define_qc_variables(
+                    [nc.variables[varname] for varname in varnames])
+                for varname in varnames:
+                    get_logger().info("Applying QC to %s", varname)
+                    flags = xqc.compute_flags(varname)
+                    for qcvarname in qcvarnames[varname]:
+                        qcvar = qc_file.variables[qcvarname]
+                        qartod_test = getattr(qcvar, 'qartod_test',
+                                              'primary')
+                        if qartod_test in flags:
+                            sources.append(flags[qartod_test])
+                            targets.append(qcvar)
+                # the dask backend doesn't memoize, so the digests of the
+                # flags it overwrites are reset and the next netCDF4 run
+                # recomputes them
+                for qcvar in targets:
+                    if getattr(qcvar, DIGEST_ATTR, None) != PENDING_DIGEST:
+                        qcvar.setncattr(DIGEST_ATTR, PENDING_DIGEST)
+                if sources:
+                    da.store(sources, targets, lock=netcdf_lock(),
+                             scheduler=scheduler)
+            if qc.ncml_write_flag:
+                with open(ncml_filename, 'wb') as ncml_file:
+                    ncml_file.write(etree.tostring(qc.ncml))
+        finally:
+            qc_file.close()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+'''
+glos_qartod/zarr_qc.py
+
+Writes the QC flag variables to a chunked, compressed Zarr store on the local
+filesystem instead of a .ncq file, and exports stores back to .ncq.  Requires
+the optional zarr dependency.
+'''
+from argparse import ArgumentParser
+from collections import OrderedDict
+from glos_qartod import get_logger
+import numpy as np
+import numpy.ma as ma
+import os
+import six
+
+
+# Default number of records per Zarr chunk along the time dimension
+DEFAULT_CHUNK_SIZE = 100000
+
+# Attribute xarray uses to name the dimensions of a Zarr array
+DIMENSIONS_ATTR = '_ARRAY_DIMENSIONS'
+
+
+def default_compressor():
+    '''
+    Returns the compressor used for flag arrays.  Flags are small integers
+    with long runs, which bit shuffling and zstd compress well.
+    '''
+    from numcodecs import Blosc
+    return Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+
+def to_json(value):
+    '''
+    Returns an attribute value as something the Zarr JSON attributes accept
+    '''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def time_ranges(size, chunk_size):
+    '''
+    Returns a list of (start, stop) slices covering `size` records along
+    chunk boundaries, so that each range can be written independently
+    '''
+    return [(start, min(start + chunk_size, size))
+            for start in range(0, size, chunk_size)]
+
+
+class ZarrVariable(object):
+    '''
+    A QC flag variable in a ZarrQCFile.  Supports the parts of the
+    netCDF4.Variable interface used by glos_qartod.qc.DatasetQC: attributes
+    are set and read as Python attributes, and data is read and written with
+    numpy indexing.  Data is held in memory until the file is closed.
+    '''
+
+    _fields = ('name', 'dimensions', 'dtype', 'shape', '_FillValue', '_attrs',
+               '_array', '_data', '_dirty')
+
+    def __init__(self, name, dimensions, shape, dtype, fill_value, array=None):
+        self.name = name
+        self.dimensions = tuple(dimensions)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._FillValue = fill_value
+        self._attrs = OrderedDict()
+        # the existing zarr array, if the variable is already in the store
+        self._array = array
+        self._data = None
+        self._dirty = array is None
+        if array is not None:
+            for key, value in array.attrs.items():
+                if key == DIMENSIONS_ATTR:
+                    continue
+                if key == 'flag_values':
+                    value = np.array(value, dtype=self.dtype)
+                self._attrs[key] = value
+
+    def __getattr__(self, name):
+        attrs = self.__dict__.get('_attrs', {})
+        if name in attrs:
+            return attrs[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self._fields:
+            self.__dict__[name] = value
+        else:
+            self._attrs[name] = value
+            self._dirty = True
+
+    def ncattrs(self):
+        return list(self._attrs)
+
+    def setncatts(self, attdict):
+        for key, value in attdict.items():
+            setattr(self, key, value)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def data(self):
+        '''
+        Returns the in-memory flags, reading them from the store on first
+        access
+        '''
+        if self._data is None:
+            if self._array is not None:
+                self._data = self._array[...]
+            else:
+                self._data = np.full(self.shape, self._FillValue,
+                                     dtype=self.dtype)
+        return self._data
+
+    def __getitem__(self, key):
+        return ma.masked_equal(self.data[key], self._FillValue)
+
+    def __setitem__(self, key, value):
+        self.data[key] = ma.filled(value, self._FillValue)
+        self._dirty = True
+
+
+class ZarrQCFile(object):
+    '''
+    A QC file backed by a Zarr group on the local filesystem.  Supports the
+    parts of the netCDF4.Dataset interface used by glos_qartod.qc.DatasetQC.
+    Flag variables are chunked along their first dimension and compressed.
+    Modified variables are written when the file is closed, concurrently by
+    variable and by chunk aligned time range.
+    '''
+
+    def __init__(self, path, parent_dimensions, chunk_size=DEFAULT_CHUNK_SIZE,
+                 compressor=None, workers=None):
+        '''
+        :param str path: Path of the Zarr store directory
+        :param parent_dimensions: Dimensions of the parent netCDF dataset
+        :param int chunk_size: Records per chunk along the first dimension
+        :param compressor: numcodecs compressor, defaults to
+                           default_compressor()
+        :param int workers: Number of threads writing chunks, defaults to
+                            the number of CPUs
+        '''
+        import zarr
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compressor = compressor or default_compressor()
+        self.workers = workers
+        self.dimensions = OrderedDict((d.name, d.size) for d in
+                                      six.itervalues(parent_dimensions))
+        self.group = zarr.open_group(path, mode='a')
+        self.variables = OrderedDict()
+        stored = self.group.attrs.get('dimensions')
+        if stored is not None and stored != dict(self.dimensions):
+            get_logger().error("Zarr store %s had dimensional mismatch with "
+                               "original data dimensions, recreating QC "
+                               "store", path)
+            self.group = zarr.open_group(path, mode='w')
+        self.group.attrs['dimensions'] = dict(self.dimensions)
+        for name, array in self.group.arrays():
+            dims = array.attrs.get(DIMENSIONS_ATTR, [])
+            self.variables[name] = ZarrVariable(name, dims, array.shape,
+                                                array.dtype,
+                                                array.fill_value, array)
+
+    def filepath(self):
+        return self.path
+
+    def createVariable(self, varname, datatype, dimensions, fill_value=None):
+        shape = tuple(self.dimensions[d] for d in dimensions)
+        var = ZarrVariable(varname, dimensions, shape, datatype, fill_value)
+        self.variables[varname] = var
+        return var
+
+    def setncattr(self, name, value):
+        self.group.attrs[name] = to_json(value)
+
+    def getncattr(self, name):
+        return self.group.attrs[name]
+
+    def write_range(self, var, start, stop):
+        '''
+        Writes one chunk aligned time range of a variable to the store
+        '''
+        var._array[start:stop] = var.data[start:stop]
+
+    def sync(self):
+        '''
+        Writes the modified variables to the store.  Chunks don't overlap so
+        the writes need no synchronization.
+        '''
+        from multiprocessing.pool import ThreadPool
+        tasks = []
+        for var in six.itervalues(self.variables):
+            if not var._dirty:
+                continue
+            chunks = (self.chunk_size,) + var.shape[1:]
+            if var._array is None or var._array.shape != var.shape:
+                var._array = self.group.create_dataset(
+                    var.name, shape=var.shape, chunks=chunks,
+                    dtype=var.dtype, fill_value=var._FillValue,
+                    compressor=self.compressor, overwrite=True)
+            attrs = dict((k, to_json(v)) for k, v in var._attrs.items())
+            attrs[DIMENSIONS_ATTR] = list(var.dimensions)
+            var._array.attrs.put(attrs)
+            if var._data is not None and var.shape:
+                tasks.extend((var, start, stop) for start, stop in
+                             time_ranges(var.shape[0], var._array.chunks[0]))
+            var._dirty = False
+        if not tasks:
+            return
+        pool = ThreadPool(self.workers)
+        try:
+            pool.map(lambda task: self.write_range(*task), tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        self.sync()
+
+
+def run_qc_zarr(config, ncfile, store_extension='zarr', series=None,
+                chunk_size=DEFAULT_CHUNK_SIZE, workers=None, neighbors=None,
+                summary=None):
+    '''
+    Runs QC on a netCDF file, writing the flags to a Zarr store with the same
+    base name as the file.  The variables each flag variable is ancillary to
+    are recorded in the store's attributes so glos_qartod.zarr_qc.export_ncq
+    can recreate the .ncq file and NcML aggregation.
+
+    :param config: str, pandas.DataFrame or CompiledConfig
+    :param netCDF4.Dataset ncfile: Dataset to QC
+    :param str store_extension: Extension of the Zarr store
+    :param series: glos_qartod.series.StationSeries the file belongs to
+    :param int chunk_size: Records per chunk along time
+    :param int workers: Number of threads writing chunks
+    :param neighbors: glos_qartod.neighbors.NeighborIndex of the run's
+                      stations, for the neighbor test
+    :param summary: glos_qartod.summary.FlagSummary to record the flag
+                    counts in
+    '''
+    from glos_qartod.cli import apply_dataset_qc
+    from glos_qartod.qc import DatasetQC
+    fname_base = ncfile.filepath().rsplit('.', 1)[0]
+    store_path = "{}.{}".format(fname_base, store_extension)
+    qc_file = ZarrQCFile(store_path, ncfile.dimensions, chunk_size,
+                         workers=workers)
+    try:
+        qc = DatasetQC(ncfile, qc_file, fname_base + '.ncml', config, series,
+                       neighbors, summary)
+        ancillary = dict(qc_file.group.attrs.get('ancillary_variables', {}))
+        for varname in apply_dataset_qc(qc):
+            ancillary[varname] = qc.find_ancillary_variables(
+                ncfile.variables[varname])
+        qc_file.setncattr('source', os.path.basename(ncfile.filepath()))
+        qc_file.setncattr('ancillary_variables', ancillary)
+        if summary is not None:
+            summary.commit()
+    finally:
+        qc_file.close()
+
+
+def export_ncq(store_path, nc_path=None, qc_extension='ncq'):
+    '''
+    Writes the flag variables of a Zarr QC store to a .ncq file next to the
+    netCDF file it was made from, and updates the NcML aggregation.
+
+    :param str store_path: Path of the Zarr store
+    :param str nc_path: Path of the parent netCDF file, defaults to the
+                        source file recorded in the store
+    :param str qc_extension: Extension of the QC file to write
+    '''
+    import pandas as pd
+    import zarr
+    from lxml import etree
+    from netCDF4 import Dataset
+    from glos_qartod.cli import create_or_open_qc_file
+    from glos_qartod.config import CompiledConfig
+    from glos_qartod.qc import DatasetQC
+
+    group = zarr.open_group(store_path, mode='r')
+    if nc_path is None:
+        nc_path = os.path.join(os.path.dirname(os.path.abspath(store_path)),
+                               group.attrs['source'])
+    fname_base = nc_path.rsplit('.', 1)[0]
+    qc_filename = "{}.{}".format(fname_base, qc_extension)
+    ncml_filename = fname_base + '.ncml'
+    with Dataset(nc_path, 'r') as nc:
+        qc_file = create_or_open_qc_file(qc_filename, nc.dimensions)
+        try:
+            # no tests are applied, so the config is left empty
+            qc = DatasetQC(nc, qc_file, ncml_filename,
+                           CompiledConfig(pd.DataFrame()))
+            for name, array in group.arrays():
+                dims = tuple(array.attrs.get(DIMENSIONS_ATTR, []))
+                if name not in qc_file.variables:
+                    ncvar = qc_file.createVariable(
+                        name, array.dtype, dims,
+                        fill_value=array.dtype.type(array.fill_value))
+                else:
+                    ncvar = qc_file.variables[name]
+                for key, value in array.attrs.items():
+                    if key == DIMENSIONS_ATTR:
+                        continue
+                    if key == 'flag_values':
+                        value = np.array(value, dtype=array.dtype)
+                    ncvar.setncattr(key, value)
+                for start, stop in time_ranges(array.shape[0],
+                                               array.chunks[0]):
+                    ncvar[start:stop] = array[start:stop]
+            ancillary = group.attrs.get('ancillary_variables', {})
+            for varname, qcvarnames in ancillary.items():
+                for qcvarname in qcvarnames:
+                    qc.append_ancillary_variable(nc.variables[varname],
+                                                 qc_file.variables[qcvarname])
+            if qc.ncml_write_flag:
+                with open(ncml_filename, 'wb') as ncml_file:
+                    ncml_file.write(etree.tostring(qc.ncml))
+        finally:
+            qc_file.close()
+    return qc_filename
+
+
+def main():
+    '''
+    Export Zarr QC stores to .ncq files and NcML aggregations
+    '''
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Turn on logging')
+    parser.add_argument('-e', '--extension', default='ncq',
+                        help='Extension of the QC files to write')
+    parser.add_argument('stores', nargs='+',
+                        help='Zarr store to export')
+
+    args = parser.parse_args()
+    if args.verbose:
+        from glos_qartod.cli import setup_logging
+        setup_logging()
+    for store_path in args.stores:
+        get_logger().info("Exported %s to %s", store_path,
+                          export_ncq(store_path, qc_extension=args.extension))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,12 +23,29 @@ setup(
     author_email='luke.campbell at rpsgroup.com',
     url='https://github.com/lukecampbell',
     entry_points={
-        'console_scripts': ['glos-qartod=glos_qartod.cli:main']
+        'console_scripts': [
+            'glos-qartod=glos_qartod.cli:main',
+            'glos-qartod-worker=glos_qartod.worker:main',
+            'glos-qartod-config=glos_qartod.config:main',
+            'glos-qartod-zarr-export=glos_qartod.zarr_qc:main',
+            'glos-qartod-stream=glos_qartod.stream:main',
+            'glos-qartod-summary=glos_qartod.summary:main',
+            'glos-qartod-export=glos_qartod.export:main',
+            'glos-qartod-migrate=glos_qartod.inplace:main'
+        ]
     },
     packages=find_packages(),
     package_data={'glos_qartod': ['logging.json']},
     install_requires=reqs,
-    tests_require=['pytest'],
+    extras_require={
+        'yaml': ['PyYAML'],
+        'parquet': ['pyarrow'],
+        'dask': ['xarray', 'dask[array]'],
+        'zarr': ['zarr<3'],
+        'mmap': ['scipy'],
+        'neighbors': ['scipy']
+    },
+    tests_require=['pytest', 'fakeredis'],
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Console',
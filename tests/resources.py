@@ -26,3 +26,37 @@ def generate_dataset(cdl_path, nc_path):
 STATIC_FILES = {
     'leorgn': get_filename('tests/data/leorgn.nc'),
 }
+
+
+def create_station_file(path, times, values, station_id='leorgn',
+                        variable='blue_green_algae', units='rfu',
+                        standard_name='ysi_blue_green_algae',
+                        fill_value=-9999., lat=41.67196, lon=-83.2903,
+                        file_format='NETCDF4'):
+    '''
+    Writes a minimal station time series dataset with the attributes the QC
+    expects and returns `path`.  Masked entries in `values` are written as
+    fill values.
+    '''
+    from netCDF4 import Dataset
+    with Dataset(path, 'w', format=file_format) as nc:
+        nc.platform = 'platform'
+        nc.createDimension('time', None)
+        platform = nc.createVariable('platform', 'i4')
+        platform.ioos_code = 'urn:ioos:station:glos:{}'.format(station_id)
+        latitude = nc.createVariable('latitude', 'f8')
+        latitude.standard_name = 'latitude'
+        latitude[...] = lat
+        longitude = nc.createVariable('longitude', 'f8')
+        longitude.standard_name = 'longitude'
+        longitude[...] = lon
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.units = 'seconds since 1970-01-01T00:00:00Z'
+        time.standard_name = 'time'
+        time[:] = times
+        var = nc.createVariable(variable, 'f8', ('time',),
+                                fill_value=fill_value)
+        var.standard_name = standard_name
+        var.units = units
+        var[:] = values
+    return path
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_climatology.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from glos_qartod import cli, config
+from glos_qartod.climatology import ClimatologyTable
+from glos_qartod.qc import qc_arrays
+from glos_qartod.stream import StreamQC
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+try:
+    from glos_qartod.xarray_qc import run_qc_xarray
+    import dask
+    import xarray
+except ImportError:
+    run_qc_xarray = None
+
+
+def dates(*values):
+    return np.array(values, dtype='datetime64[ms]')
+
+
+class TestClimatologyTable(TestCase):
+
+    def test_month_wraps(self):
+        table = ClimatologyTable([
+            {'period': 'month', 'start': 12, 'end': 2, 'min': 0, 'max': 4},
+            {'period': 'month', 'start': 6, 'end': 8, 'min': 15, 'max': 25},
+        ])
+        flags = table.flag(dates('2016-12-31', '2017-01-15', '2017-02-28',
+                                 '2016-07-01', '2016-07-01', '2016-04-01'),
+                           [3, 5, -1, 20, 10, 10])
+        np.testing.assert_array_equal(flags, [1, 3, 3, 1, 3, 2])
+
+    def test_day_of_year(self):
+        table = ClimatologyTable([
+            {'period': 'day', 'start': 60, 'end': 60, 'min': 0, 'max': 1},
+            {'period': 'day', 'start': 366, 'end': 366, 'min': 5, 'max': 6},
+        ])
+        # day 60 is Feb 29 in a leap year and Mar 1 otherwise
+        flags = table.flag(dates('2016-02-29', '2017-03-01', '2016-03-01',
+                                 '2016-12-31', '2017-12-31'),
+                           [0.5, 0.5, 0.5, 5.5, 5.5])
+        np.testing.assert_array_equal(flags, [1, 1, 2, 1, 2])
+
+    def test_depth_and_precedence(self):
+        table = ClimatologyTable([
+            {'period': 'month', 'start': 1, 'end': 12, 'min': 10, 'max': 20,
+             'depth_min': 0, 'depth_max': 5},
+            {'period': 'month', 'start': 1, 'end': 12, 'min': 0, 'max': 10,
+             'depth_min': 5, 'depth_max': np.nan},
+            # overlapped by the rows above except at unknown depths
+            {'period': 'month', 'start': 1, 'end': 12, 'min': 100,
+             'max': 200},
+        ])
+        when = dates('2016-05-01')
+        depths = np.array([0, 4.9, 5, 50, np.nan, -1])
+        lower, upper = table.lookup(when, depths)
+        np.testing.assert_array_equal(lower, [10, 10, 0, 0, 100, 100])
+        np.testing.assert_array_equal(upper, [20, 20, 10, 10, 200, 200])
+        np.testing.assert_array_equal(table.flag(when, [15, 15], None), [3, 3])
+
+    def test_missing_dates(self):
+        table = ClimatologyTable([
+            {'period': 'month', 'start': 1, 'end': 12, 'min': 0, 'max': 1}])
+        flags = table.flag(np.array(['2016-01-01', 'NaT'],
+                                    dtype='datetime64[ms]'), [2, 2])
+        np.testing.assert_array_equal(flags, [3, 2])
+
+    def test_bad_period(self):
+        with self.assertRaises(ValueError):
+            ClimatologyTable([{'period': 'season', 'start': 1, 'end': 2,
+                               'min': 0, 'max': 1}])
+
+
+class TestClimatologyQC(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config_path = os.path.join(self.tmpdir, 'config.csv')
+        pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 100
+        }, {
+            'station_id': '*', 'variable': 'temperature', 'units': 'degC',
+            'gross_range.sensor_min': -5, 'gross_range.sensor_max': 40
+        }]).to_csv(self.config_path, index=False)
+        pd.DataFrame([
+            {'station_id': 'leorgn', 'variable': 'blue_green_algae',
+             'period': 'month', 'start': 8, 'end': 8, 'min': 0, 'max': 5},
+            {'station_id': '*', 'variable': 'temperature', 'period': 'month',
+             'start': 1, 'end': 12, 'min': 15, 'max': 25, 'depth_min': 0,
+             'depth_max': 10},
+            {'station_id': '*', 'variable': 'temperature', 'period': 'month',
+             'start': 1, 'end': 12, 'min': 4, 'max': 10, 'depth_min': 10,
+             'depth_max': 100},
+        ]).to_csv(config.sheet_path(self.config_path, config.CLIMATOLOGY),
+                  index=False)
+        self.addCleanup(config.clear_cache)
+        # 2016-08-31 to 2016-09-01
+        self.times = 1472601600 + 3600 * np.arange(48, dtype='f8')
+
+    def test_load(self):
+        compiled = config.load_compiled_config(self.config_path)
+        assert compiled.climatology('leorgn', 'blue_green_algae') is not None
+        assert compiled.climatology('45005', 'temperature') is not None
+        assert compiled.climatology('45005', 'blue_green_algae') is None
+
+    def test_validation(self):
+        sheets = config.read_sheets(self.config_path)
+        sheets[config.CLIMATOLOGY].loc[0, 'period'] = 'season'
+        with self.assertRaises(ValueError):
+            config.validate_sheets(sheets, self.config_path)
+
+    def station_values(self):
+        values = ma.masked_array(np.full(48, 3.))
+        values[[1, 30]] = 7.
+        values[2] = ma.masked
+        return values
+
+    def station_flags(self, path):
+        with Dataset(path.replace('.nc', '.ncq')) as nc:
+            return dict((test, ma.filled(nc.variables[
+                'qartod_blue_green_algae_{}_flag'.format(test)][:], 9))
+                for test in ('climatology', 'primary'))
+
+    def expected_station_flags(self):
+        expected = np.full(48, 1, dtype=np.int8)
+        expected[1] = 3
+        expected[2] = 9
+        # September has no climatology
+        expected[24:] = 2
+        return expected
+
+    def test_station_variable(self):
+        path = os.path.join(self.tmpdir, 'leorgn.nc')
+        create_station_file(path, self.times, self.station_values())
+        with Dataset(path) as nc:
+            cli.run_qc(self.config_path, nc)
+        flags = self.station_flags(path)
+        np.testing.assert_array_equal(flags['climatology'],
+                                      self.expected_station_flags())
+        assert flags['primary'][1] == 3
+
+    @skipIf(run_qc_xarray is None, "xarray and dask are not installed")
+    def test_dask(self):
+        path = os.path.join(self.tmpdir, 'leorgn.nc')
+        create_station_file(path, self.times, self.station_values())
+        run_qc_xarray(self.config_path, path, chunk_size=7)
+        flags = self.station_flags(path)
+        np.testing.assert_array_equal(flags['climatology'],
+                                      self.expected_station_flags())
+        assert flags['primary'][1] == 3
+
+    def test_stream(self):
+        engine = StreamQC(config.load_compiled_config(self.config_path))
+        for time, value, expected in ((self.times[0], 3., 1),
+                                      (self.times[1], 7., 3),
+                                      (self.times[30], 3., 2)):
+            record, = engine.process({'station_id': 'leorgn',
+                                      'variable': 'blue_green_algae',
+                                      'time': time, 'value': value})
+            assert record['flags']['climatology'] == expected
+        # the depth of the observation selects the bounds
+        for depth, expected in ((5., 1), (50., 3)):
+            record, = engine.process({'station_id': '45005',
+                                      'variable': 'temperature',
+                                      'time': self.times[0], 'value': 20.,
+                                      'depth': depth})
+            assert record['flags']['climatology'] == expected
+
+    def test_profile_variable(self):
+        path = os.path.join(self.tmpdir, 'leorgn.nc')
+        create_station_file(path, self.times, np.zeros(48))
+        with Dataset(path, 'a') as nc:
+            nc.createDimension('depth', 3)
+            depth = nc.createVariable('depth', 'f8', ('depth',))
+            depth.standard_name = 'depth'
+            depth[:] = [1, 20, 200]
+            ncvar = nc.createVariable('temperature', 'f4', ('time', 'depth'),
+                                      fill_value=np.float32(-9999.))
+            ncvar.standard_name = 'sea_water_temperature'
+            ncvar.units = 'degC'
+            ncvar[:] = np.tile([20., 20., 20.], (48, 1))
+        with Dataset(path) as nc:
+            cli.run_qc(self.config_path, nc)
+        with Dataset(path.replace('.nc', '.ncq')) as nc:
+            flags = nc.variables['qartod_temperature_climatology_flag'][:]
+        assert (flags[:, 0] == 1).all()
+        assert (flags[:, 1] == 3).all()
+        assert (flags[:, 2] == 2).all()
+
+    def test_qc_arrays(self):
+        when = np.array(self.times[[0, 30]] * 1000, dtype='datetime64[ms]')
+        flags = qc_arrays(self.config_path, 'leorgn', 'temperature', when,
+                          [20., 20.], depth=50.)
+        np.testing.assert_array_equal(flags['climatology'], [3, 3])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_config.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import config
+from glos_qartod.config import CompiledConfig
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+class TestConfig(TestCase):
+
+    def setUp(self):
+        self.frame = pd.DataFrame([
+            {'station_id': '*', 'variable': 'sea_water_temperature',
+             'units': 'degree_Celsius', 'gross_range.sensor_min': -5},
+            {'station_id': 'leorgn', 'variable': 'sea_water_temperature',
+             'units': 'degree_Celsius', 'gross_range.sensor_min': 0},
+            {'station_id': 'leorgn', 'variable': 'blue_green_algae',
+             'units': 'rfu', 'gross_range.sensor_min': -1},
+            {'station_id': '45005', 'variable': 'wind_speed',
+             'units': 'm s-1', 'gross_range.sensor_min': np.nan},
+        ])
+
+    def test_get_prefers_station(self):
+        compiled = CompiledConfig(self.frame)
+        row = compiled.get('leorgn', 'sea_water_temperature')
+        assert row['gross_range.sensor_min'] == 0
+        row = compiled.get('45005', 'sea_water_temperature')
+        assert row['gross_range.sensor_min'] == -5
+        assert row['station_id'] == '45005'
+
+    def test_get_missing(self):
+        compiled = CompiledConfig(self.frame)
+        with self.assertRaises(KeyError):
+            compiled.get('leorgn', 'wind_speed')
+
+    def test_variables(self):
+        compiled = CompiledConfig(self.frame)
+        assert set(compiled.variables('leorgn')) == {'sea_water_temperature',
+                                                     'blue_green_algae'}
+        assert set(compiled.variables('45005')) == {'sea_water_temperature',
+                                                    'wind_speed'}
+
+    def write_csv(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'config.csv')
+        self.frame.to_csv(path, index=False)
+        pd.DataFrame([{'var_name': 'blue_green_algae',
+                       'var_dir': 'ysi_blue_green_algae'}]).to_csv(
+            os.path.join(tmpdir, 'config.mappings.csv'), index=False)
+        return path
+
+    def test_reload_on_change(self):
+        path = self.write_csv()
+        first = config.load_compiled_config(path)
+        assert config.load_compiled_config(path) is first
+        assert config.load_sheets(path) is config.load_sheets(path)
+
+        # touching a sibling sheet also invalidates the cache
+        mappings = os.path.join(os.path.dirname(path), 'config.mappings.csv')
+        st = os.stat(mappings)
+        os.utime(mappings, (st.st_atime, st.st_mtime + 10))
+        assert config.load_compiled_config(path) is not first
+
+    def test_csv(self):
+        path = self.write_csv()
+        sheets = config.load_sheets(path)
+        assert list(sheets) == ['Variable Config', 'Mappings']
+        frame = sheets['Variable Config']
+        assert frame['station_id'].tolist() == ['*', 'leorgn', 'leorgn',
+                                                '45005']
+        mappings = sheets['Mappings'].set_index('var_name')
+        assert mappings.loc['blue_green_algae', 'var_dir'] == \
+            'ysi_blue_green_algae'
+
+    def test_convert(self):
+        src = self.write_csv()
+        tmpdir = os.path.dirname(src)
+        formats = ['json', 'yml', 'xlsx']
+        try:
+            import pyarrow
+            formats.append('parquet')
+        except ImportError:
+            pass
+        for ext in formats:
+            dest = os.path.join(tmpdir, 'converted.{}'.format(ext))
+            config.convert(src, dest)
+            sheets = config.load_sheets(dest)
+            assert set(sheets) == {'Variable Config', 'Mappings'}
+            compiled = config.load_compiled_config(dest)
+            row = compiled.get('leorgn', 'blue_green_algae')
+            assert row['gross_range.sensor_min'] == -1
+            assert pd.isnull(compiled.get('45005', 'wind_speed')[
+                'gross_range.sensor_min'])
+
+    def test_convert_workbook(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dest = os.path.join(tmpdir, 'GLOS-Climatologies.csv')
+        config.convert('tests/data/GLOS-Climatologies.xlsx', dest)
+        row = config.load_compiled_config(dest).get('leorgn',
+                                                    'blue_green_algae')
+        assert row.units == 'rfu'
+        assert row['gross_range.sensor_min'] == -1
+
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            config.validate_sheets({'Mappings': pd.DataFrame()})
+        with self.assertRaises(ValueError):
+            config.validate_sheets({'Variable Config':
+                                    self.frame.drop('units', axis=1)})
+        with self.assertRaises(ValueError):
+            config.validate_sheets({'Variable Config':
+                                    self.frame.assign(**{'spike.low': 1})})
+        with self.assertRaises(ValueError):
+            config.validate_sheets({'Variable Config': self.frame.assign(
+                **{'spike.low_threshold': 'high'})})
+        with self.assertRaises(ValueError):
+            config.read_sheets('config.txt')
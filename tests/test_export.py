@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_export.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from glos_qartod import cli
+from glos_qartod.export import export, month_partitions
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+@skipIf(pa is None, "pyarrow is not installed")
+class TestExport(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, 'dataset')
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'flat_line.low_reps': 2,
+            'flat_line.high_reps': 3, 'flat_line.epsilon': 0.001
+        }])
+        self.rng = np.random.RandomState(4)
+        # 2016-08-31T20:00Z, so the first file runs into September
+        self.start = 1472673600
+        self.paths = [self.create_file(0), self.create_file(1)]
+
+    def create_file(self, i):
+        times = self.start + 86400 * i + 600 * np.arange(40, dtype='f8')
+        values = ma.masked_array(self.rng.uniform(-0.2, 1.2, 40))
+        values[5] = ma.masked
+        path = create_station_file(
+            os.path.join(self.tmpdir, 'leorgn_{}.nc'.format(i)), times,
+            values)
+        with Dataset(path) as nc:
+            cli.run_qc(self.config, nc)
+        return path
+
+    def read(self):
+        import pyarrow.parquet as pq
+        frame = pq.read_table(self.dest).to_pandas()
+        return frame.sort_values('time').reset_index(drop=True)
+
+    def expected(self, paths):
+        frames = []
+        for path in paths:
+            with Dataset(path) as nc, \
+                    Dataset(path.replace('.nc', '.ncq')) as qc:
+                frame = pd.DataFrame({
+                    'time': pd.to_datetime(nc.variables['time'][:], unit='s',
+                                           utc=True),
+                    'value': ma.filled(nc.variables['blue_green_algae'][:],
+                                       np.nan)})
+                for test in ('gross_range', 'flat_line', 'primary'):
+                    frame[test + '_flag'] = ma.filled(qc.variables[
+                        'qartod_blue_green_algae_{}_flag'.format(test)][:], 9)
+            frames.append(frame)
+        return pd.concat(frames).sort_values('time').reset_index(drop=True)
+
+    def check(self, paths):
+        frame = self.read()
+        expected = self.expected(paths)
+        assert len(frame) == len(expected)
+        assert set(frame['station_id']) == {'leorgn'}
+        assert set(frame['variable']) == {'blue_green_algae'}
+        np.testing.assert_array_equal(frame['time'].values,
+                                      expected['time'].values)
+        np.testing.assert_array_equal(frame['value'].values,
+                                      expected['value'].values)
+        for column in ('gross_range_flag', 'flat_line_flag', 'primary_flag'):
+            np.testing.assert_array_equal(frame[column].values,
+                                          expected[column].values)
+        # unconfigured tests are exported as not run
+        assert (frame['spike_flag'] == 9).all()
+        return frame
+
+    def test_month_partitions(self):
+        dates = np.array(['2016-08-30', '2016-08-31', '2016-09-01',
+                          '2016-10-02'], dtype='datetime64[ms]')
+        assert month_partitions(dates) == [('2016-08', 0, 2),
+                                           ('2016-09', 2, 3),
+                                           ('2016-10', 3, 4)]
+        assert month_partitions(dates[:0]) == []
+
+    def test_export(self):
+        assert export(self.config, self.paths[:1], self.dest,
+                      chunk_size=7) == self.paths[:1]
+        frame = self.check(self.paths[:1])
+        assert set(frame['month']) == {'2016-08', '2016-09'}
+        assert np.isnan(frame['value'][5])
+        assert frame['primary_flag'][5] == 9
+
+        # new files are appended and unchanged files skipped
+        assert export(self.config, self.paths, self.dest) == self.paths[1:]
+        self.check(self.paths)
+
+        # a changed file replaces its parts
+        with Dataset(self.paths[0], 'a') as nc:
+            nc.variables['blue_green_algae'][:20] = 0.5
+        with Dataset(self.paths[0]) as nc:
+            cli.run_qc(self.config, nc)
+        assert export(self.config, self.paths, self.dest) == self.paths[:1]
+        self.check(self.paths)
+
+    def test_inplace(self):
+        from glos_qartod.inplace import migrate
+        export(self.config, self.paths, self.dest)
+        expected = self.expected(self.paths)
+        shutil.rmtree(self.dest)
+        migrate(self.paths)
+        # the flags are read from the files themselves
+        assert export(self.config, self.paths, self.dest) == self.paths
+        frame = self.read()
+        for column in ('gross_range_flag', 'flat_line_flag', 'primary_flag'):
+            np.testing.assert_array_equal(frame[column].values,
+                                          expected[column].values)
+        assert export(self.config, self.paths, self.dest) == []
+
+    def test_arrow(self):
+        import pyarrow.ipc
+        export(self.config, self.paths, self.dest, fmt='arrow', chunk_size=7)
+        part = os.path.join(self.dest, 'station_id=leorgn',
+                            'variable=blue_green_algae', 'month=2016-09',
+                            'leorgn_1.arrow')
+        table = pyarrow.ipc.open_file(pa.memory_map(part)).read_all()
+        assert table.num_rows == 40
+        assert table.schema.field('primary_flag').type == pa.int8()
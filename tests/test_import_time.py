@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_import_time.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+
+import json
+import os
+import subprocess
+import sys
+
+
+# Modules which must only be loaded on the code paths that need them
+HEAVY_MODULES = ['pandas', 'netCDF4', 'lxml', 'redis', 'redis_lock', 'rq',
+                 'ioos_qartod', 'quantities', 'cf_units']
+
+# Wall clock budget, in seconds, for importing a glos_qartod entry point module
+# in a fresh interpreter.  Can be overridden for slow CI machines.
+IMPORT_BUDGET = float(os.getenv('GLOS_QARTOD_IMPORT_BUDGET', 0.5))
+
+MEASURE_SCRIPT = '''
+import json, sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+sys.stdout.write(json.dumps({{'seconds': elapsed,
+                              'modules': sorted(sys.modules)}}))
+'''
+
+
+def measure_import(module):
+    '''
+    Imports `module` in a fresh interpreter and returns a tuple of the elapsed
+    import time in seconds and the set of top level modules that were loaded.
+    '''
+    output = subprocess.check_output([sys.executable, '-c',
+                                      MEASURE_SCRIPT.format(module=module)])
+    result = json.loads(output.decode('utf-8'))
+    loaded = {m.split('.')[0] for m in result['modules']}
+    return result['seconds'], loaded
+
+
+class TestImportTime(TestCase):
+
+    def check_module(self, module):
+        seconds, loaded = measure_import(module)
+        print("import {}: {:.3f}s (budget {:.3f}s)".format(module, seconds,
+                                                           IMPORT_BUDGET))
+        eager = sorted(loaded.intersection(HEAVY_MODULES))
+        assert not eager, "{} eagerly imports {}".format(module,
+                                                         ', '.join(eager))
+        assert seconds < IMPORT_BUDGET, \
+            "import {} took {:.3f}s".format(module, seconds)
+
+    def test_import_cli(self):
+        self.check_module('glos_qartod.cli')
+
+    def test_import_qc(self):
+        self.check_module('glos_qartod.qc')
+
+    def test_import_run(self):
+        self.check_module('glos_qartod.run')
+
+    def test_import_stream(self):
+        self.check_module('glos_qartod.stream')
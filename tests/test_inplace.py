@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_inplace.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli, qc
+from glos_qartod.inplace import InPlaceDatasetQC, migrate
+from glos_qartod.qc import DIGEST_ATTR
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+# every test's flag variable is defined, configured or not
+FLAGS = sorted('qartod_blue_green_algae_{}_flag'.format(test)
+               for test in ('gross_range', 'flat_line', 'rate_of_change',
+                            'spike', 'climatology', 'neighbor', 'primary'))
+
+
+class TestInPlace(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'flat_line.low_reps': 2,
+            'flat_line.high_reps': 3, 'flat_line.epsilon': 0.001
+        }])
+        rng = np.random.RandomState(12)
+        self.times = 1472601600 + 600 * np.arange(60, dtype='f8')
+        self.values = ma.masked_array(rng.uniform(-0.2, 1.2, 60))
+        self.values[[3, 30]] = ma.masked
+        self.values[40:45] = 0.5
+
+    def create_file(self, name, **kwargs):
+        return create_station_file(os.path.join(self.tmpdir, name),
+                                   self.times, self.values, **kwargs)
+
+    def sidecar_flags(self, path):
+        '''
+        Returns the flags of a file QC'd to a .ncq file
+        '''
+        with Dataset(path) as nc:
+            cli.run_qc(self.config, nc)
+        with Dataset(path.replace('.nc', '.ncq')) as qc_file:
+            return dict((name, qc_file.variables[name][:]) for name in FLAGS)
+
+    def check_inplace(self, path, expected):
+        with Dataset(path) as nc:
+            ancillary = nc.variables['blue_green_algae'].ancillary_variables
+            assert sorted(ancillary.split()) == FLAGS
+            for name in FLAGS:
+                np.testing.assert_array_equal(nc.variables[name][:],
+                                              expected[name])
+            return dict((name, getattr(nc.variables[name], DIGEST_ATTR,
+                                       None)) for name in FLAGS)
+
+    def test_run_qc_inplace(self):
+        expected = self.sidecar_flags(self.create_file('sidecar.nc'))
+        path = self.create_file('leorgn.nc')
+        cli.run_qc_path(self.config, path, 'inplace')
+        assert not os.path.exists(path.replace('.nc', '.ncq'))
+        assert not os.path.exists(path.replace('.nc', '.ncml'))
+        digests = self.check_inplace(path, expected)
+
+        # the flags are found in the file again, so a rerun leaves them
+        with Dataset(path, 'a') as nc:
+            inplace_qc = InPlaceDatasetQC(nc, self.config)
+            # there's no NcML aggregation to read or write
+            assert inplace_qc.ncml is None
+            assert sorted(inplace_qc.find_ancillary_variables(
+                nc.variables['blue_green_algae'])) == FLAGS
+            assert inplace_qc.index.qc_parents[FLAGS[0]] == 'blue_green_algae'
+        cli.run_qc_path(self.config, path, 'inplace')
+        assert self.check_inplace(path, expected) == digests
+
+    def test_other_ancillary_variables(self):
+        path = self.create_file('leorgn.nc')
+        with Dataset(path, 'a') as nc:
+            nc.variables['blue_green_algae'].ancillary_variables = 'platform'
+        cli.run_qc_path(self.config, path, 'inplace')
+        with Dataset(path) as nc:
+            ancillary = nc.variables['blue_green_algae'].ancillary_variables
+            # the file's own ancillary variables are kept
+            assert ancillary.split()[0] == 'platform'
+            assert sorted(ancillary.split()[1:]) == FLAGS
+            inplace_qc = InPlaceDatasetQC(nc, self.config)
+            assert sorted(inplace_qc.find_ancillary_variables(
+                nc.variables['blue_green_algae'])) == FLAGS
+
+    def test_classic(self):
+        expected = self.sidecar_flags(self.create_file(
+            'sidecar.nc', file_format='NETCDF3_CLASSIC'))
+        path = self.create_file('leorgn.nc', file_format='NETCDF3_CLASSIC')
+        cli.run_qc_path(self.config, path, 'inplace')
+        self.check_inplace(path, expected)
+
+    def test_block_writes(self):
+        # the source file's time dimension is unlimited, unlike the .ncq's
+        self.addCleanup(setattr, qc, 'WRITE_BLOCK', qc.WRITE_BLOCK)
+        qc.WRITE_BLOCK = 7
+        for file_format in ('NETCDF4', 'NETCDF3_CLASSIC'):
+            expected = self.sidecar_flags(self.create_file(
+                'sidecar.nc', file_format=file_format))
+            path = self.create_file('leorgn.nc', file_format=file_format)
+            cli.run_qc_path(self.config, path, 'inplace')
+            self.check_inplace(path, expected)
+            with Dataset(path) as nc:
+                assert nc.dimensions['time'].isunlimited()
+                assert len(nc.dimensions['time']) == 60
+
+    def test_migrate(self):
+        paths = [self.create_file('leorgn.nc'), self.create_file('kept.nc')]
+        expected = self.sidecar_flags(paths[0])
+        self.sidecar_flags(paths[1])
+        with Dataset(paths[0].replace('.nc', '.ncq')) as qc_file:
+            digests = dict((name, getattr(qc_file.variables[name],
+                                          DIGEST_ATTR, None))
+                           for name in FLAGS)
+
+        assert migrate(paths[:1], chunk_size=7) == paths[:1]
+        assert not os.path.exists(paths[0].replace('.nc', '.ncq'))
+        assert not os.path.exists(paths[0].replace('.nc', '.ncml'))
+        assert self.check_inplace(paths[0], expected) == digests
+        # the migrated flags are up to date, so QC in place leaves them
+        cli.run_qc_path(self.config, paths[0], 'inplace')
+        assert self.check_inplace(paths[0], expected) == digests
+
+        assert migrate(paths[1:], remove=False) == paths[1:]
+        assert os.path.exists(paths[1].replace('.nc', '.ncq'))
+        assert os.path.exists(paths[1].replace('.nc', '.ncml'))
+        self.check_inplace(paths[1], expected)
+        # files without a QC file are skipped
+        assert migrate([self.create_file('new.nc')]) == []
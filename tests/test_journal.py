@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_journal.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli, run
+from glos_qartod.journal import RunJournal
+from glos_qartod.pipeline import run_pipeline
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'flat_line.low_reps': 2,
+            'flat_line.high_reps': 3, 'flat_line.epsilon': 0.001
+        }])
+        self.journal_path = os.path.join(self.tmpdir, 'journal.jsonl')
+        station_dir = os.path.join(self.tmpdir, 'blue_green_algae', 'leorgn')
+        os.makedirs(station_dir)
+        rng = np.random.RandomState(2)
+        self.paths = []
+        for i in range(3):
+            times = 1472601600 + 86400 * i + 600 * np.arange(30, dtype='f8')
+            self.paths.append(create_station_file(
+                os.path.join(station_dir, 'leorgn_{}.nc'.format(i)), times,
+                rng.uniform(-0.2, 1.2, 30)))
+
+    def records(self):
+        with open(self.journal_path) as f:
+            return [json.loads(line) for line in f
+                    if line.strip().endswith('}')]
+
+    def run_all(self, key=None):
+        journal = RunJournal(self.journal_path, key)
+        return [cli.run_qc_path(self.config, path, journal=journal)
+                for path in self.paths]
+
+    def test_resume(self):
+        assert self.run_all() == [True, True, True]
+        records = self.records()
+        assert [r['event'] for r in records if r['event'] != 'unit'] == \
+            ['start', 'done'] * 3
+        units = set((os.path.basename(r['file']), r['test'])
+                    for r in records if r['event'] == 'unit')
+        assert ('leorgn_0.nc', 'gross_range') in units
+        assert ('leorgn_2.nc', 'primary') in units
+        # unconfigured tests aren't run
+        assert ('leorgn_0.nc', 'spike') not in units
+
+        # a restart skips everything without opening the files
+        os.remove(self.paths[1].replace('.nc', '.ncq'))
+        assert self.run_all() == [False, False, False]
+        assert not os.path.exists(self.paths[1].replace('.nc', '.ncq'))
+        # unless the configuration changed
+        assert self.run_all(key='other') == [True, True, True]
+
+    def test_changed_file(self):
+        self.run_all()
+        with Dataset(self.paths[2], 'a') as nc:
+            nc.variables['blue_green_algae'][0] = 0.5
+        assert self.run_all() == [False, False, True]
+
+    def test_interrupted(self):
+        self.run_all()
+        journal = RunJournal(self.journal_path)
+        journal.start(self.paths[0])
+        # a run killed mid write leaves a partial record
+        with open(self.journal_path, 'a') as f:
+            f.write('{"event": "un')
+        journal = RunJournal(self.journal_path)
+        assert journal.is_interrupted(self.paths[0])
+        assert not journal.is_complete(self.paths[0])
+        assert journal.is_complete(self.paths[1])
+        assert self.run_all() == [True, False, False]
+        assert self.records()[-1]['event'] == 'done'
+        assert RunJournal(self.journal_path).is_complete(self.paths[0])
+
+    def test_run_subset(self):
+        qc_varnames = {'qartod_blue_green_algae_gross_range_flag'}
+        # nothing QC'd yet
+        assert sorted(run.find_files(self.tmpdir, qc_varnames, set())) == \
+            self.paths
+        self.run_all()
+        journal = RunJournal(self.journal_path)
+        journal.start(self.paths[1])
+        # the journal shows the interrupted file though its QC variables
+        # exist, and the rest are skipped even without a QC file
+        os.remove(self.paths[2].replace('.nc', '.ncq'))
+        assert run.find_files(self.tmpdir, qc_varnames, set(),
+                              RunJournal(self.journal_path)) == \
+            [self.paths[1]]
+
+    def test_pipeline(self):
+        journal = RunJournal(self.journal_path)
+        cli.run_qc_path(self.config, self.paths[0], journal=journal)
+        written = run_pipeline(self.config, self.paths, journal=journal)
+        assert written == self.paths[1:]
+        journal = RunJournal(self.journal_path)
+        assert all(journal.is_complete(path) for path in self.paths)
+        units = [r for r in self.records() if r['event'] == 'unit' and
+                 r['file'] == os.path.abspath(self.paths[2])]
+        assert set(r['test'] for r in units) == {'gross_range', 'flat_line'}
+        assert all(r['variable'] == 'blue_green_algae' for r in units)
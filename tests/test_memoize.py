@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_memoize.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.qc import DIGEST_ATTR, PENDING_DIGEST
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestMemoize(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'flat_line.low_reps': 2,
+            'flat_line.high_reps': 3, 'flat_line.epsilon': 0.001
+        }])
+        self.path = os.path.join(self.tmpdir, 'leorgn.nc')
+        self.qc_path = os.path.join(self.tmpdir, 'leorgn.ncq')
+        times = 1472601600 + 600 * np.arange(40, dtype='f8')
+        values = np.random.RandomState(5).uniform(-0.2, 1.2, 40)
+        create_station_file(self.path, times, values)
+
+    def run_qc(self):
+        with Dataset(self.path) as nc:
+            cli.run_qc(self.config, nc)
+
+    def tamper(self):
+        '''
+        Overwrites the first flag of each flag variable without touching the
+        digests, so a later run shows whether the flags were rewritten
+        '''
+        with Dataset(self.qc_path, 'a') as nc:
+            for test in ('gross_range', 'flat_line', 'primary'):
+                nc.variables['qartod_blue_green_algae_{}_flag'.format(
+                    test)][0] = 2
+
+    def first_flags(self):
+        with Dataset(self.qc_path) as nc:
+            return dict((test, int(ma.filled(nc.variables[
+                'qartod_blue_green_algae_{}_flag'.format(test)][0], 9)))
+                for test in ('gross_range', 'flat_line', 'primary'))
+
+    def digests(self):
+        with Dataset(self.qc_path) as nc:
+            return dict((name, getattr(ncvar, DIGEST_ATTR, None))
+                        for name, ncvar in nc.variables.items())
+
+    def test_unchanged_inputs_skipped(self):
+        self.run_qc()
+        digests = self.digests()
+        assert digests['qartod_blue_green_algae_gross_range_flag']
+        # unconfigured tests are not run and keep the reserved digest
+        assert digests['qartod_blue_green_algae_spike_flag'] == PENDING_DIGEST
+        self.tamper()
+        self.run_qc()
+        assert self.first_flags() == {'gross_range': 2, 'flat_line': 2,
+                                      'primary': 2}
+        assert self.digests() == digests
+
+    def test_changed_parameters(self):
+        self.run_qc()
+        self.tamper()
+        self.config['gross_range.sensor_max'] = 2
+        self.run_qc()
+        flags = self.first_flags()
+        assert flags['gross_range'] != 2
+        # flat line is unaffected, the primary flag depends on gross range
+        assert flags['flat_line'] == 2
+        assert flags['primary'] != 2
+
+    def test_changed_data(self):
+        self.run_qc()
+        self.tamper()
+        with Dataset(self.path, 'a') as nc:
+            nc.variables['blue_green_algae'][39] = 0.5
+        self.run_qc()
+        assert 2 not in self.first_flags().values()
+
+    def test_changed_attributes(self):
+        self.run_qc()
+        self.tamper()
+        with Dataset(self.path, 'a') as nc:
+            nc.variables['blue_green_algae'].scale_factor = 2.
+        self.run_qc()
+        assert 2 not in self.first_flags().values()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_metadata_index.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.qc import DatasetIndex, DatasetQC
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestDatasetIndex(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'leorgn.nc')
+        times = 1472601600 + 600 * np.arange(20, dtype='f8')
+        create_station_file(self.path, times, np.full(20, 0.5))
+        # a second sensor with the same standard_name
+        with Dataset(self.path, 'a') as nc:
+            ncvar = nc.createVariable('blue_green_algae_2', 'f8', ('time',),
+                                      fill_value=-9999.)
+            ncvar.standard_name = 'ysi_blue_green_algae'
+            ncvar.units = 'rfu'
+            ncvar[:] = np.full(20, 5.)
+        self.config = pd.DataFrame([
+            {'station_id': 'leorgn', 'variable': variable, 'units': 'rfu',
+             'gross_range.sensor_min': 0, 'gross_range.sensor_max': 1}
+            for variable in ('blue_green_algae', 'blue_green_algae_2')
+        ])
+
+    def gross_range_flags(self):
+        qc_path = self.path.replace('.nc', '.ncq')
+        with Dataset(qc_path) as nc:
+            return dict(
+                (varname, ma.filled(nc.variables[
+                    'qartod_{}_gross_range_flag'.format(varname)][:], 9))
+                for varname in ('blue_green_algae', 'blue_green_algae_2'))
+
+    def test_index(self):
+        with Dataset(self.path) as nc:
+            index = DatasetIndex(nc)
+            assert index.station_name == 'urn:ioos:station:glos:leorgn'
+            assert index.station_id == 'leorgn'
+            assert index.time.name == 'time'
+            assert index.time_units == 'seconds since 1970-01-01T00:00:00Z'
+            assert index.variables_by_standard_name[
+                'ysi_blue_green_algae'] == ['blue_green_algae',
+                                            'blue_green_algae_2']
+
+    def test_shared_standard_name(self):
+        for _ in range(2):
+            # the second run finds the parents through the NcML
+            with Dataset(self.path) as nc:
+                cli.run_qc(self.config, nc)
+            flags = self.gross_range_flags()
+            assert (flags['blue_green_algae'] == 1).all()
+            assert (flags['blue_green_algae_2'] == 4).all()
+
+    def test_parent_by_name(self):
+        with Dataset(self.path) as nc:
+            cli.run_qc(self.config, nc)
+        os.remove(self.path.replace('.nc', '.ncml'))
+        qc_path = self.path.replace('.nc', '.ncq')
+        with Dataset(self.path) as nc, Dataset(qc_path, 'a') as qc_file:
+            qc = DatasetQC(nc, qc_file, self.path.replace('.nc', '.ncml'),
+                           self.config)
+            qcvar = qc_file.variables['qartod_blue_green_algae_2_spike_flag']
+            assert qc.index.find_parent(qcvar).name == 'blue_green_algae_2'
+
+    def test_missing_platform(self):
+        with Dataset(self.path, 'a') as nc:
+            nc.platform = 'buoy'
+        with Dataset(self.path) as nc:
+            index = DatasetIndex(nc)
+            with self.assertRaises(ValueError):
+                index.get_station_name()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_multidim.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.multidim import column_flags
+from ioos_qartod.qc_tests import qc as qartod
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+import quantities as pq
+
+
+class TestMultidim(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'temperature',
+            'units': 'degC', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 25, 'gross_range.user_min': 2,
+            'gross_range.user_max': 20, 'rate_of_change.threshold': 30,
+            'spike.low_threshold': 2, 'spike.high_threshold': 5,
+            'flat_line.low_reps': 2, 'flat_line.high_reps': 4,
+            'flat_line.epsilon': 0.01
+        }])
+        rng = np.random.RandomState(7)
+        self.times = 1472601600 + 600 * np.arange(60, dtype='f8')
+        self.values = ma.masked_array(
+            np.round(rng.uniform(-2, 27, (60, 5)) * 2) / 2)
+        self.values[10:16, 1] = 12.
+        self.values[rng.rand(60, 5) < 0.15] = ma.masked
+        self.values[:, 4] = ma.masked
+        self.values[[0, 1, 2], 3] = ma.masked
+
+    def expected_flags(self, column):
+        '''
+        Returns the flags of the 1-D tests run over the valid values of a
+        column
+        '''
+        valid = ~ma.getmaskarray(column)
+        values = ma.getdata(column)[valid]
+        dates = np.array(self.times[valid] * 1000, dtype='datetime64[ms]')
+        expected = {
+            'gross_range': qartod.range_check(values, [0, 25], [2, 20]),
+            'rate_of_change': qartod.rate_of_change_check(dates, values,
+                                                          30 / pq.hour),
+            'spike': qartod.spike_check(values, 2, 5),
+            'flat_line': qartod.flat_line_check(values, 2, 4, 0.01)
+        }
+        for test, flags in expected.items():
+            full = np.full(column.shape, 9, dtype=np.int8)
+            full[valid] = flags
+            expected[test] = full
+        return expected
+
+    def test_column_flags(self):
+        dates = np.array(self.times * 1000, dtype='datetime64[ms]')
+        params = {
+            'gross_range': {'sensor_span': [0, 25], 'user_span': [2, 20]},
+            'rate_of_change': {'thresh_val': 30},
+            'spike': {'low_thresh': 2, 'high_thresh': 5},
+            'flat_line': {'low_reps': 2, 'high_reps': 4, 'eps': 0.01}
+        }
+        valid = ~ma.getmaskarray(self.values)
+        for test, test_params in params.items():
+            flags = column_flags(test, test_params, dates,
+                                 ma.getdata(self.values), valid)
+            assert flags.shape == self.values.shape
+            for col in range(4):
+                np.testing.assert_array_equal(
+                    flags[:, col], self.expected_flags(self.values[:, col])[test],
+                    '{} column {}'.format(test, col))
+            assert (flags[:, 4] == 9).all()
+
+    def test_netcdf_2d(self):
+        path = os.path.join(self.tmpdir, 'thermistor.nc')
+        create_station_file(path, self.times, np.zeros(60))
+        with Dataset(path, 'a') as nc:
+            nc.createDimension('depth', 5)
+            ncvar = nc.createVariable('temperature', 'f4', ('time', 'depth'),
+                                      fill_value=np.float32(-9999.))
+            ncvar.standard_name = 'sea_water_temperature'
+            ncvar.units = 'degC'
+            ncvar[:] = self.values
+        with Dataset(path) as nc:
+            cli.run_qc(self.config, nc)
+
+        with Dataset(path.replace('.nc', '.ncq')) as nc:
+            flags = dict(
+                (test, ma.filled(nc.variables[
+                    'qartod_temperature_{}_flag'.format(test)][:], 9))
+                for test in ('gross_range', 'rate_of_change', 'spike',
+                             'flat_line', 'primary'))
+        # the last column is entirely missing
+        for flags_2d in flags.values():
+            assert flags_2d.shape == (60, 5)
+            assert (flags_2d[:, 4] == 9).all()
+        for col in range(4):
+            expected = self.expected_flags(self.values[:, col])
+            for test, test_flags in expected.items():
+                np.testing.assert_array_equal(flags[test][:, col], test_flags,
+                                              '{} column {}'.format(test, col))
+            np.testing.assert_array_equal(
+                flags['primary'][:, col],
+                qartod.qc_compare([np.asarray(f, dtype=np.int8)
+                                   for f in expected.values()]))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_neighbors.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.config import CompiledConfig
+from glos_qartod.neighbors import (NeighborIndex, align, neighbor_check,
+                                   needs_neighbors)
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestNeighbors(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': '*', 'variable': 'water_temperature',
+            'units': 'degC', 'neighbor.k': 2,
+            'neighbor.suspect_threshold': 2, 'neighbor.fail_threshold': 5,
+            'neighbor.time_tolerance': 900, 'neighbor.max_distance': 100
+        }])
+        self.times = 1472601600 + 600 * np.arange(30, dtype='f8')
+        # leorgn and two stations within 100 km, and a distant station
+        self.stations = [
+            ('leorgn', 41.672, -83.290, self.times),
+            ('tolcrib', 41.702, -83.261, self.times + 300),
+            ('ohio', 41.827, -83.194, self.times[::2]),
+            ('45005', 47.0, -87.0, self.times),
+        ]
+
+    def create_files(self, leorgn_values):
+        paths = []
+        for station_id, lat, lon, times in self.stations:
+            path = os.path.join(self.tmpdir, '{}.nc'.format(station_id))
+            values = (leorgn_values if station_id == 'leorgn'
+                      else np.full(times.size, 20.))
+            if station_id == '45005':
+                values = np.full(times.size, 5.)
+            create_station_file(path, times, values, station_id=station_id,
+                                variable='water_temperature', units='degC',
+                                standard_name='sea_water_temperature',
+                                lat=lat, lon=lon)
+            paths.append(path)
+        return paths
+
+    def test_align(self):
+        ref_times = np.array([0, 10, 20, 40])
+        ref_values = np.array([1., 2., 3., 4.])
+        times = np.array([-3, 4, 6, 25, 31, 44, 50])
+        np.testing.assert_array_equal(
+            align(times, ref_times, ref_values, 4),
+            [1, 1, 2, np.nan, np.nan, 4, np.nan])
+        np.testing.assert_array_equal(
+            align(times, ref_times[:1], ref_values[:1], 4),
+            [1, 1, np.nan, np.nan, np.nan, np.nan, np.nan])
+
+    def test_neighbor_check(self):
+        neighbor_values = np.array([[10., 10., np.nan, 10., np.nan],
+                                    [11., 20., np.nan, np.nan, np.nan],
+                                    [12., 30., 10., 10., np.nan]])
+        flags = neighbor_check(np.array([11., 23., 16., 10., 10.]),
+                               neighbor_values, 2, 5)
+        np.testing.assert_array_equal(flags, [1, 3, 4, 1, 2])
+        flags = neighbor_check(np.array([1., 2.]), np.empty((0, 2)), 2)
+        np.testing.assert_array_equal(flags, [2, 2])
+
+    def test_nearest(self):
+        index = NeighborIndex(self.create_files(np.full(30, 20.)))
+        assert index.nearest('leorgn', 3) == ['tolcrib', 'ohio', '45005']
+        assert index.nearest('leorgn', 1) == ['tolcrib']
+        assert index.nearest('leorgn', 3, max_distance=100) == ['tolcrib',
+                                                                'ohio']
+        assert index.nearest('45005', 2, max_distance=100) == []
+        assert index.nearest('unknown', 2) == []
+
+    def test_needs_neighbors(self):
+        assert needs_neighbors(CompiledConfig(self.config))
+        config = self.config.copy()
+        config['neighbor.suspect_threshold'] = np.nan
+        assert not needs_neighbors(CompiledConfig(config))
+
+    def test_run(self):
+        values = ma.masked_array(np.full(30, 20.5))
+        values[10:20] = 23.
+        values[20:] = 30.
+        values[5] = ma.masked
+        paths = self.create_files(values)
+        index = NeighborIndex(paths)
+        reads = []
+        read_series = index._read_series
+
+        def counting(*args):
+            reads.append(args[0])
+            return read_series(*args)
+        index._read_series = counting
+
+        for path in paths:
+            with Dataset(path) as nc:
+                cli.run_qc(self.config, nc, neighbors=index)
+        # each station is read once however many times it is a neighbor
+        assert sorted(reads) == ['leorgn', 'ohio', 'tolcrib']
+
+        with Dataset(paths[0].replace('.nc', '.ncq')) as nc:
+            flags = ma.filled(
+                nc.variables['qartod_water_temperature_neighbor_flag'][:], 9)
+        expected = np.ones(30, dtype=np.int8)
+        expected[10:20] = 3
+        expected[20:] = 4
+        expected[5] = 9
+        np.testing.assert_array_equal(flags, expected)
+
+        # the distant station has no neighbors within 100 km
+        with Dataset(paths[3].replace('.nc', '.ncq')) as nc:
+            flags = nc.variables['qartod_water_temperature_neighbor_flag'][:]
+        assert (flags == 2).all()
+
+    def test_without_index(self):
+        paths = self.create_files(np.full(30, 20.))
+        with Dataset(paths[0]) as nc:
+            cli.run_qc(self.config, nc)
+        with Dataset(paths[0].replace('.nc', '.ncq')) as nc:
+            flags = ma.filled(
+                nc.variables['qartod_water_temperature_neighbor_flag'][:], 9)
+        assert (flags == 9).all()
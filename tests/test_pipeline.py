@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_pipeline.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.pipeline import run_pipeline
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestPipeline(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'rate_of_change.threshold': 1,
+            'flat_line.low_reps': 2, 'flat_line.high_reps': 3,
+            'flat_line.epsilon': 0.001
+        }])
+        rng = np.random.RandomState(11)
+        self.files = []
+        for i in range(5):
+            times = 1472601600 + 86400 * i + 600 * np.arange(60, dtype='f8')
+            values = ma.masked_array(rng.uniform(-0.2, 1.2, 60))
+            values[rng.rand(60) < 0.1] = ma.masked
+            self.files.append((times, values))
+
+    def create_files(self, dirname):
+        os.mkdir(os.path.join(self.tmpdir, dirname))
+        paths = []
+        for i, (times, values) in enumerate(self.files):
+            paths.append(create_station_file(
+                os.path.join(self.tmpdir, dirname, 'leorgn_{}.nc'.format(i)),
+                times, values))
+        return paths
+
+    def read_flags(self, path):
+        with Dataset(path.replace('.nc', '.ncq')) as nc:
+            return dict((name, ma.filled(ncvar[:], 9))
+                        for name, ncvar in nc.variables.items())
+
+    def test_matches_sequential(self):
+        sequential = self.create_files('sequential')
+        for path in sequential:
+            with Dataset(path) as nc:
+                cli.run_qc(self.config, nc)
+        pipelined = self.create_files('pipelined')
+        written = run_pipeline(self.config, pipelined, queue_size=1)
+        assert written == pipelined
+        for seq_path, pipe_path in zip(sequential, pipelined):
+            expected = self.read_flags(seq_path)
+            result = self.read_flags(pipe_path)
+            assert sorted(result) == sorted(expected)
+            for name in expected:
+                np.testing.assert_array_equal(result[name], expected[name],
+                                              name)
+            with open(seq_path.replace('.nc', '.ncml'), 'rb') as f:
+                expected_ncml = f.read()
+            with open(pipe_path.replace('.nc', '.ncml'), 'rb') as f:
+                ncml = f.read()
+            assert ncml == expected_ncml
+
+    def test_failed_files_skipped(self):
+        paths = self.create_files('files')
+        broken = os.path.join(self.tmpdir, 'files', 'broken.nc')
+        with open(broken, 'w') as f:
+            f.write('not netCDF')
+        empty = create_station_file(
+            os.path.join(self.tmpdir, 'files', 'empty.nc'), [], [])
+        written = run_pipeline(self.config,
+                               paths[:2] + [broken, empty] + paths[2:])
+        assert written == paths[:2] + [empty] + paths[2:]
+        for path in paths:
+            flags = self.read_flags(path)
+            assert 'qartod_blue_green_algae_primary_flag' in flags
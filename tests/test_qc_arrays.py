@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_qc_arrays.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.qc import qc_arrays
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestQCArrays(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'rate_of_change.threshold': 1,
+            'flat_line.low_reps': 2, 'flat_line.high_reps': 3,
+            'flat_line.epsilon': 0.001
+        }])
+        self.times = 1472601600 + 600 * np.arange(60, dtype='f8')
+        self.values = ma.masked_array(np.linspace(0, 1, 60))
+        self.values[13:19] = 0.5
+        self.values[20] = 5
+        self.values[41] = ma.masked
+
+    def test_matches_netcdf_qc(self):
+        path = create_station_file(os.path.join(self.tmpdir, 'leorgn.nc'),
+                                   self.times, self.values)
+        with Dataset(path) as nc:
+            cli.run_qc(self.config, nc)
+        flags = qc_arrays(self.config, 'leorgn', 'blue_green_algae',
+                          self.times, self.values, units='rfu',
+                          time_units='seconds since 1970-01-01T00:00:00Z')
+        assert list(flags) == ['flat_line', 'gross_range', 'rate_of_change',
+                               'primary']
+        with Dataset(path.replace('.nc', '.ncq')) as qc_file:
+            for test, test_flags in flags.items():
+                qcvar = qc_file.variables[
+                    'qartod_blue_green_algae_{}_flag'.format(test)]
+                np.testing.assert_array_equal(test_flags,
+                                              ma.filled(qcvar[:], 9))
+
+    def test_pandas_input(self):
+        frame = pd.DataFrame({
+            'time': pd.to_datetime(self.times, unit='s'),
+            'value': ma.filled(self.values, np.nan)
+        })
+        flags = qc_arrays(self.config, 'urn:ioos:station:glos:leorgn',
+                          'blue_green_algae', frame['time'], frame['value'])
+        assert flags['gross_range'][20] == 4
+        assert flags['primary'][20] == 4
+        assert flags['primary'][41] == 9
+        assert flags['primary'].dtype == np.int8
+
+    def test_unit_conversion(self):
+        config = self.config.copy()
+        config['variable'] = 'temperature'
+        config['units'] = 'degC'
+        config['gross_range.sensor_max'] = 30
+        flags = qc_arrays(config, 'leorgn', 'temperature',
+                          pd.to_datetime(self.times[:3], unit='s'),
+                          np.array([273.15, 300.15, 310.15]), units='K')
+        np.testing.assert_array_equal(flags['gross_range'], [1, 1, 4])
+
+    def test_unconfigured_variable(self):
+        with self.assertRaises(KeyError):
+            qc_arrays(self.config, 'leorgn', 'dissolved_oxygen', self.times,
+                      self.values)
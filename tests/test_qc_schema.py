@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_qc_schema.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.qc import (DIGEST_ATTR, DIGEST_LENGTH, PENDING_DIGEST,
+                             DatasetQC, changed_attributes)
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestQCSchema(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1
+        }])
+        self.path = os.path.join(self.tmpdir, 'leorgn.nc')
+        self.qc_path = os.path.join(self.tmpdir, 'leorgn.ncq')
+        times = 1472601600 + 600 * np.arange(20, dtype='f8')
+        values = np.random.RandomState(3).uniform(-0.2, 1.2, 20)
+        create_station_file(self.path, times, values)
+
+    def run_qc(self, events=None):
+        with Dataset(self.path) as nc:
+            qc_file = cli.create_or_open_qc_file(self.qc_path, nc.dimensions)
+            try:
+                qc = DatasetQC(nc, qc_file, os.path.join(self.tmpdir,
+                                                         'leorgn.ncml'),
+                               self.config)
+                if events is not None:
+                    define_qc_variables = qc.define_qc_variables
+                    write_qc = qc.write_qc
+
+                    def define(ncvariables):
+                        events.append('define')
+                        qcvarnames = define_qc_variables(ncvariables)
+                        events.append(dict(
+                            (name, getattr(qc_file.variables[name],
+                                           DIGEST_ATTR, None))
+                            for names in qcvarnames.values()
+                            for name in names))
+                        return qcvarnames
+
+                    def write(task):
+                        events.append('write')
+                        return write_qc(task)
+                    qc.define_qc_variables = define
+                    qc.write_qc = write
+                cli.apply_dataset_qc(qc)
+                return dict(
+                    (name, changed_attributes(qc_file.variables[name], attrs))
+                    for name, (dims, attrs) in
+                    qc.qc_schema(nc.variables['blue_green_algae']).items())
+            finally:
+                qc_file.close()
+
+    def test_defined_before_writes(self):
+        events = []
+        self.run_qc(events)
+        assert events[0] == 'define'
+        assert events.count('define') == 1
+        assert 'write' in events
+
+    def test_schema(self):
+        self.run_qc()
+        with Dataset(self.path) as nc, Dataset(self.qc_path) as qc_nc:
+            qc = DatasetQC(nc, qc_nc, None, self.config)
+            schema = qc.qc_schema(nc.variables['blue_green_algae'])
+        assert list(schema)[-1] == 'qartod_blue_green_algae_primary_flag'
+        assert 'qartod_monotonic_pressure_flag' not in schema
+        dims, attrs = schema['qartod_blue_green_algae_gross_range_flag']
+        assert dims == ('time',)
+        assert attrs['qartod_test'] == 'gross_range'
+        assert attrs['flag_values'].dtype == np.int8
+        assert 'qartod_test' not in \
+            schema['qartod_blue_green_algae_primary_flag'][1]
+
+    def test_unchanged_attributes_skipped(self):
+        self.run_qc()
+        # every attribute matches the schema after a run
+        changed = self.run_qc()
+        assert not any(changed.values())
+        name = 'qartod_blue_green_algae_flat_line_flag'
+        with Dataset(self.qc_path, 'a') as nc:
+            nc.variables[name].long_name = 'Out of date'
+            nc.variables[name].flag_values = np.array([1, 2, 3, 4, 9],
+                                                      dtype=np.int16)
+        with Dataset(self.path) as nc, Dataset(self.qc_path) as qc_nc:
+            schema = DatasetQC(nc, qc_nc, None, self.config).qc_schema(
+                nc.variables['blue_green_algae'])
+            changed = changed_attributes(qc_nc.variables[name],
+                                         schema[name][1])
+        assert list(changed) == ['long_name', 'flag_values']
+        changed = self.run_qc()
+        assert not any(changed.values())
+        with Dataset(self.qc_path) as nc:
+            assert nc.variables[name].flag_values.dtype == np.int8
+
+    def test_digest_reserved(self):
+        events = []
+        self.run_qc(events)
+        # every flag variable has a digest once defined, before any writes
+        reserved = events[1]
+        assert set(reserved.values()) == set([PENDING_DIGEST])
+        with Dataset(self.qc_path) as nc:
+            digests = dict((name, getattr(nc.variables[name], DIGEST_ATTR))
+                           for name in reserved)
+        written = [digest for digest in digests.values()
+                   if digest != PENDING_DIGEST]
+        assert written
+        assert all(len(digest) <= DIGEST_LENGTH for digest in written)
+
+        # a rerun keeps the digests recorded, so the flags are up to date
+        events = []
+        self.run_qc(events)
+        assert events[1] == digests
+        assert 'write' not in events
+        with Dataset(self.qc_path) as nc:
+            for name, digest in digests.items():
+                assert getattr(nc.variables[name], DIGEST_ATTR) == digest
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_read_path.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod.cli import create_or_open_qc_file
+from glos_qartod.qc import DatasetQC, open_raw
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestReadPath(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([
+            {'station_id': 'leorgn', 'variable': 'blue_green_algae',
+             'units': 'rfu'},
+            {'station_id': 'leorgn', 'variable': 'temperature', 'units': 'K'}
+        ])
+
+    def create_file(self, file_format):
+        path = os.path.join(self.tmpdir, '{}.nc'.format(file_format))
+        times = ma.masked_array(1472601600 + 600 * np.arange(50, dtype='f8'))
+        times[10] = ma.masked
+        values = ma.masked_array(np.linspace(0, 1, 50))
+        values[[3, 7, 8]] = ma.masked
+        create_station_file(path, times, values, file_format=file_format)
+        with Dataset(path, 'a') as nc:
+            nc.variables['blue_green_algae'][12] = np.nan
+            # packed shorts with a valid range, read through the scaling
+            temperature = nc.createVariable('temperature', 'i2', ('time',),
+                                            fill_value=np.int16(-999))
+            temperature.scale_factor = 0.01
+            temperature.add_offset = 10.
+            temperature.valid_min = np.int16(-500)
+            temperature.units = 'degC'
+            temperature_values = ma.masked_array(np.linspace(-10, 20, 50))
+            temperature_values[5] = ma.masked
+            temperature_values[6] = -30
+            temperature[:] = temperature_values
+        return path
+
+    def check_file(self, path):
+        with Dataset(path) as nc:
+            qc_file = create_or_open_qc_file(path + 'q', nc.dimensions)
+            self.addCleanup(qc_file.close)
+            qc = DatasetQC(nc, qc_file, path + 'l', self.config)
+            for varname in ('blue_green_algae', 'temperature',
+                            'blue_green_algae'):
+                ncvar = nc.variables[varname]
+                times, values, mask = qc.get_unmasked(ncvar)
+                expected_times = nc.variables['time'][:]
+                expected_values = ncvar[:]
+                expected_mask = (ma.getmaskarray(expected_times) |
+                                 ma.getmaskarray(expected_values) |
+                                 np.isnan(ma.getdata(expected_values)))
+                np.testing.assert_array_equal(mask, expected_mask)
+                np.testing.assert_allclose(
+                    times, ma.getdata(expected_times)[~expected_mask])
+                expected_values = ma.getdata(expected_values)[~expected_mask]
+                if varname == 'temperature':
+                    expected_values = expected_values + 273.15
+                np.testing.assert_allclose(values, expected_values)
+                assert values.dtype == np.float64
+
+    def test_netcdf4(self):
+        self.check_file(self.create_file('NETCDF4'))
+
+    def test_classic(self):
+        self.check_file(self.create_file('NETCDF3_CLASSIC'))
+
+    def test_classic_memory_mapped(self):
+        try:
+            import scipy.io  # noqa
+        except ImportError:
+            self.skipTest("scipy is not installed")
+        path = self.create_file('NETCDF3_64BIT_OFFSET')
+        with Dataset(path) as nc:
+            with open_raw(nc) as read:
+                times = read(nc.variables['time'])
+                # a view of the mapped file rather than a copy
+                assert not times.flags['OWNDATA']
+                del times
+
+    def test_series_reused(self):
+        path = self.create_file('NETCDF4')
+        with Dataset(path) as nc:
+            qc_file = create_or_open_qc_file(path + 'q', nc.dimensions)
+            self.addCleanup(qc_file.close)
+            qc = DatasetQC(nc, qc_file, path + 'l', self.config)
+            ncvar = nc.variables['blue_green_algae']
+            first = qc.get_unmasked(ncvar)
+            assert qc.get_unmasked(ncvar)[1] is first[1]
+            qc.get_unmasked(nc.variables['temperature'])
+            # the buffers are reused for the next variable
+            assert qc.get_buffer('values', 1).base is first[1].base
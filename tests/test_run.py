@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_run.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from glos_qartod import run
+from glos_qartod.config import CompiledConfig
+from glos_qartod.journal import config_key
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class TestRun(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.conf = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': -1,
+            'gross_range.sensor_max': 20, 'rate_of_change.threshold': 1,
+            'spike.low_threshold': np.nan
+        }])
+
+    def create_file(self, name, size):
+        path = os.path.join(self.tmpdir, 'blue_green_algae', 'leorgn', name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        times = 1472601600 + 600 * np.arange(size, dtype='f8')
+        return create_station_file(path, times, np.zeros(size))
+
+    def test_configured_tests(self):
+        row = self.conf.iloc[0]
+        assert run.configured_tests(row) == {'gross_range', 'rate_of_change'}
+
+    def test_climatology(self):
+        climatology = pd.DataFrame([
+            {'station_id': '*', 'variable': 'blue_green_algae',
+             'period': 'month', 'start': 1, 'end': 12, 'min': 0, 'max': 5},
+            {'station_id': 'leorgn', 'variable': 'temperature',
+             'period': 'month', 'start': 1, 'end': 12, 'min': 0, 'max': 25}])
+        row = self.conf.iloc[0]
+        assert run.configured_tests(row, climatology) == \
+            {'gross_range', 'rate_of_change', 'climatology'}
+        assert run.configured_tests(row, climatology.iloc[1:]) == \
+            {'gross_range', 'rate_of_change'}
+
+        # a QC file written before the climatology was configured
+        path = self.create_file('a.nc', 10)
+        with Dataset(path.replace('.nc', '.ncq'), 'w') as nc:
+            nc.createDimension('time', 10)
+            for test in ('gross_range', 'rate_of_change'):
+                nc.createVariable('qartod_blue_green_algae_{}_flag'.format(
+                    test), 'i1', ('time',))
+        assert run.qc_subset(self.tmpdir, self.conf, {}) == set()
+        assert run.qc_subset(self.tmpdir, self.conf, {},
+                             climatology=climatology) == {path}
+        jobs, _ = run.plan([path], self.conf, climatology=climatology)
+        assert jobs == [(10 * 3, path)]
+
+    def test_estimate_cost(self):
+        path = self.create_file('a.nc', 50)
+        cost = run.estimate_cost(path, CompiledConfig(self.conf))
+        assert cost == 50 * 2
+
+    def test_schedule(self):
+        # LPT puts 7 and 3 together, 5 and 4 together
+        assert run.schedule([3, 5, 7, 4], 2) == 10
+        assert run.schedule([3, 5, 7, 4], 1) == 19
+        assert run.schedule([], 4) == 0
+
+    def test_plan(self):
+        small = self.create_file('small.nc', 10)
+        large = self.create_file('large.nc', 100)
+        files = run.qc_subset(self.tmpdir, self.conf, {})
+        assert files == {small, large}
+        jobs, makespan = run.plan(files, self.conf, workers=2)
+        assert [f for _, f in jobs] == [large, small]
+        assert makespan == 200
+
+    def test_job_id(self):
+        path = self.create_file('a.nc', 10)
+        conf_file = os.path.join(self.tmpdir, 'config.csv')
+        self.conf.to_csv(conf_file, index=False)
+        jid = run.job_id(conf_file, path)
+        assert jid.startswith('qartod-')
+        assert run.job_id(conf_file, path) == jid
+        assert run.job_id(conf_file,
+                          self.create_file('b.nc', 10)) != jid
+        # a new version of the config
+        self.conf['gross_range.sensor_max'] = 30
+        self.conf.to_csv(conf_file, index=False)
+        assert run.job_id(conf_file, path) != jid
+        jid = run.job_id(conf_file, path)
+        # a new version of the file
+        os.utime(path, (0, 0))
+        assert run.job_id(conf_file, path) != jid
+        # the config key read once for a run gives the same IDs
+        jid = run.job_id(conf_file, path)
+        assert run.job_id(conf_file, path, config_key(conf_file)) == jid
+        assert run.job_id(conf_file, path, 'other') != jid
+
+    def queue(self):
+        from rq import Queue
+        return Queue(connection=fakeredis.FakeStrictRedis())
+
+    @skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_enqueue_qc(self):
+        q = self.queue()
+        path = self.create_file('a.nc', 10)
+        conf_file = os.path.join(self.tmpdir, 'config.csv')
+        self.conf.to_csv(conf_file, index=False)
+        key = config_key(conf_file)
+        job = run.enqueue_qc(q, conf_file, path, conf_key=key,
+                             journal='journal.jsonl')
+        assert job.id == run.job_id(conf_file, path)
+        assert job.args == (conf_file, path)
+        assert job.kwargs == {'journal': 'journal.jsonl'}
+        # finished results are kept as long as the latest job IDs
+        assert job.result_ttl == run.LATEST_JOB_TTL
+        latest = [k for k in q.connection.keys()
+                  if k.decode('utf-8').startswith(run.LATEST_JOB_PREFIX)]
+        assert len(latest) == 1
+        assert q.connection.get(latest[0]).decode('utf-8') == job.id
+        assert 0 < q.connection.ttl(latest[0]) <= run.LATEST_JOB_TTL
+
+        # the same job queued, running or finished isn't enqueued again
+        for status in ('queued', 'started', 'finished'):
+            job.set_status(status)
+            assert run.enqueue_qc(q, conf_file, path, conf_key=key) is None
+        assert len(q) == 1
+
+        # a failed job is deleted and enqueued again
+        job.set_status('failed')
+        retried = run.enqueue_qc(q, conf_file, path, conf_key=key)
+        assert retried.id == job.id
+        assert retried.get_status() == 'queued'
+        assert retried.kwargs == {}
+
+    @skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_enqueue_qc_coalesces(self):
+        from rq.job import Job
+        q = self.queue()
+        path = self.create_file('a.nc', 10)
+        conf_file = os.path.join(self.tmpdir, 'config.csv')
+        self.conf.to_csv(conf_file, index=False)
+        first = run.enqueue_qc(q, conf_file, path)
+        # a queued job of an earlier version of the file is replaced
+        os.utime(path, (0, 0))
+        second = run.enqueue_qc(q, conf_file, path)
+        assert second.id != first.id
+        assert not Job.exists(first.id, connection=q.connection)
+        assert q.job_ids == [second.id]
+
+        # a job already started may have read the file, so it is kept
+        second.set_status('started')
+        os.utime(path, (10, 10))
+        third = run.enqueue_qc(q, conf_file, path)
+        assert Job.exists(second.id, connection=q.connection)
+        assert third.id not in (first.id, second.id)
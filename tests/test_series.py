@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_series.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.series import StationSeries, context_size
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestSeries(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'rate_of_change.threshold': 1,
+            'flat_line.low_reps': 2, 'flat_line.high_reps': 3,
+            'flat_line.epsilon': 0.001
+        }])
+        self.times = 1472601600 + 600 * np.arange(40, dtype='f8')
+        self.values = np.linspace(0, 1, 40)
+        # a flat line straddling the file boundary and a jump just after it
+        self.values[17:23] = 0.5
+        self.values[23] = 5
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def flags(self, nc_path, test):
+        qc_path = nc_path.rsplit('.', 1)[0] + '.ncq'
+        with Dataset(qc_path) as nc:
+            varname = 'qartod_blue_green_algae_{}_flag'.format(test)
+            return nc.variables[varname][:]
+
+    def test_context_size(self):
+        assert context_size('flat_line', {'high_reps': 5}) == (5, 0)
+        assert context_size('spike', {}) == (1, 1)
+        assert context_size('gross_range', {}) == (0, 0)
+
+    def test_order(self):
+        second = create_station_file(self.path('b.nc'), self.times[20:],
+                                     self.values[20:])
+        first = create_station_file(self.path('a.nc'), self.times[:20],
+                                    self.values[:20])
+        series = StationSeries([second, first])
+        assert series.paths == [first, second]
+        assert series.neighbours(first) == ([], [second])
+        assert series.neighbours(second) == ([first], [])
+
+    def test_series_matches_combined(self):
+        combined = create_station_file(self.path('combined.nc'), self.times,
+                                       self.values)
+        with Dataset(combined) as nc:
+            cli.run_qc(self.config, nc)
+
+        os.makedirs(self.path('split'))
+        parts = [
+            create_station_file(self.path('split/a.nc'), self.times[:20],
+                                self.values[:20]),
+            create_station_file(self.path('split/b.nc'), self.times[20:],
+                                self.values[20:])
+        ]
+        cli.run_qc_series(self.config, parts)
+
+        for test in ('rate_of_change', 'flat_line'):
+            expected = self.flags(combined, test)
+            result = np.concatenate([self.flags(p, test) for p in parts])
+            np.testing.assert_array_equal(result, expected)
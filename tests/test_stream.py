@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_stream.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod.qc import qc_arrays
+from glos_qartod.stream import StreamQC, process_lines
+
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestStreamQC(TestCase):
+
+    def setUp(self):
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'gross_range.user_min': 0.1,
+            'gross_range.user_max': 0.9, 'rate_of_change.threshold': 20,
+            'spike.low_threshold': 0.1, 'spike.high_threshold': 0.3,
+            'flat_line.low_reps': 2, 'flat_line.high_reps': 4,
+            'flat_line.epsilon': 0.01
+        }])
+        rng = np.random.RandomState(1)
+        self.times = 1472601600 + np.cumsum(rng.randint(1, 1200, 80))
+        self.values = rng.uniform(-0.2, 1.2, 80)
+        self.values[10:17] = 0.5
+        self.values[30] = 0.9
+
+    def observations(self):
+        for i, (time, value) in enumerate(zip(self.times, self.values)):
+            yield {'station_id': 'leorgn', 'variable': 'blue_green_algae',
+                   'time': float(time), 'value': float(value), 'id': i}
+
+    def stream_flags(self, engine, checkpoint_every=None):
+        '''
+        Streams the observations and returns the final flags of each,
+        restoring a new engine from a checkpoint every `checkpoint_every`
+        observations
+        '''
+        records = {}
+        for observation in self.observations():
+            for record in engine.process(observation):
+                records[record['id']] = record
+            if checkpoint_every and observation['id'] % checkpoint_every == 0:
+                checkpoint = json.loads(json.dumps(engine.checkpoint()))
+                engine = StreamQC(self.config)
+                engine.restore(checkpoint)
+        return records
+
+    def test_matches_batch_tests(self):
+        expected = qc_arrays(self.config, 'leorgn', 'blue_green_algae',
+                             np.array(self.times * 1000,
+                                      dtype='datetime64[ms]'),
+                             self.values)
+        primary = expected.pop('primary')
+        assert set(expected) == {'gross_range', 'rate_of_change', 'spike',
+                                 'flat_line'}
+        for checkpoint_every in (None, 7):
+            records = self.stream_flags(StreamQC(self.config),
+                                        checkpoint_every)
+            for test, flags in expected.items():
+                np.testing.assert_array_equal(
+                    [records[i]['flags'][test] for i in range(80)], flags,
+                    test)
+            np.testing.assert_array_equal(
+                [records[i]['primary'] for i in range(80)], primary)
+
+    def test_spike_update(self):
+        engine = StreamQC(self.config)
+        observation = {'station_id': 'leorgn', 'variable': 'blue_green_algae'}
+        for time, value in ((0, 0.2), (600, 0.9)):
+            records = engine.process(dict(observation, time=time,
+                                          value=value))
+        assert len(records) == 1
+        assert records[0]['flags']['spike'] == 1
+        records = engine.process(dict(observation, time=1200, value=0.2))
+        assert len(records) == 2
+        assert records[0]['update'] and records[0]['time'] == 600
+        assert records[0]['flags']['spike'] == 4
+        assert records[0]['primary'] == 4
+        assert 'update' not in records[1]
+
+    def test_missing_and_unconfigured(self):
+        engine = StreamQC(self.config)
+        record, = engine.process({'station_id': 'leorgn',
+                                  'variable': 'blue_green_algae',
+                                  'time': '2016-08-31T00:00:00Z',
+                                  'value': None})
+        assert set(record['flags'].values()) == {9}
+        assert record['primary'] == 9
+        record, = engine.process({'station_id': 'leorgn',
+                                  'variable': 'dissolved_oxygen',
+                                  'time': 0, 'value': 1.})
+        assert record['flags'] == {}
+        assert record['primary'] == 2
+
+    def test_user_span_only(self):
+        # gross range without a sensor span can't be run, which leaves the
+        # other tests of the series running
+        config = self.config.drop(columns=['gross_range.sensor_min',
+                                           'gross_range.sensor_max'])
+        engine = StreamQC(config)
+        observation = {'station_id': 'leorgn', 'variable': 'blue_green_algae'}
+        for time, value in ((0, 0.2), (600, 0.9), (1200, 0.2)):
+            records = engine.process(dict(observation, time=time,
+                                          value=value))
+        assert records[0]['flags']['spike'] == 4
+        assert records[0]['primary'] == 4
+        flags = records[1]['flags']
+        assert flags['gross_range'] == 9
+        assert set(flags) == {'gross_range', 'rate_of_change', 'spike',
+                              'flat_line'}
+
+    def test_process_lines_checkpoint(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        checkpoint_path = os.path.join(tmpdir, 'checkpoint.json')
+        lines = [json.dumps(o) for o in self.observations()]
+        output = []
+        process_lines(StreamQC(self.config), lines[:40] + ['not json'],
+                      output.append, checkpoint_path, checkpoint_every=10)
+        engine = StreamQC(self.config)
+        engine.load_checkpoint(checkpoint_path)
+        process_lines(engine, lines[40:], output.append)
+        records = {}
+        for line in output:
+            record = json.loads(line)
+            records[record['id']] = record
+        expected = self.stream_flags(StreamQC(self.config))
+        assert records == expected
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_summary.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli
+from glos_qartod.pipeline import run_pipeline
+from glos_qartod.summary import FlagSummary
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestSummary(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'flat_line.low_reps': 2,
+            'flat_line.high_reps': 3, 'flat_line.epsilon': 0.001
+        }])
+        rng = np.random.RandomState(8)
+        self.paths = []
+        self.times = []
+        for i in range(2):
+            times = 1472601600 + 86400 * i + 600 * np.arange(50, dtype='f8')
+            values = ma.masked_array(rng.uniform(-0.2, 1.2, 50))
+            values[[0, 7, 49]] = ma.masked
+            self.paths.append(create_station_file(
+                os.path.join(self.tmpdir, 'leorgn_{}.nc'.format(i)), times,
+                values))
+            self.times.append(times)
+
+    def open_summary(self, name='summary.db', **kwargs):
+        summary = FlagSummary(os.path.join(self.tmpdir, name), **kwargs)
+        self.addCleanup(summary.close)
+        return summary
+
+    def expected(self, path, test):
+        with Dataset(path.replace('.nc', '.ncq')) as nc:
+            flags = ma.filled(nc.variables[
+                'qartod_blue_green_algae_{}_flag'.format(test)][:], 9)
+        counts = np.bincount(flags.astype(np.uint8), minlength=10)
+        return dict(good=counts[1], not_evaluated=counts[2],
+                    suspect=counts[3], bad=counts[4], missing=counts[9])
+
+    def check(self, summary, paths):
+        rows = summary.query(by_file=True)
+        assert [(os.path.basename(r['file']), r['test']) for r in rows] == \
+            [(os.path.basename(path), test) for path in paths
+             for test in ('flat_line', 'gross_range', 'primary')]
+        for row in rows:
+            path = row['file']
+            for key, value in self.expected(path, row['test']).items():
+                assert row[key] == value, (path, key)
+            assert row['station_id'] == 'leorgn'
+            assert row['variable'] == 'blue_green_algae'
+            times = self.times[self.paths.index(path)]
+            # the first and last records are missing
+            assert row['time_start'] == times[1]
+            assert row['time_end'] == times[48]
+
+    def test_run_qc(self):
+        summary = self.open_summary()
+        for path in self.paths:
+            with Dataset(path) as nc:
+                cli.run_qc(self.config, nc, summary=summary)
+        self.check(summary, self.paths)
+
+        totals = summary.query(test='gross_range')
+        assert len(totals) == 1
+        assert totals[0]['files'] == 2
+        assert totals[0]['missing'] == 6
+        assert totals[0]['good'] + totals[0]['bad'] == 94
+        assert totals[0]['time_start'] == self.times[0][1]
+        assert totals[0]['time_end'] == self.times[1][48]
+        # only the second file overlaps
+        rows = summary.query(test='gross_range', start=self.times[1][0])
+        assert rows[0]['files'] == 1
+        assert summary.query(station_id='other') == []
+
+    def test_memoized_rerun(self):
+        for path in self.paths:
+            with Dataset(path) as nc:
+                cli.run_qc(self.config, nc)
+        # the flags are up to date, so a new summary is filled from the
+        # flags already written
+        summary = self.open_summary()
+        for path in self.paths:
+            with Dataset(path) as nc:
+                cli.run_qc(self.config, nc, summary=summary)
+        self.check(summary, self.paths)
+
+    def test_pipeline(self):
+        summary = self.open_summary()
+        run_pipeline(self.config, self.paths, summary=summary)
+        self.check(summary, self.paths)
+
+    def test_concurrent_writers(self):
+        # two workers sharing the database, each part way through a file
+        summaries = [self.open_summary(timeout=0.1) for _ in range(2)]
+        flags = np.array([1, 1, 3, 4, 9], dtype=np.int8)
+        for summary, path in zip(summaries, self.paths):
+            summary.record(path, 'leorgn', 'blue_green_algae', 'gross_range',
+                           flags)
+        # recorded rows aren't visible until committed
+        assert summaries[1].query() == []
+        assert summaries[0].has(self.paths[0], 'blue_green_algae',
+                                'gross_range')
+        for summary in reversed(summaries):
+            summary.commit()
+        rows = summaries[0].query(by_file=True)
+        assert [os.path.basename(row['file']) for row in rows] == \
+            ['leorgn_0.nc', 'leorgn_1.nc']
+        assert [(row['good'], row['suspect'], row['bad'], row['missing'])
+                for row in rows] == [(2, 1, 1, 1)] * 2
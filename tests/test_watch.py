@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_watch.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import run
+from tests.resources import create_station_file
+
+import numpy as np
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+
+class TestWatch(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.conf = pd.DataFrame([{
+            'station_id': '*', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1
+        }, {
+            'station_id': '*', 'variable': 'turbidity', 'units': 'NTU',
+            'gross_range.sensor_min': np.nan
+        }])
+        self.mappings = {'blue_green_algae': 'ysi_blue_green_algae'}
+        self.existing = self.create_file('ysi_blue_green_algae', 'leorgn',
+                                         'a.nc')
+        os.makedirs(os.path.join(self.tmpdir, 'turbidity', 'leorgn'))
+        self.enqueued = []
+
+    def create_file(self, *parts):
+        path = os.path.join(self.tmpdir, *parts)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        times = 1472601600 + 600 * np.arange(10, dtype='f8')
+        return create_station_file(path, times, np.zeros(10))
+
+    def watcher(self, settle):
+        try:
+            watcher = run.Watcher(self.tmpdir, self.conf, self.mappings,
+                                  self.enqueued.append, settle=settle)
+        except OSError:
+            self.skipTest('inotify is not available')
+        self.addCleanup(watcher.close)
+        return watcher
+
+    def test_variable_dirs(self):
+        assert run.variable_dirs(self.tmpdir, self.conf, self.mappings) == \
+            {os.path.join(self.tmpdir, 'ysi_blue_green_algae')}
+
+    def test_new_files(self):
+        watcher = self.watcher(settle=0)
+        # the first poll sweeps and finds the file without QC
+        watcher.poll()
+        assert self.enqueued == [self.existing]
+
+        new = self.create_file('ysi_blue_green_algae', 'leorgn', 'b.nc')
+        self.create_file('ysi_blue_green_algae', 'leorgn', 'b.txt')
+        # not configured
+        self.create_file('turbidity', 'leorgn', 'c.nc')
+        watcher.poll(1)
+        assert self.enqueued == [self.existing, new]
+
+        # a new station and subdirectory
+        station = self.create_file('ysi_blue_green_algae', '45005', 'd.nc')
+        watcher.poll(1)
+        nested = self.create_file('ysi_blue_green_algae', '45005', '2017',
+                                  'e.nc')
+        watcher.poll(1)
+        assert self.enqueued[2:] == [station, nested]
+
+        # modified files are QC'd again
+        with open(self.existing, 'ab') as f:
+            f.write(b'\0')
+        watcher.poll(1)
+        assert self.enqueued[4:] == [self.existing]
+
+    def test_debounce(self):
+        watcher = self.watcher(settle=60)
+        watcher.poll()
+        assert self.enqueued == []
+        new = self.create_file('ysi_blue_green_algae', 'leorgn', 'b.nc')
+        watcher.poll(1)
+        assert sorted(watcher.pending) == sorted([self.existing, new])
+        assert 0 < watcher.timeout(watcher.pending[new]) <= 60
+        # another write restarts the wait
+        watcher.pending[new] -= 50
+        with open(new, 'ab') as f:
+            f.write(b'\0')
+        watcher.poll(1)
+        assert self.enqueued == []
+        for path in watcher.pending:
+            watcher.pending[path] -= 60
+        watcher.poll()
+        assert sorted(self.enqueued) == sorted([self.existing, new])
+        assert watcher.pending == {}
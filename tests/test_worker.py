@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_worker.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from glos_qartod import config, get_logger
+from glos_qartod.worker import PreloadWorker, preload
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import pandas as pd
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class RecordingHandler(logging.Handler):
+    '''
+    Keeps the log records it handles
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class StubJob(object):
+    '''
+    The attributes of an rq job the worker reads before forking it
+    '''
+
+    def __init__(self, args):
+        self.id = 'stub'
+        self._args = args
+
+    @property
+    def args(self):
+        if isinstance(self._args, Exception):
+            raise self._args
+        return self._args
+
+
+class TestWorker(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        config.clear_cache()
+        self.addCleanup(config.clear_cache)
+        self.path = os.path.join(self.tmpdir, 'config.xlsx')
+        self.write_workbook(1)
+
+    def write_workbook(self, sensor_max):
+        with pd.ExcelWriter(self.path) as writer:
+            pd.DataFrame([{
+                'station_id': 'leorgn', 'variable': 'blue_green_algae',
+                'units': 'rfu', 'gross_range.sensor_min': 0,
+                'gross_range.sensor_max': sensor_max
+            }]).to_excel(writer, sheet_name='Variable Config', index=False)
+            pd.DataFrame([{
+                'var_name': 'blue_green_algae',
+                'var_dir': 'ysi_blue_green_algae'
+            }]).to_excel(writer, sheet_name='Mappings', index=False)
+
+    def cached(self):
+        '''
+        Returns the cache entry of the workbook
+        '''
+        return config._cache.get(os.path.abspath(self.path), (None, {}))[1]
+
+    def sensor_max(self, compiled):
+        return compiled.get('leorgn',
+                            'blue_green_algae')['gross_range.sensor_max']
+
+    def worker(self):
+        connection = fakeredis.FakeStrictRedis()
+        return PreloadWorker(['default'], connection=connection,
+                             config_paths=[self.path])
+
+    def errors(self):
+        handler = RecordingHandler()
+        handler.setLevel(logging.ERROR)
+        get_logger().addHandler(handler)
+        self.addCleanup(get_logger().removeHandler, handler)
+        return handler.records
+
+    def test_preload(self):
+        preload([self.path])
+        assert 'ioos_qartod.qc_tests.qc' in sys.modules
+        compiled = self.cached()['compiled']
+        assert self.sensor_max(compiled) == 1
+        # jobs get the compiled config from the cache
+        assert config.load_compiled_config(self.path) is compiled
+
+    @skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_refresh_config(self):
+        worker = self.worker()
+        assert worker.config_paths == [self.path]
+        preload(worker.config_paths)
+        first = config.load_compiled_config(self.path)
+        self.write_workbook(2)
+        st = os.stat(self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime + 10))
+
+        worker.refresh_config(StubJob((self.path, 'leorgn.nc')))
+        compiled = self.cached()['compiled']
+        assert compiled is not first
+        assert self.sensor_max(compiled) == 2
+        assert config.load_compiled_config(self.path) is compiled
+
+    @skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_refresh_config_other_jobs(self):
+        worker = self.worker()
+        errors = self.errors()
+        # jobs without a config path are left alone
+        worker.refresh_config(StubJob(()))
+        worker.refresh_config(StubJob((42,)))
+        assert errors == []
+        assert config._cache == {}
+
+        # failures are logged and left for the job to report
+        worker.refresh_config(StubJob((os.path.join(self.tmpdir,
+                                                     'missing.xlsx'),)))
+        worker.refresh_config(StubJob(ValueError('unpickling failed')))
+        assert [record.getMessage() for record in errors] == [
+            'Could not preload config {}'.format(
+                os.path.join(self.tmpdir, 'missing.xlsx')),
+            'Could not read arguments of job stub']
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_write_path.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase
+from glos_qartod import cli, qc
+from ioos_qartod.qc_tests import qc as qartod
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+import quantities as pq
+
+
+class TestWritePath(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'rate_of_change.threshold': 1,
+            'flat_line.low_reps': 2, 'flat_line.high_reps': 3,
+            'flat_line.epsilon': 0.001
+        }])
+        self.times = 1472601600 + 600 * np.arange(100, dtype='f8')
+        rng = np.random.RandomState(3)
+        self.values = ma.masked_array(rng.uniform(-0.2, 1.2, 100))
+        self.values[40:46] = 0.5
+        self.path = os.path.join(self.tmpdir, 'leorgn.nc')
+        self.qc_path = os.path.join(self.tmpdir, 'leorgn.ncq')
+
+    def run_qc(self, values):
+        create_station_file(self.path, self.times, values)
+        with Dataset(self.path) as nc:
+            cli.run_qc(self.config, nc)
+        with Dataset(self.qc_path) as nc:
+            return dict((test, ma.filled(nc.variables[
+                'qartod_blue_green_algae_{}_flag'.format(test)][:], 9))
+                for test in ('gross_range', 'rate_of_change', 'flat_line',
+                             'primary'))
+
+    def expected_flags(self, values):
+        '''
+        Returns the flags of the tests run directly over the valid values,
+        scattered back with MISSING for the masked records
+        '''
+        valid = ~ma.getmaskarray(values)
+        compressed = ma.getdata(values)[valid]
+        dates = np.array(self.times[valid] * 1000, dtype='datetime64[ms]')
+        expected = {
+            'gross_range': qartod.range_check(compressed, [0, 1]),
+            'rate_of_change': qartod.rate_of_change_check(dates, compressed,
+                                                          1 / pq.hour),
+            'flat_line': qartod.flat_line_check(compressed, 2, 3, 0.001)
+        }
+        expected['primary'] = qartod.qc_compare(list(expected.values()))
+        for test, flags in expected.items():
+            full = np.full(values.shape, 9, dtype=np.int8)
+            full[valid] = flags
+            expected[test] = full
+        return expected
+
+    def check_flags(self, values):
+        result = self.run_qc(values)
+        for test, flags in self.expected_flags(values).items():
+            np.testing.assert_array_equal(result[test], flags, test)
+
+    def test_partially_masked(self):
+        values = self.values.copy()
+        values[[0, 7, 41, 42, 60, 99]] = ma.masked
+        self.check_flags(values)
+
+    def test_masked_records_reset(self):
+        self.check_flags(self.values)
+        # flags left from an earlier run don't survive once a record is
+        # missing
+        values = self.values.copy()
+        values[10:30] = ma.masked
+        self.check_flags(values)
+
+    def test_all_masked(self):
+        values = ma.masked_all(self.values.shape)
+        result = self.run_qc(values)
+        for flags in result.values():
+            assert (flags == 9).all()
+
+    def test_block_writes(self):
+        # blocks of 10 records, aligned to the chunks of 5, so the last of
+        # the 103 records are written in a block of 3
+        self.addCleanup(setattr, qc, 'WRITE_BLOCK', qc.WRITE_BLOCK)
+        qc.WRITE_BLOCK = 12
+        flags = (np.arange(103) % 4 + 1).astype(np.int8)
+        flags[[3, 50, 51, 102]] = 9
+        for file_format, size, kwargs in (
+                ('NETCDF4', 103, {'chunksizes': (5,)}),
+                ('NETCDF4', None, {'chunksizes': (5,)}),
+                ('NETCDF3_CLASSIC', None, {})):
+            with Dataset(self.qc_path, 'w', format=file_format) as nc:
+                nc.createDimension('time', size)
+                ncvar = nc.createVariable('flags', np.int8, ('time',),
+                                          fill_value=np.int8(9), **kwargs)
+                ncvar[:103] = 3
+                qc.write_flag_array(ncvar, flags)
+                # an unlimited dimension isn't grown past the flags
+                assert len(nc.dimensions['time']) == 103
+                np.testing.assert_array_equal(ma.filled(ncvar[:], 9), flags,
+                                              file_format)
+
+    def test_block_writes_2d(self):
+        # rows of 4 flags, so blocks of 3 rows and a last block of 1
+        self.addCleanup(setattr, qc, 'WRITE_BLOCK', qc.WRITE_BLOCK)
+        qc.WRITE_BLOCK = 12
+        flags = (np.arange(40) % 4 + 1).astype(np.int8).reshape(10, 4)
+        with Dataset(self.qc_path, 'w') as nc:
+            nc.createDimension('time', None)
+            nc.createDimension('depth', 4)
+            ncvar = nc.createVariable('flags', np.int8, ('time', 'depth'),
+                                      fill_value=np.int8(9))
+            qc.write_flag_array(ncvar, flags)
+            assert len(nc.dimensions['time']) == 10
+            np.testing.assert_array_equal(ncvar[:], flags)
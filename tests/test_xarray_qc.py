@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_xarray_qc.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from glos_qartod import cli
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+try:
+    from glos_qartod.xarray_qc import run_qc_xarray
+    import dask
+    import xarray
+except ImportError:
+    run_qc_xarray = None
+
+
+@skipIf(run_qc_xarray is None, "xarray and dask are not installed")
+class TestXarrayQC(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'rate_of_change.threshold': 1,
+            'flat_line.low_reps': 2, 'flat_line.high_reps': 3,
+            'flat_line.epsilon': 0.001
+        }])
+        times = 1472601600 + 600 * np.arange(60, dtype='f8')
+        values = ma.masked_array(np.linspace(0, 1, 60))
+        values[13:19] = 0.5
+        values[20] = 5
+        values[41] = ma.masked
+        self.paths = []
+        for name in ('netcdf4', 'dask'):
+            path = os.path.join(self.tmpdir, '{}.nc'.format(name))
+            self.paths.append(create_station_file(path, times, values))
+
+    def flags(self, nc_path):
+        qc_path = nc_path.rsplit('.', 1)[0] + '.ncq'
+        with Dataset(qc_path) as nc:
+            return {k: v[:] for k, v in nc.variables.items()}
+
+    def test_matches_netcdf4_backend(self):
+        with Dataset(self.paths[0]) as nc:
+            cli.run_qc(self.config, nc)
+        # small chunks so window tests cross chunk boundaries
+        run_qc_xarray(self.config, self.paths[1], chunk_size=7,
+                      scheduler='threads')
+
+        expected = self.flags(self.paths[0])
+        result = self.flags(self.paths[1])
+        assert set(result) == set(expected)
+        for test in ('gross_range', 'rate_of_change', 'flat_line',
+                     'primary'):
+            varname = 'qartod_blue_green_algae_{}_flag'.format(test)
+            np.testing.assert_array_equal(ma.filled(result[varname], 9),
+                                          ma.filled(expected[varname], 9))
+        assert os.path.exists(self.paths[1].rsplit('.', 1)[0] + '.ncml')
+
+    def test_scheduler(self):
+        # the QC file's variables can't be stored from other processes
+        with self.assertRaises(ValueError):
+            run_qc_xarray(self.config, self.paths[1], scheduler='processes')
+        assert not os.path.exists(self.paths[1].rsplit('.', 1)[0] + '.ncq')
+
+    def test_multidim_skipped(self):
+        with Dataset(self.paths[1], 'a') as nc:
+            nc.createDimension('depth', 3)
+            ncvar = nc.createVariable('temperature', 'f4', ('time', 'depth'),
+                                      fill_value=np.float32(-9999.))
+            ncvar.standard_name = 'sea_water_temperature'
+            ncvar.units = 'degC'
+            ncvar[:] = np.ones((60, 3))
+        config = pd.concat([self.config, pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'temperature',
+            'units': 'degC', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 25
+        }])], ignore_index=True)
+        with Dataset(self.paths[0]) as nc:
+            cli.run_qc(self.config, nc)
+        run_qc_xarray(config, self.paths[1], chunk_size=7,
+                      scheduler='threads')
+
+        # the 1-D variable is still QC'd and the 2-D one is left out
+        expected = self.flags(self.paths[0])
+        result = self.flags(self.paths[1])
+        assert set(result) == set(expected)
+        varname = 'qartod_blue_green_algae_primary_flag'
+        np.testing.assert_array_equal(ma.filled(result[varname], 9),
+                                      ma.filled(expected[varname], 9))
+
+    def test_clears_digests(self):
+        with Dataset(self.paths[0]) as nc:
+            cli.run_qc(self.config, nc)
+        expected = self.flags(self.paths[0])
+        with Dataset(self.paths[1]) as nc:
+            cli.run_qc(self.config, nc)
+        config = self.config.copy()
+        config['gross_range.sensor_max'] = 0.3
+        run_qc_xarray(config, self.paths[1], scheduler='threads')
+
+        # the flags of the dask run aren't mistaken for those of the first
+        with Dataset(self.paths[1]) as nc:
+            cli.run_qc(self.config, nc)
+        result = self.flags(self.paths[1])
+        for varname in ('qartod_blue_green_algae_gross_range_flag',
+                        'qartod_blue_green_algae_primary_flag'):
+            np.testing.assert_array_equal(ma.filled(result[varname], 9),
+                                          ma.filled(expected[varname], 9))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+tests/test_zarr_qc.py
+'''
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from unittest import TestCase, skipIf
+from glos_qartod import cli
+from netCDF4 import Dataset
+from tests.resources import create_station_file
+
+import numpy as np
+import numpy.ma as ma
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+try:
+    from glos_qartod.zarr_qc import export_ncq, run_qc_zarr
+    import zarr
+except ImportError:
+    run_qc_zarr = None
+
+
+@skipIf(run_qc_zarr is None, "zarr is not installed")
+class TestZarrQC(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = pd.DataFrame([{
+            'station_id': 'leorgn', 'variable': 'blue_green_algae',
+            'units': 'rfu', 'gross_range.sensor_min': 0,
+            'gross_range.sensor_max': 1, 'rate_of_change.threshold': 1,
+            'flat_line.low_reps': 2, 'flat_line.high_reps': 3,
+            'flat_line.epsilon': 0.001
+        }])
+        times = 1472601600 + 600 * np.arange(60, dtype='f8')
+        values = ma.masked_array(np.linspace(0, 1, 60))
+        values[13:19] = 0.5
+        values[20] = 5
+        values[41] = ma.masked
+        self.paths = []
+        for name in ('netcdf4', 'zarr'):
+            path = os.path.join(self.tmpdir, '{}.nc'.format(name))
+            self.paths.append(create_station_file(path, times, values))
+
+    def flags(self, nc_path):
+        qc_path = nc_path.rsplit('.', 1)[0] + '.ncq'
+        with Dataset(qc_path) as nc:
+            return {k: (v[:], {a: v.getncattr(a) for a in v.ncattrs()})
+                    for k, v in nc.variables.items()}
+
+    def test_store_and_export(self):
+        with Dataset(self.paths[0]) as nc:
+            cli.run_qc(self.config, nc)
+        # small chunks so the store has several chunks per variable
+        with Dataset(self.paths[1]) as nc:
+            run_qc_zarr(self.config, nc, chunk_size=7, workers=4)
+
+        store_path = self.paths[1].rsplit('.', 1)[0] + '.zarr'
+        group = zarr.open_group(store_path, mode='r')
+        expected = self.flags(self.paths[0])
+        assert set(group.array_keys()) == set(expected)
+        primary = group['qartod_blue_green_algae_primary_flag']
+        assert primary.chunks == (7,)
+        assert primary.compressor is not None
+        assert primary.attrs['flag_meanings'] == \
+            'GOOD NOT_EVALUATED SUSPECT BAD MISSING'
+        assert primary.attrs['_ARRAY_DIMENSIONS'] == ['time']
+        np.testing.assert_array_equal(
+            primary[:], ma.filled(expected[primary.basename][0], 9))
+
+        export_ncq(store_path)
+        result = self.flags(self.paths[1])
+        assert set(result) == set(expected)
+        for varname, (values, attrs) in expected.items():
+            np.testing.assert_array_equal(ma.filled(result[varname][0], 9),
+                                          ma.filled(values, 9))
+            result_attrs = result[varname][1]
+            np.testing.assert_array_equal(result_attrs.pop('flag_values'),
+                                          attrs.pop('flag_values'))
+            assert result_attrs == attrs
+        with open(self.paths[1].rsplit('.', 1)[0] + '.ncml') as f:
+            ncml = f.read()
+        assert 'qartod_blue_green_algae_flat_line_flag' in ncml
+        assert 'zarr.ncq' in ncml
+
+    def test_rerun_updates_store(self):
+        store_path = self.paths[1].rsplit('.', 1)[0] + '.zarr'
+        for _ in range(2):
+            with Dataset(self.paths[1]) as nc:
+                run_qc_zarr(self.config, nc, chunk_size=7)
+        group = zarr.open_group(store_path, mode='r')
+        gross_range = group['qartod_blue_green_algae_gross_range_flag'][:]
+        assert gross_range[20] == 4
+        assert gross_range[41] == 9
+        assert group.attrs['ancillary_variables']['blue_green_algae']